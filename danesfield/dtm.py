@@ -11,6 +11,11 @@
 """DTM (Digital Terrain Model) estimation from a DSM (Digital Surface Model)
 """
 
+import concurrent.futures
+import logging
+import os
+import tempfile
+
 import numpy
 import scipy.ndimage as ndimage
 
@@ -20,8 +25,22 @@ class DTMEstimator(object):
     """
 
     def __init__(self, nodata_val=-9999, num_outer_iter=100,
-                 num_inner_iter=10, base_step=1):
+                 num_inner_iter=10, base_step=1, num_workers=1,
+                 tolerance=None, min_iter=1, dtype=None, inplace=False):
         """Constructor
+
+        With num_workers > 1, the cloth draping of large images is split
+        into bands of rows processed by a pool of threads.
+
+        If tolerance is given, the cloth draping of a pyramid level stops
+        early once the largest change of the cloth height in an outer
+        iteration is less than tolerance, after at least min_iter outer
+        iterations.  Otherwise the full schedule of iterations is run.
+
+        If dtype is given, e.g. numpy.float32, the DSM is converted to it
+        and the DTM is computed in it.  With inplace, the cloth and the
+        blur output are two buffers allocated once and shared by all the
+        pyramid levels, instead of new arrays at every iteration.
         """
         if nodata_val is None:
             nodata_val = -9999
@@ -29,6 +48,14 @@ class DTMEstimator(object):
         self.num_outer_iter = num_outer_iter
         self.num_inner_iter = num_inner_iter
         self.base_step = base_step
+        self.num_workers = num_workers
+        self.tolerance = tolerance
+        self.min_iter = min_iter
+        self.dtype = dtype
+        self.inplace = inplace
+        # Iteration counts and residuals of each pyramid level of the
+        # last fit, from the coarsest level to the finest
+        self.level_stats = []
 
     @staticmethod
     def downsample(dtm):
@@ -57,6 +84,30 @@ class DTMEstimator(object):
         out[::2, 1::2] = dtm[:, s1]
         out[1::2, 1::2] = dtm[s0, s1]
 
+    @staticmethod
+    def pyramid_shapes(shape):
+        """Shapes of the levels of the image pyramid of an image of the
+        given shape, from the finest level to the coarsest.  Images are
+        downsampled while both dimensions are larger than 100 pixels.
+        """
+        shapes = [tuple(shape)]
+        while min(shapes[-1]) > 100:
+            shapes.append(tuple((s + 1) // 2 for s in shapes[-1]))
+        return shapes
+
+    def level_schedule(self, step, level, max_level):
+        """
+        Step size and number of outer iterations of a pyramid level, given
+        the step size and the index of the coarsest level
+        """
+        if level == max_level:
+            return step, self.num_outer_iter
+        # Decrease the step size exponentially when moving back down the pyramid
+        step = step / (2 * 2 ** (max_level - level))
+        # Decrease the number of iterations as well
+        num_iter = max(1, int(self.num_outer_iter / (2 ** (max_level - level))))
+        return step, num_iter
+
     def recursive_fit_dtm(self, dtm, dsm, step=1, level=0):
         """
         Recursive function to apply multi-scale DTM fitting
@@ -70,35 +121,200 @@ class DTMEstimator(object):
             sm_dtm, max_level = self.recursive_fit_dtm(sm_dtm, sm_dsm, step, level+1)
             # Upsample the DTM back to the original resolution
             self.upsample(sm_dtm, dtm)
-            print("level {} of {}".format(level, max_level))
-            # Decrease the step size exponentially when moving back down the pyramid
-            step = step / (2 * 2 ** (max_level - level))
-            # Decrease the number of iterations as well
-            num_iter = max(1, int(self.num_outer_iter / (2 ** (max_level - level))))
+            step, num_iter = self.level_schedule(step, level, max_level)
             # Apply iterations of cloth draping simulation to smooth out the result
-            return self.drape_cloth(dtm, dsm, step, num_iter), max_level
+            return self.drape_cloth(dtm, dsm, step, num_iter, level), max_level
 
-        print("reached min size {}".format(dtm.shape))
         # Apply cloth draping at the coarsest level (base case)
-        return self.drape_cloth(dtm, dsm, step, self.num_outer_iter), level
+        return self.drape_cloth(dtm, dsm, step, self.num_outer_iter, level), level
+
+    def recursive_fit_dtm_inplace(self, buffers, dsm, valid, step, initial_height, level=0):
+        """
+        Recursive function to apply multi-scale DTM fitting in place.
+
+        buffers are two flat arrays at least as large as dsm.  Each level
+        uses views of their first pixels, one for the cloth and one for
+        the blur output.  The upsampled cloth of the coarser level is
+        written to the buffer its result is not in.  Returns the DTM, a
+        view of one of the buffers, and the number of levels.
+        """
+        def view(buf):
+            return buf[:dsm.size].reshape(dsm.shape)
+
+        # if the image is still larger than 100 pixels, downsample
+        if numpy.min(dsm.shape) > 100:
+            # Recursively apply DTM fitting to the downsampled image
+            sm_dtm, max_level = self.recursive_fit_dtm_inplace(
+                buffers, self.downsample(dsm), self.downsample(valid), step,
+                initial_height, level+1)
+            if numpy.may_share_memory(sm_dtm, buffers[0]):
+                scratch, dtm = view(buffers[0]), view(buffers[1])
+            else:
+                dtm, scratch = view(buffers[0]), view(buffers[1])
+            # Upsample the DTM back to the original resolution
+            self.upsample(sm_dtm, dtm)
+            step, num_iter = self.level_schedule(step, level, max_level)
+        else:
+            # Apply cloth draping at the coarsest level (base case)
+            dtm, scratch = view(buffers[0]), view(buffers[1])
+            dtm.fill(initial_height)
+            num_iter = self.num_outer_iter
+            max_level = level
+        return self.drape_cloth(dtm, dsm, step, num_iter, level,
+                                valid=valid, scratch=scratch), max_level
+
+    def drape_cloth_iteration(self, dtm, dsm, valid, step, scratch=None):
+        """
+        Compute one outer iteration of the cloth draping simulation,
+        modifying dtm in place.  Returns the updated DTM.
+
+        If scratch is given, it is an array of the shape of dtm that the
+        blur writes to, and the updated DTM is either dtm or scratch.
+        """
+        # raise the DTM by step (inverted gravity)
+        numpy.add(dtm, step, out=dtm, where=valid)
+        for i in range(self.num_inner_iter):
+            # handle DSM intersections, snap back to below DSM
+            numpy.minimum(dtm, dsm, out=dtm, where=valid)
+            # apply spring tension forces (blur the DTM)
+            if scratch is None:
+                dtm = ndimage.uniform_filter(dtm, size=3)
+            else:
+                ndimage.uniform_filter(dtm, size=3, output=scratch)
+                dtm, scratch = scratch, dtm
+        return dtm
 
-    def drape_cloth(self, dtm, dsm, step=1, num_outer_iter=10):
+    def num_bands(self, shape):
+        """
+        Number of bands of rows the cloth draping of an image is split
+        into.  Bands are at least twice as tall as the halo of rows they
+        read from their neighbors, which is recomputed by both bands.
+        """
+        halo = max(self.num_inner_iter, 1)
+        return max(1, min(self.num_workers, shape[0] // (2 * halo)))
+
+    def check_convergence(self, stats, dtm, prev_dtm):
+        """
+        Record the change of the cloth over the last outer iteration in
+        the stats of a pyramid level, overwriting prev_dtm.  Returns True
+        if the cloth draping of the level has converged.
+        """
+        update = numpy.subtract(dtm, prev_dtm, out=prev_dtm)
+        numpy.abs(update, out=update)
+        stats['max_update'] = float(update.max())
+        stats['mean_update'] = float(update.mean())
+        stats['converged'] = (self.tolerance is not None and
+                              stats['iterations'] >= self.min_iter and
+                              stats['max_update'] < self.tolerance)
+        return stats['converged']
+
+    def log_level_stats(self, stats):
+        self.level_stats.append(stats)
+        logging.info("dtm level={level} shape={shape[0]}x{shape[1]} "
+                     "iterations={iterations}/{max_iterations} "
+                     "max_update={max_update:.4g} mean_update={mean_update:.4g} "
+                     "converged={converged}".format(**stats))
+
+    def drape_cloth(self, dtm, dsm, step=1, num_outer_iter=10, level=0,
+                    valid=None, scratch=None, stats=None):
         """
         Compute inverted 2.5D cloth draping simulation iterations
+
+        valid is the mask of valid DSM pixels, computed if not given.  If
+        scratch is given, it is an array of the shape of dtm used as
+        second buffer, and the result is either dtm or scratch.  If stats
+        is given, the iteration count and residuals are written to that
+        dict instead of being logged as a pyramid level.
         """
-        print("draping:", end='')
-        for i in range(num_outer_iter):
-            print(".", end='', flush=True)
-            # raise the DTM by step (inverted gravity)
+        log_stats = stats is None
+        if log_stats:
+            stats = {}
+        stats.update({'level': level, 'shape': dtm.shape, 'iterations': 0,
+                      'max_iterations': num_outer_iter, 'max_update': float('nan'),
+                      'mean_update': float('nan'), 'converged': False})
+        if valid is None:
             valid = dsm != self.nodata_val
-            dtm[valid] += step
-            for i in range(self.num_inner_iter):
-                # handle DSM intersections, snap back to below DSM
-                numpy.minimum(dtm, dsm, out=dtm, where=valid)
-                # apply spring tension forces (blur the DTM)
-                dtm = ndimage.uniform_filter(dtm, size=3)
-        # print newline after progress bar
-        print("")
+        num_bands = self.num_bands(dtm.shape)
+        if num_bands > 1:
+            with concurrent.futures.ThreadPoolExecutor(num_bands) as executor:
+                dtm = self.drape_cloth_bands(dtm, dsm, step, num_outer_iter,
+                                             num_bands, executor, stats, valid, scratch)
+        else:
+            prev_dtm = None
+            for i in range(num_outer_iter):
+                # the residual of the last iteration is always recorded
+                check = self.tolerance is not None or i == num_outer_iter - 1
+                if check:
+                    if prev_dtm is None:
+                        prev_dtm = numpy.empty_like(dtm)
+                    numpy.copyto(prev_dtm, dtm)
+                if scratch is None:
+                    dtm = self.drape_cloth_iteration(dtm, dsm, valid, step)
+                else:
+                    new_dtm = self.drape_cloth_iteration(dtm, dsm, valid, step, scratch)
+                    if new_dtm is scratch:
+                        dtm, scratch = scratch, dtm
+                stats['iterations'] += 1
+                if check and self.check_convergence(stats, dtm, prev_dtm):
+                    break
+            # one final intersection check
+            numpy.minimum(dtm, dsm, out=dtm, where=valid)
+        if log_stats:
+            self.log_level_stats(stats)
+        return dtm
+
+    def drape_cloth_bands(self, dtm, dsm, step, num_outer_iter, num_bands, executor,
+                          stats, valid, out=None):
+        """
+        Compute cloth draping simulation iterations on bands of rows in
+        parallel.
+
+        The blur spreads values by one pixel per inner iteration, so each
+        band is processed with a halo of num_inner_iter rows from its
+        neighbors and the band rows are exact.  The halos are exchanged
+        between outer iterations through a second buffer.  The results
+        match drape_cloth within floating point tolerance, since the
+        running sums of the blur start at different rows.
+
+        If out is given, it is used as second buffer and the band windows
+        are allocated once, otherwise they are copied at each iteration.
+        """
+        halo = self.num_inner_iter
+        rows = dtm.shape[0]
+        edges = numpy.linspace(0, rows, num_bands + 1).astype(int)
+        # (first, last) rows of each band and of its window with halo
+        bands = [(r0, r1, max(r0 - halo, 0), min(r1 + halo, rows))
+                 for r0, r1 in zip(edges[:-1], edges[1:])]
+
+        if out is None:
+            out = numpy.empty_like(dtm)
+            windows = [None] * num_bands
+        else:
+            windows = [(numpy.empty((w1 - w0, dtm.shape[1]), dtm.dtype),
+                        numpy.empty((w1 - w0, dtm.shape[1]), dtm.dtype))
+                       for r0, r1, w0, w1 in bands]
+
+        def update_band(band, window, src, dst):
+            r0, r1, w0, w1 = band
+            if window is None:
+                result = self.drape_cloth_iteration(src[w0:w1].copy(), dsm[w0:w1],
+                                                    valid[w0:w1], step)
+            else:
+                numpy.copyto(window[0], src[w0:w1])
+                result = self.drape_cloth_iteration(window[0], dsm[w0:w1],
+                                                    valid[w0:w1], step, window[1])
+            dst[r0:r1] = result[r0 - w0:r1 - w0]
+
+        for i in range(num_outer_iter):
+            # list() waits for all bands and raises their exceptions
+            list(executor.map(update_band, bands, windows,
+                              [dtm] * num_bands, [out] * num_bands))
+            dtm, out = out, dtm
+            stats['iterations'] += 1
+            # out holds the cloth before this iteration
+            if (self.tolerance is not None or i == num_outer_iter - 1) and \
+               self.check_convergence(stats, dtm, out):
+                break
         # one final intersection check
         numpy.minimum(dtm, dsm, out=dtm, where=valid)
         return dtm
@@ -107,14 +323,140 @@ class DTMEstimator(object):
         """
         Fit a Digital Terrain Model (DTM) to the provided Digital Surface Model (DSM)
         """
-        # initialize DTM to a deep copy of the DSM
-        dtm = dsm.copy()
+        valid = dsm != self.nodata_val
+        if self.dtype is not None:
+            dsm = dsm.astype(self.dtype, copy=False)
         # get the range of valid height values (skipping no-data values)
-        valid_data = dsm[dsm != self.nodata_val]
+        valid_data = dsm[valid]
         minv = numpy.min(valid_data)
         maxv = numpy.max(valid_data)
+        del valid_data
         # compute the step size that covers the range in num_iter steps
         step = (maxv - minv) / self.num_outer_iter
+        self.level_stats = []
+        return self.fit_levels(dsm, valid, step, minv)
+
+    def fit_levels(self, dsm, valid, step, initial_height, level=0):
+        """
+        Fit the DTM of pyramid level level, and of all the coarser levels,
+        to the DSM downsampled to that level
+        """
+        if self.inplace:
+            buffers = (numpy.empty(dsm.size, dsm.dtype), numpy.empty(dsm.size, dsm.dtype))
+            return self.recursive_fit_dtm_inplace(buffers, dsm, valid, step,
+                                                  initial_height, level)[0]
         # initialize the DTM values to the minimum DSM height
-        dtm = numpy.full(dsm.shape, minv, dsm.dtype)
-        return self.recursive_fit_dtm(dtm, dsm, step)[0]
+        dtm = numpy.full(dsm.shape, initial_height, dsm.dtype)
+        return self.recursive_fit_dtm(dtm, dsm, step, level)[0]
+
+    def fit_dtm_tiled(self, read_dsm, write_dtm, shape, tile_size=2048, temp_dir=None):
+        """
+        Fit a DTM to a DSM too large to be held in memory, reading and
+        writing it by tiles.
+
+        read_dsm(row, col, rows, cols, factor) returns the (rows, cols)
+        window starting at (row, col) of the DSM decimated by factor,
+        i.e. the pixels dsm[row * factor::factor, col * factor::factor].
+        write_dtm(row, col, dtm) writes a window of the full resolution
+        DTM starting at (row, col).  shape is the shape of the DSM.
+
+        The coarse pyramid levels, from the first with at most tile_size
+        squared pixels, are fit in memory to a decimated read of the DSM.
+        Each finer level is then refined in tiles of tile_size pixels,
+        with a halo of one pixel per inner iteration of the level which
+        makes the tiles match fit_dtm within floating point tolerance.
+        The intermediate levels are kept in memory mapped files in
+        temp_dir, and the full resolution tiles are aligned on multiples
+        of tile_size.  With a tolerance, each tile stops iterating on its
+        own.
+        """
+        shapes = self.pyramid_shapes(shape)
+        max_level = len(shapes) - 1
+        # get the range of valid height values (skipping no-data values)
+        minv, maxv = numpy.inf, -numpy.inf
+        for r0, r1, c0, c1 in self.tiles(shape, tile_size):
+            dsm = read_dsm(r0, c0, r1 - r0, c1 - c0, 1)
+            valid_data = dsm[dsm != self.nodata_val]
+            if valid_data.size:
+                minv = min(minv, valid_data.min())
+                maxv = max(maxv, valid_data.max())
+        if minv > maxv:
+            raise ValueError("The DSM has no valid pixels")
+        dtype = self.dtype if self.dtype is not None else dsm.dtype
+        minv, maxv = numpy.asarray([minv, maxv], dtype)
+        step = (maxv - minv) / self.num_outer_iter
+        self.level_stats = []
+
+        # fit the coarse levels in memory
+        level = next((i for i, s in enumerate(shapes) if s[0] * s[1] <= tile_size ** 2),
+                     max_level)
+        dsm = read_dsm(0, 0, shapes[level][0], shapes[level][1], 2 ** level)
+        dsm = dsm.astype(dtype, copy=False)
+        dtm = self.fit_levels(dsm, dsm != self.nodata_val, step, minv, level)
+        del dsm
+        if level == 0:
+            for r0, r1, c0, c1 in self.tiles(shape, tile_size):
+                write_dtm(r0, c0, dtm[r0:r1, c0:c1])
+            return
+
+        # refine the finer levels by tiles
+        with tempfile.TemporaryDirectory(dir=temp_dir) as temp_dir:
+            for level in range(level - 1, -1, -1):
+                if level > 0:
+                    fine_dtm = numpy.memmap(os.path.join(temp_dir, 'level{}.dat'.format(level)),
+                                            dtype, 'w+', shape=shapes[level])
+
+                    def write_level(row, col, tile):
+                        fine_dtm[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+                else:
+                    fine_dtm = None
+                    write_level = write_dtm
+                self.refine_level_tiled(read_dsm, write_level, dtm, shapes[level], level,
+                                        self.level_schedule(step, level, max_level),
+                                        tile_size, dtype)
+                del dtm
+                dtm = fine_dtm
+            del dtm
+
+    @staticmethod
+    def tiles(shape, tile_size):
+        """(first row, last row, first column, last column) of the tiles of an image
+        """
+        for r0 in range(0, shape[0], tile_size):
+            for c0 in range(0, shape[1], tile_size):
+                yield (r0, min(r0 + tile_size, shape[0]),
+                       c0, min(c0 + tile_size, shape[1]))
+
+    def refine_level_tiled(self, read_dsm, write_level, coarse_dtm, shape, level,
+                           schedule, tile_size, dtype):
+        """
+        Upsample the DTM of the next coarser pyramid level and drape the
+        cloth on the DSM of this level, by tiles with a halo
+        """
+        step, num_iter = schedule
+        halo = num_iter * self.num_inner_iter
+        stats = {'level': level, 'shape': shape, 'iterations': 0,
+                 'max_iterations': num_iter, 'max_update': 0.0,
+                 'mean_update': 0.0, 'converged': True}
+        num_pixels = 0
+        for r0, r1, c0, c1 in self.tiles(shape, tile_size):
+            # start the windows on even pixels of the level to upsample
+            # the coarser level in place
+            w0, w1 = max(r0 - halo, 0) // 2 * 2, min(r1 + halo, shape[0])
+            v0, v1 = max(c0 - halo, 0) // 2 * 2, min(c1 + halo, shape[1])
+            dsm = read_dsm(w0, v0, w1 - w0, v1 - v0, 2 ** level).astype(dtype, copy=False)
+            dtm = numpy.empty(dsm.shape, dtype)
+            self.upsample(coarse_dtm[w0 // 2:(w1 + 1) // 2, v0 // 2:(v1 + 1) // 2], dtm)
+            tile_stats = {}
+            dtm = self.drape_cloth(dtm, dsm, step, num_iter, level, stats=tile_stats)
+            write_level(r0, c0, dtm[r0 - w0:r1 - w0, c0 - v0:c1 - v0])
+            logging.debug("dtm level={} tile rows={}:{} cols={}:{} iterations={}".format(
+                level, r0, r1, c0, c1, tile_stats['iterations']))
+            # combine the stats of the tiles, weighting the mean by tile size
+            stats['iterations'] = max(stats['iterations'], tile_stats['iterations'])
+            stats['max_update'] = max(stats['max_update'], tile_stats['max_update'])
+            stats['mean_update'] += tile_stats['mean_update'] * dsm.size
+            stats['converged'] &= tile_stats['converged']
+            num_pixels += dsm.size
+        stats['mean_update'] /= num_pixels
+        self.log_level_stats(stats)
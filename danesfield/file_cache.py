@@ -0,0 +1,92 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""JSON caches of values computed from files
+
+Entries are keyed by the absolute path of the file and are valid while the
+size and modification time of the file are unchanged.
+"""
+
+import concurrent.futures
+import json
+import os
+
+
+def file_key(fpath):
+    """Absolute path, size and modification time of a file
+    """
+    st = os.stat(fpath)
+    return os.path.abspath(fpath), st.st_size, st.st_mtime
+
+
+def read_file_cache(cache_fpath, version):
+    """
+    Read the entries of a cache, returns no entries if the cache doesn't
+    exist, is invalid or has another version.
+    """
+    try:
+        with open(cache_fpath) as f:
+            cache = json.load(f)
+        if cache.get('version') == version:
+            return cache['files']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def write_file_cache(cache_fpath, version, files):
+    # write to a temporary file and rename, so that concurrent runs never
+    # read a partial cache
+    temp_fpath = '{}.{}.tmp'.format(cache_fpath, os.getpid())
+    with open(temp_fpath, 'w') as f:
+        json.dump({'version': version, 'files': files}, f, indent=2)
+    os.replace(temp_fpath, cache_fpath)
+
+
+def cached_value(files, key, name='value'):
+    """
+    Value of an entry of a cache if it is up to date with the file key,
+    otherwise None
+    """
+    path, size, mtime = key
+    entry = files.get(path)
+    if entry and entry['size'] == size and entry['mtime'] == mtime:
+        return entry[name]
+    return None
+
+
+def set_cached_value(files, key, value, name='value'):
+    path, size, mtime = key
+    files[path] = {'size': size, 'mtime': mtime, name: value}
+
+
+def map_files_cached(function, fpaths, cache_fpath=None, version=1, jobs=None):
+    """
+    Compute function(fpath) for each file, using the cache file if given.
+
+    The values missing from the cache are computed by a pool of jobs
+    processes, or in this process with one job, and the cache is updated.
+    Values must be JSON serializable and not None.  Returns the list of
+    values and the number of values taken from the cache.
+    """
+    files = read_file_cache(cache_fpath, version) if cache_fpath else {}
+    keys = [file_key(fpath) for fpath in fpaths]
+    values = [cached_value(files, key) for key in keys]
+    missing = [i for i, value in enumerate(values) if value is None]
+    if missing:
+        missing_fpaths = [fpaths[i] for i in missing]
+        if jobs == 1 or len(missing) == 1:
+            results = list(map(function, missing_fpaths))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+                results = list(executor.map(function, missing_fpaths))
+        for i, value in zip(missing, results):
+            values[i] = value
+        if cache_fpath:
+            for i in missing:
+                set_cached_value(files, keys[i], values[i])
+            write_file_cache(cache_fpath, version, files)
+    return values, len(fpaths) - len(missing)
@@ -0,0 +1,176 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""Gridding of point clouds into rasters such as a DSM
+
+Points are streamed in chunks and binned into the cells of a regular grid,
+accumulating the statistics of each cell with unbuffered numpy reductions,
+so that several statistics are computed in a single pass over the points.
+"""
+
+import numpy
+import scipy.ndimage
+
+STATISTICS = ('max', 'min', 'count', 'mean')
+NODATA_VALUE = -9999
+
+
+class PointGrid(object):
+    """Per cell statistics of the points binned into a regular grid
+    """
+
+    def __init__(self, bounds, gsd, statistics=('max',)):
+        """Constructor
+
+        bounds are the (minX, maxX, minY, maxY) coordinates of the grid
+        and gsd the size of its cells.  As for PDAL's writers.gdal, the
+        grid starts at (minX, minY) and has a column for each gsd in
+        [minX, maxX], i.e. one more than fits in the bounds.
+        """
+        unknown = set(statistics) - set(STATISTICS)
+        if unknown:
+            raise ValueError("Unknown statistics {}, expected some of {}".format(
+                sorted(unknown), STATISTICS))
+        minX, maxX, minY, maxY = bounds
+        self.gsd = gsd
+        self.statistics = tuple(statistics)
+        self.shape = (int((maxY - minY) / gsd) + 1, int((maxX - minX) / gsd) + 1)
+        self.origin = (minX, minY + self.shape[0] * gsd)
+        self.min_y = minY
+        size = self.shape[0] * self.shape[1]
+        self.max = self.min = self.sum = None
+        if 'max' in statistics:
+            self.max = numpy.full(size, -numpy.inf, numpy.float32)
+        if 'min' in statistics:
+            self.min = numpy.full(size, numpy.inf, numpy.float32)
+        if 'mean' in statistics:
+            self.sum = numpy.zeros(size, numpy.float64)
+        self.count = numpy.zeros(size, numpy.int64)
+        self.num_points = 0
+        # void filling cells of the last window size, shared by the statistics
+        self._voids = None
+
+    @property
+    def geotransform(self):
+        """GDAL geotransform of the grid, north up
+        """
+        return (self.origin[0], self.gsd, 0.0, self.origin[1], 0.0, -self.gsd)
+
+    def cell_indices(self, x, y):
+        """
+        Flat indices of the cells of points, and the mask of the points in
+        the grid
+        """
+        # cells are indexed from (minX, minY) as in PDAL, and rows are flipped
+        # for the north up raster
+        col = numpy.floor((x - self.origin[0]) / self.gsd)
+        row = self.shape[0] - 1 - numpy.floor((y - self.min_y) / self.gsd)
+        inside = (col >= 0) & (col < self.shape[1]) & (row >= 0) & (row < self.shape[0])
+        return (row[inside].astype(numpy.int64) * self.shape[1] +
+                col[inside].astype(numpy.int64)), inside
+
+    def add_points(self, x, y, z):
+        """Bin a chunk of points into the grid, ignoring those outside it
+        """
+        idx, inside = self.cell_indices(numpy.asarray(x), numpy.asarray(y))
+        if not len(idx):
+            return
+        z = numpy.asarray(z)[inside]
+        self.num_points += len(idx)
+        # ufunc.at is only fast without casting
+        z32 = z.astype(numpy.float32, copy=False)
+        if self.max is not None:
+            numpy.maximum.at(self.max, idx, z32)
+        if self.min is not None:
+            numpy.minimum.at(self.min, idx, z32)
+        # chunks usually cover a small part of the grid, count over the
+        # range of their cells only
+        first = idx.min()
+        idx = idx - first
+        if self.sum is not None:
+            sums = numpy.bincount(idx, z)
+            self.sum[first:first + len(sums)] += sums
+        counts = numpy.bincount(idx)
+        self.count[first:first + len(counts)] += counts
+        self._voids = None
+
+    def raster(self, statistic, window_size=0, nodata=NODATA_VALUE):
+        """
+        Raster of a statistic of the points in each cell.  Empty cells of
+        height statistics are filled with the value of the nearest
+        non-empty cell within window_size cells, and set to nodata beyond.
+        """
+        if statistic == 'count':
+            return self.count.reshape(self.shape).copy()
+        if statistic == 'mean':
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                values = (self.sum / self.count).astype(numpy.float32)
+        else:
+            values = getattr(self, statistic).copy()
+        values = values.reshape(self.shape)
+        if self._voids is None or self._voids[0] != window_size:
+            empty = (self.count == 0).reshape(self.shape)
+            self._voids = (window_size, void_fill_cells(empty, window_size))
+        fill_voids(values, self._voids[1], nodata)
+        return values
+
+
+def void_fill_cells(empty, window_size):
+    """
+    Find the nearest non-empty cell of each empty cell of a raster.
+    Returns the flat indices of the empty cells with a non-empty cell at
+    most window_size cells away, the flat indices of those non-empty
+    cells, and the flat indices of the other empty cells.
+    """
+    empty_idx = numpy.flatnonzero(empty)
+    if not len(empty_idx) or window_size <= 0 or len(empty_idx) == empty.size:
+        return empty_idx[:0], empty_idx[:0], empty_idx
+    distance, (rows, cols) = scipy.ndimage.distance_transform_edt(
+        empty, return_indices=True)
+    distance = distance.ravel()[empty_idx]
+    source = (rows.ravel()[empty_idx].astype(numpy.int64) * empty.shape[1] +
+              cols.ravel()[empty_idx])
+    fill = distance <= window_size
+    return empty_idx[fill], source[fill], empty_idx[~fill]
+
+
+def fill_voids(values, cells, nodata=NODATA_VALUE):
+    """
+    Fill the empty cells of a raster in place with the value of their
+    nearest non-empty cell, given the cells found by void_fill_cells, and
+    with nodata beyond the window size.
+    """
+    target, source, unfilled = cells
+    flat = values.reshape(-1)
+    flat[target] = flat[source]
+    flat[unfilled] = nodata
+    return values
+
+
+def max_into(raster, rows, cols, values):
+    """
+    Keep the largest of the values of the points at each (row, col) pixel
+    of raster, as a z-buffer, ignoring the points outside of it.  Returns
+    the mask of the points inside the raster.
+    """
+    inside = (rows >= 0) & (rows < raster.shape[0]) & (cols >= 0) & (cols < raster.shape[1])
+    idx = rows[inside] * raster.shape[1] + cols[inside]
+    # ufunc.at is only fast without casting
+    numpy.maximum.at(raster.reshape(-1), idx,
+                     numpy.asarray(values)[inside].astype(raster.dtype, copy=False))
+    return inside
+
+
+def grid_points(chunks, bounds, gsd, statistics=('max',), window_size=0,
+                nodata=NODATA_VALUE):
+    """
+    Grid chunks of (X, Y, Z) point coordinates.  Returns the PointGrid and
+    a dict of the raster of each statistic.
+    """
+    grid = PointGrid(bounds, gsd, statistics)
+    for x, y, z in chunks:
+        grid.add_points(x, y, z)
+    return grid, {s: grid.raster(s, window_size, nodata) for s in statistics}
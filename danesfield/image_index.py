@@ -0,0 +1,99 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""Index of the metadata of satellite images
+
+The metadata used to choose images, read from the NITF headers, is kept in
+a JSON index keyed by file path, size and modification time so that the
+headers are only read again for new or modified images.
+"""
+
+import logging
+
+import gdal
+import numpy
+import pyproj
+
+from danesfield import file_cache
+from danesfield import gdal_utils
+
+INDEX_VERSION = 2
+
+# Numeric NITF metadata stored in the index, the first two are required
+NITF_METADATA = {'angle': 'NITF_CSEXRA_OBLIQUITY_ANGLE',
+                 'cloud_cover': 'NITF_PIAIMC_CLOUDCVR',
+                 'view_azimuth': 'NITF_CSEXRA_AZ_OF_OBLIQUITY',
+                 'sun_azimuth': 'NITF_CSEXRA_SUN_AZIMUTH',
+                 'sun_elevation': 'NITF_CSEXRA_SUN_ELEVATION'}
+
+
+def read_image_metadata(fpath):
+    """
+    Read the metadata of an image: the obliquity angle, cloud cover, view
+    and sun angles, and Long/Lat bounding box [minX, minY, maxX, maxY].
+    Missing optional angles are None.
+    """
+    image = gdal_utils.gdal_open(fpath, gdal.GA_ReadOnly)
+    md = image.GetMetadata()
+    metadata = {}
+    for name, key in NITF_METADATA.items():
+        try:
+            metadata[name] = float(md[key])
+        except (KeyError, ValueError):
+            if name in ('angle', 'cloud_cover'):
+                raise
+            metadata[name] = None
+    outProj = pyproj.Proj('+proj=longlat +datum=WGS84')
+    metadata['bounds'] = [float(b) for b in gdal_utils.gdal_bounding_box(image, outProj)]
+    return metadata
+
+
+def image_metadata(fpaths, index_fpath=None, jobs=None):
+    """
+    Metadata of images, see read_image_metadata, taken from the index
+    file if given and up to date.  The headers of the other images are
+    read by a pool of jobs processes and added to the index.
+    """
+    metadata, num_cached = file_cache.map_files_cached(
+        read_image_metadata, fpaths, index_fpath, INDEX_VERSION, jobs)
+    logging.info("Metadata of {} images, {} from the index".format(len(fpaths), num_cached))
+    return metadata
+
+
+def intersection(a, b):
+    x1 = max(a[0], b[0])
+    y1 = max(a[1], b[1])
+    x2 = min(a[2], b[2])
+    y2 = min(a[3], b[3])
+    if x1 < x2 and y1 < y2:
+        return [x1, y1, x2, y2]
+    # else return None
+
+
+def uncovered_areas(dsm_bounds, bounds):
+    """
+    Area of the [minX, minY, maxX, maxY] bounds of a DSM not covered by
+    the bounds of each image
+    """
+    dsm_area = (dsm_bounds[2] - dsm_bounds[0]) * (dsm_bounds[3] - dsm_bounds[1])
+    areas = numpy.zeros(len(bounds))
+    for i, image_bounds in enumerate(bounds):
+        overlap = intersection(dsm_bounds, image_bounds)
+        areas[i] = dsm_area - ((overlap[2] - overlap[0]) * (overlap[3] - overlap[1])
+                               if overlap else 0)
+    return areas
+
+
+def rank_images(dsm_bounds, metadata):
+    """
+    Order images by most area overlap with the DSM, least cloud cover
+    and most nadir angle.  Returns the sort index and the uncovered area
+    of each image.
+    """
+    areas = uncovered_areas(dsm_bounds, [m['bounds'] for m in metadata])
+    angles = numpy.array([m['angle'] for m in metadata])
+    cloud_cover = numpy.array([m['cloud_cover'] for m in metadata])
+    return numpy.lexsort((angles, cloud_cover, areas)), areas
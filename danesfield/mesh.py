@@ -0,0 +1,244 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""Build triangle meshes from height grids and write them as OBJ or PLY
+"""
+
+import numpy
+from scipy.spatial import ConvexHull, Delaunay
+
+# Format of the vertex coordinates in OBJ files, enough digits to read
+# back the same doubles, or the same floats for single precision vertices
+OBJ_FLOAT_FORMAT = '%.17g'
+OBJ_FLOAT32_FORMAT = '%.9g'
+
+# Number of rows formatted at a time when writing OBJ files
+OBJ_CHUNK_ROWS = 65536
+
+
+def grid_faces(rows, cols, valid=None):
+    """
+    Triangles of a grid of rows x cols vertices numbered in row-major
+    order, two per cell.  If a mask of valid vertices is given, the
+    triangles with an invalid vertex are dropped.
+    """
+    index = numpy.arange(rows * cols).reshape(rows, cols)
+    id0 = index[:-1, :-1].ravel()
+    id1 = id0 + 1
+    id2 = id0 + cols
+    id3 = id2 + 1
+    # triangles (id0, id2, id1) and (id2, id3, id1) of each cell
+    faces = numpy.empty((2 * len(id0), 3), dtype=numpy.int64)
+    faces[0::2] = numpy.stack([id0, id2, id1], axis=1)
+    faces[1::2] = numpy.stack([id2, id3, id1], axis=1)
+    if valid is not None:
+        faces = faces[numpy.all(valid.ravel()[faces], axis=1)]
+    return faces
+
+
+def remove_unused_vertices(vertices, faces):
+    """Drop the vertices not used by any face and renumber the faces
+    """
+    used = numpy.zeros(len(vertices), dtype=bool)
+    used[faces.ravel()] = True
+    new_index = numpy.cumsum(used) - 1
+    return vertices[used], new_index[faces]
+
+
+def valid_hull_vertices(valid):
+    """
+    Row-major indices of the samples at the vertices of the convex hull
+    of the valid samples of a grid, None if they don't span an area
+    """
+    rows = numpy.flatnonzero(valid.any(axis=1))
+    if not len(rows):
+        return None
+    # only the first and last valid samples of each row can be on the hull
+    first = numpy.argmax(valid[rows], axis=1)
+    last = valid.shape[1] - 1 - numpy.argmax(valid[rows, ::-1], axis=1)
+    index = numpy.unique(numpy.concatenate([rows * valid.shape[1] + first,
+                                            rows * valid.shape[1] + last]))
+    row_index, col_index = numpy.divmod(index, valid.shape[1])
+    points = numpy.stack([col_index, row_index], axis=1)
+    if numpy.linalg.matrix_rank(points - points[0]) < 2:
+        return None
+    return index[ConvexHull(points).vertices]
+
+
+def edge_neighbors(tri, vertices, int_points, simplex):
+    """
+    Triangle across the edge that each of int_points lies on, in the
+    Delaunay triangulation tri of the integer points vertices, given the
+    triangle of each point, or -1 if the point is strictly inside its
+    triangle, outside of the triangulation or on its hull
+    """
+    neighbor = numpy.full(len(simplex), -1, dtype=numpy.int64)
+    inside = numpy.flatnonzero(simplex >= 0)
+    corners = vertices[tri.simplices[simplex[inside]]]
+    p = int_points[inside]
+    for k in range(3):
+        a, b = corners[:, (k + 1) % 3], corners[:, (k + 2) % 3]
+        # exact orientation test, the point is on the edge opposite to vertex k
+        on_edge = ((b[:, 0] - a[:, 0]) * (p[:, 1] - a[:, 1]) ==
+                   (b[:, 1] - a[:, 1]) * (p[:, 0] - a[:, 0]))
+        neighbor[inside[on_edge]] = tri.neighbors[simplex[inside[on_edge]], k]
+    return neighbor
+
+
+def adaptive_grid_mesh(z, max_error, valid=None):
+    """
+    Triangulate a subset of the samples of a height grid such that the
+    linear interpolation of the mesh is within max_error of every valid
+    sample.
+
+    Samples are inserted greedily: starting from the vertices of the
+    convex hull of the valid samples and the valid samples next to an
+    invalid one, the sample with the largest error in each triangle above
+    max_error is added to a Delaunay triangulation, until no error
+    exceeds max_error.  Only valid samples are inserted.  A triangle
+    covering an invalid sample, or part of a triangle of grid_faces with
+    an invalid vertex, is refined until it covers no other valid sample,
+    then dropped, so that the mesh covers the same area as grid_faces.
+    Returns the row-major indices of the samples used as vertices and the
+    faces, with the same orientation as grid_faces.
+    """
+    rows, cols = z.shape
+    if valid is None:
+        valid = numpy.ones(z.shape, dtype=bool)
+    else:
+        valid = numpy.asarray(valid, dtype=bool)
+    selected = None
+    if rows >= 2 and cols >= 2:
+        selected = valid_hull_vertices(valid)
+    if selected is None:
+        vertex_index = numpy.arange(rows * cols)
+        return vertex_index, grid_faces(rows, cols, valid)
+    # the valid samples sharing a triangle of grid_faces with an invalid
+    # sample are inserted first, to follow the boundary of the valid cells
+    padded = numpy.pad(~valid, 1, mode='constant')
+    next_to_invalid = numpy.zeros(z.shape, dtype=bool)
+    for dr, dc in ((0, -1), (0, 1), (-1, 0), (1, 0), (1, -1), (-1, 1)):
+        next_to_invalid |= padded[1 + dr:rows + 1 + dr, 1 + dc:cols + 1 + dc]
+    selected = numpy.union1d(selected, numpy.flatnonzero(next_to_invalid & valid))
+    flat_z = z.ravel().astype(numpy.float64)
+    flat_valid = valid.ravel()
+    row_index, col_index = numpy.divmod(numpy.arange(rows * cols), cols)
+    int_points = numpy.stack([col_index, row_index], axis=1)
+    points = int_points.astype(numpy.float64)
+    # points inside the triangles of grid_faces with an invalid vertex,
+    # (2 v + a + b) / 4 for each of their vertices v, in quarters of a
+    # sample so that they are compared exactly to the edges of the mesh
+    invalid_faces = grid_faces(rows, cols)
+    invalid_faces = int_points[invalid_faces[~numpy.all(flat_valid[invalid_faces], axis=1)]]
+    probes = (invalid_faces.sum(axis=1)[:, None] + invalid_faces).reshape(-1, 2)
+    probe_points = probes / 4.0
+    is_selected = numpy.zeros(rows * cols, dtype=bool)
+    while True:
+        is_selected[selected] = True
+        tri = Delaunay(points[selected])
+        simplex = tri.find_simplex(points)
+        inside = simplex >= 0
+        # barycentric coordinates of each sample in its triangle
+        transform = tri.transform[simplex[inside]]
+        b = numpy.einsum('nij,nj->ni', transform[:, :2], points[inside] - transform[:, 2])
+        vertex_z = flat_z[selected][tri.simplices[simplex[inside]]]
+        interpolated = (vertex_z[:, 0] * b[:, 0] + vertex_z[:, 1] * b[:, 1] +
+                        vertex_z[:, 2] * (1 - b[:, 0] - b[:, 1]))
+        error = numpy.zeros(rows * cols)
+        error[inside] = numpy.abs(interpolated - flat_z[inside])
+        # triangles covering an invalid sample or a triangle of grid_faces
+        # with an invalid vertex, inside or on an edge
+        neighbor = edge_neighbors(tri, int_points[selected], int_points, simplex)
+        invalid = ~flat_valid & inside
+        probe_simplex = tri.find_simplex(probe_points)
+        probe_neighbor = edge_neighbors(tri, 4 * int_points[selected], probes, probe_simplex)
+        covers_invalid = numpy.zeros(len(tri.simplices), dtype=bool)
+        for triangles in (simplex[invalid], neighbor[invalid], probe_simplex, probe_neighbor):
+            covers_invalid[triangles[triangles >= 0]] = True
+        # the valid samples they cover are inserted first, and valid
+        # samples outside of the triangulation, on its hull, as well
+        pending = ~inside | covers_invalid[simplex]
+        pending |= (neighbor >= 0) & covers_invalid[neighbor]
+        error[pending] = numpy.inf
+        error[~flat_valid | is_selected] = 0
+        candidates = numpy.flatnonzero(error > max_error)
+        if not len(candidates):
+            break
+        # the sample with the largest error in each triangle
+        order = numpy.lexsort((-error[candidates], simplex[candidates]))
+        candidates = candidates[order]
+        first = numpy.ones(len(candidates), dtype=bool)
+        first[1:] = simplex[candidates[1:]] != simplex[candidates[:-1]]
+        selected = numpy.concatenate([selected, candidates[first]])
+
+    faces = tri.simplices[~covers_invalid]
+    vertex_points = points[selected]
+    # orient the triangles like grid_faces, clockwise in (col, row)
+    e1 = vertex_points[faces[:, 1]] - vertex_points[faces[:, 0]]
+    e2 = vertex_points[faces[:, 2]] - vertex_points[faces[:, 0]]
+    counterclockwise = e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0] > 0
+    faces[counterclockwise] = faces[counterclockwise][:, [0, 2, 1]]
+    return selected, faces
+
+
+def write_rows(f, row_format, array, chunk_rows=OBJ_CHUNK_ROWS):
+    """
+    Write the rows of a 2D array to a text stream with a printf style
+    format for one row, ending with a newline
+    """
+    for start in range(0, len(array), chunk_rows):
+        chunk = array[start:start + chunk_rows]
+        # formatting a chunk at once is several times faster than
+        # numpy.savetxt, which formats the rows one by one
+        f.write((row_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def write_obj(fpath, vertices, faces, header=()):
+    """Write a mesh as an OBJ file, with optional header lines
+    """
+    vertices = numpy.asarray(vertices)
+    float_format = OBJ_FLOAT32_FORMAT if vertices.dtype == numpy.float32 else OBJ_FLOAT_FORMAT
+    with open(fpath, 'w', buffering=1 << 20) as f:
+        f.writelines(header)
+        write_rows(f, 'v {0} {0} {0}\n'.format(float_format), vertices)
+        write_rows(f, 'f %d %d %d\n', numpy.asarray(faces) + 1)
+
+
+def write_ply(fpath, vertices, faces, header=()):
+    """
+    Write a mesh as a binary PLY file with float coordinates for single
+    precision vertices, double otherwise.  Header lines are written as
+    comments.
+    """
+    vertices = numpy.asarray(vertices)
+    if vertices.dtype == numpy.float32:
+        vertex_type, vertex_dtype = 'float', '<f4'
+    else:
+        vertex_type, vertex_dtype = 'double', '<f8'
+    faces = numpy.asarray(faces)
+    face_records = numpy.empty(len(faces), dtype=[('count', 'u1'), ('index', '<i4', 3)])
+    face_records['count'] = 3
+    face_records['index'] = faces
+    lines = ['ply', 'format binary_little_endian 1.0']
+    lines += ['comment ' + line.lstrip('#').strip() for line in header]
+    lines += ['element vertex {}'.format(len(vertices)),
+              'property {} x'.format(vertex_type), 'property {} y'.format(vertex_type),
+              'property {} z'.format(vertex_type),
+              'element face {}'.format(len(faces)),
+              'property list uchar int vertex_indices', 'end_header']
+    with open(fpath, 'wb') as f:
+        f.write(('\n'.join(lines) + '\n').encode('ascii'))
+        f.write(numpy.ascontiguousarray(vertices, dtype=vertex_dtype).tobytes())
+        f.write(face_records.tobytes())
+
+
+def write_mesh(fpath, vertices, faces, header=()):
+    """Write a mesh as a binary PLY file if fpath ends with .ply, as OBJ otherwise
+    """
+    if fpath.lower().endswith('.ply'):
+        write_ply(fpath, vertices, faces, header)
+    else:
+        write_obj(fpath, vertices, faces, header)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+
+"""Occlusion tests for points projected into an image
+
+Each engine takes the integer image coordinates of projected points as a
+(2, n) array of (column, row), the heights of the points, the (rows, cols)
+shape of the image region and a height tolerance.  It returns a boolean
+mask of the points that are visible, i.e. that are within the tolerance of
+the highest point projecting to the same image pixel.
+"""
+
+import numpy
+
+
+def visible_mask_sort(img_points, heights, shape, tolerance=1.0):
+    """Occlusion test by rendering a height map with sorted points
+
+    The points must already be sorted by increasing height so that the
+    highest point projecting to a pixel is written last.  The height map is
+    stored in single precision.
+    """
+    height_map = numpy.full(shape, -numpy.inf, dtype=numpy.float32)
+    height_map[img_points[1], img_points[0]] = heights
+    return height_map[img_points[1], img_points[0]] <= heights + tolerance
+
+
+def visible_mask_zbuffer(img_points, heights, shape, tolerance=1.0):
+    """Occlusion test by z-buffering, without sorting
+
+    The highest point of each pixel is found with an unbuffered maximum
+    reduction over the flattened pixel indices, so the points can be in any
+    order and ties are resolved deterministically.  The height map is
+    stored in double precision, which also holds -inf for integer heights.
+    """
+    flat_idx = numpy.ravel_multi_index((img_points[1], img_points[0]), shape)
+    height_map = numpy.full(shape[0] * shape[1], -numpy.inf, dtype=numpy.float64)
+    numpy.maximum.at(height_map, flat_idx, heights)
+    return height_map[flat_idx] <= heights + tolerance
+
+
+# The available occlusion engines, by name
+ENGINES = {
+    'sort': visible_mask_sort,
+    'zbuffer': visible_mask_zbuffer,
+}
+
+# Engines that require the points to be sorted by increasing height
+SORTED_ENGINES = {'sort'}
+
+
+def get_engine(name):
+    """Look up an occlusion engine by name"""
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise ValueError("Unknown occlusion engine {!r}, expected one of {}".format(
+            name, sorted(ENGINES)))
@@ -4,10 +4,12 @@
 # See accompanying Copyright.txt and LICENSE files for details
 ###############################################################################
 
-from danesfield import rpc
+from danesfield import occlusion
 from danesfield import raytheon_rpc
+from danesfield import rpc_cache
 
 import gdal
+import multiprocessing
 import numpy
 import osr
 import pyproj
@@ -23,6 +25,130 @@ def circ_structure(n):
     return (x**2 + y**2) <= n**2
 
 
+def read_filtered_dsm(dsm, dtm=None, denoise_radius=0, window=None):
+    """Read the DSM, fill its nodata values from the DTM, and denoise it
+
+    window is an optional (xoff, yoff, xsize, ysize) tuple selecting the
+    part of the DSM to read.  The DSM and DTM must be aligned.
+    """
+    if window is None:
+        window = (0, 0, dsm.RasterXSize, dsm.RasterYSize)
+    xoff, yoff, xsize, ysize = window
+    band = dsm.GetRasterBand(1)
+    dsmRaster = band.ReadAsArray(
+        xoff=xoff, yoff=yoff, win_xsize=xsize, win_ysize=ysize)
+    dsm_nodata_value = band.GetNoDataValue()
+
+    if dtm:
+        band = dtm.GetRasterBand(1)
+        dtmRaster = band.ReadAsArray(
+            xoff=xoff, yoff=yoff, win_xsize=xsize, win_ysize=ysize)
+        newRaster = numpy.where(dsmRaster != dsm_nodata_value, dsmRaster, dtmRaster)
+        dsmRaster = newRaster
+
+    # apply morphology to denoise the DSM
+    if (denoise_radius > 0):
+        morph_struct = circ_structure(denoise_radius)
+        dsmRaster = morphology.grey_opening(dsmRaster, structure=morph_struct)
+        dsmRaster = morphology.grey_closing(dsmRaster, structure=morph_struct)
+    return dsmRaster
+
+
+def denoise_halo(denoise_radius):
+    """Number of pixels outside of a block that affect the denoised DSM
+    values inside of the block
+
+    An opening followed by a closing applies four erosions or dilations,
+    each of which reaches the radius of the structuring element.
+    """
+    if denoise_radius > 0:
+        return 4 * int(numpy.floor(denoise_radius))
+    return 0
+
+
+def dsm_world_points(transform, dsmRaster, dsm_nodata_value, xoff=0, yoff=0):
+    """Compute the world coordinates of the valid pixels of a DSM raster
+
+    dsmRaster may be a block of a larger DSM starting at pixel (xoff, yoff),
+    in which case the returned pixel and line indices are relative to the
+    full DSM.  Returns the pixels, lines, and X, Y, Z world coordinates of
+    all pixels that are not nodata.
+    """
+    ysize, xsize = dsmRaster.shape
+    pixels = numpy.arange(xoff, xoff + xsize)
+    pixels = numpy.tile(pixels, ysize)
+    lines = numpy.arange(yoff, yoff + ysize)
+    lines = numpy.repeat(lines, xsize)
+    arrayX = transform[0] + pixels * transform[1] + lines * transform[2]
+    arrayY = transform[3] + pixels * transform[4] + lines * transform[5]
+    arrayZ = dsmRaster[lines - yoff, pixels - xoff]
+    validIdx = arrayZ != dsm_nodata_value
+    pixels = pixels[validIdx]
+    lines = lines[validIdx]
+    arrayX = arrayX[validIdx]
+    arrayY = arrayY[validIdx]
+    arrayZ = arrayZ[validIdx]
+    return pixels, lines, arrayX, arrayY, arrayZ
+
+
+def lonlat_projections(projection):
+    """Return the pyproj projections that map from the given WKT projection
+    to Long/Lat
+    """
+    srs = osr.SpatialReference(wkt=projection)
+    proj_srs = srs.ExportToProj4()
+    inProj = pyproj.Proj(proj_srs)
+    outProj = pyproj.Proj('+proj=longlat +datum=WGS84')
+    return inProj, outProj
+
+
+def create_destination_image(dsm, sourceImage, destination_image):
+    """Create the orthorectified image on the DSM grid
+
+    The image has the bands and data type of the source image and the
+    georeference of the DSM.  Returns None on error.
+    """
+    driver = dsm.GetDriver()
+    driverMetadata = driver.GetMetadata()
+    if driverMetadata.get(gdal.DCAP_CREATE) != "YES":
+        print("Driver {} does not supports Create().".format(driver))
+        return None
+
+    print("Create destination image of "
+          "size:({}, {}) ...".format(dsm.RasterXSize, dsm.RasterYSize))
+    # georeference information
+    projection = dsm.GetProjection()
+    transform = dsm.GetGeoTransform()
+    gcpProjection = dsm.GetGCPProjection()
+    gcps = dsm.GetGCPs()
+    options = ["COMPRESS=DEFLATE"]
+    # ensure that space will be reserved for geographic corner coordinates
+    # (in DMS) to be set later
+    if (driver.ShortName == "NITF" and not projection):
+        options.append("ICORDS=G")
+    # If I try to use AddBand with GTiff I get:
+    # Dataset does not support the AddBand() method.
+    # So I create all bands using the same type at the begining
+    destImage = driver.Create(
+        destination_image, xsize=dsm.RasterXSize,
+        ysize=dsm.RasterYSize,
+        bands=sourceImage.RasterCount,
+        eType=sourceImage.GetRasterBand(1).DataType,
+        options=options)
+
+    if (projection):
+        # georeference through affine geotransform
+        destImage.SetProjection(projection)
+        destImage.SetGeoTransform(transform)
+    else:
+        # georeference through GCPs
+        destImage.SetGCPs(gcps, gcpProjection)
+        # not implemented: compute arrayX, arrayY, arrayZ
+        print("Not implemented yet")
+        return None
+    return destImage
+
+
 COMPLETE_DSM_INTERSECTION = 0
 PARTIAL_DSM_INTERSECTION = 1
 EMPTY_DSM_INTERSECTION = 2
@@ -31,7 +157,9 @@ ERROR = 10
 
 def orthorectify(args_source_image, args_dsm, args_destination_image,
                  args_occlusion_thresh=1.0, args_denoise_radius=2,
-                 args_raytheon_rpc=None, args_dtm=None):
+                 args_raytheon_rpc=None, args_dtm=None,
+                 args_tile_size=None, args_max_memory_mb=None,
+                 args_occlusion_engine='sort'):
     """
     Orthorectify an image given the DSM
 
@@ -45,6 +173,14 @@ def orthorectify(args_source_image, args_dsm, args_destination_image,
                         to the DSM reduce speckled noise
         raytheon-rpc: Raytheon RPC file name. If not provided
                       the RPC is read from the source_image
+        dtm: Optional DTM file name used to fill nodata areas of the DSM
+        tile-size: Process the DSM in blocks of this many pixels on a side
+                   to bound memory use.  The result is the same as
+                   processing the whole DSM at once.
+        max-memory-mb: Choose the block size so that the working memory is
+                       approximately bounded by this many megabytes
+        occlusion-engine: Name of the occlusion test in occlusion.ENGINES,
+                          'sort' (default) or 'zbuffer'
 
     Returns:
         COMPLETE_DSM_INTERSECTION = 0
@@ -52,22 +188,12 @@ def orthorectify(args_source_image, args_dsm, args_destination_image,
         EMPTY_DSM_INTERSECTION = 2
         ERROR = 10
     """
-    returnValue = COMPLETE_DSM_INTERSECTION
     # open the source image
     sourceImage = gdal.Open(args_source_image, gdal.GA_ReadOnly)
     if not sourceImage:
         return ERROR
-    sourceBand = sourceImage.GetRasterBand(1)
 
-    if (args_raytheon_rpc):
-        # read the RPC from raytheon file
-        print("Reading RPC from Raytheon file: {}".format(args_raytheon_rpc))
-        model = raytheon_rpc.read_raytheon_rpc_file(args_raytheon_rpc)
-    else:
-        # read the RPC from RPC Metadata in the image file
-        print("Reading RPC Metadata from {}".format(args_source_image))
-        rpcMetaData = sourceImage.GetMetadata('RPC')
-        model = rpc.rpc_from_gdal_dict(rpcMetaData)
+    model = read_model(args_source_image, sourceImage, args_raytheon_rpc)
     if model is None:
         print("Error reading the RPC")
         return ERROR
@@ -76,96 +202,69 @@ def orthorectify(args_source_image, args_dsm, args_destination_image,
     dsm = gdal.Open(args_dsm, gdal.GA_ReadOnly)
     if not dsm:
         return ERROR
-    band = dsm.GetRasterBand(1)
-    dsmRaster = band.ReadAsArray(
-        xoff=0, yoff=0,
-        win_xsize=dsm.RasterXSize, win_ysize=dsm.RasterYSize)
-    dsm_nodata_value = band.GetNoDataValue()
-    print("DSM raster shape {}".format(dsmRaster.shape))
 
+    dtm = None
     if args_dtm:
         dtm = gdal.Open(args_dtm, gdal.GA_ReadOnly)
         if not dtm:
             return ERROR
-        band = dtm.GetRasterBand(1)
-        dtmRaster = band.ReadAsArray(
-            xoff=0, yoff=0,
-            win_xsize=dtm.RasterXSize, win_ysize=dtm.RasterYSize)
-        newRaster = numpy.where(dsmRaster != dsm_nodata_value, dsmRaster, dtmRaster)
-        dsmRaster = newRaster
 
-    # apply morphology to denoise the DSM
-    if (args_denoise_radius > 0):
-        morph_struct = circ_structure(args_denoise_radius)
-        dsmRaster = morphology.grey_opening(dsmRaster, structure=morph_struct)
-        dsmRaster = morphology.grey_closing(dsmRaster, structure=morph_struct)
+    if args_tile_size or args_max_memory_mb:
+        return orthorectify_blocks(sourceImage, model, dsm, dtm,
+                                   args_destination_image,
+                                   args_occlusion_thresh, args_denoise_radius,
+                                   args_tile_size, args_max_memory_mb,
+                                   args_occlusion_engine)
 
     # create the rectified image
-    driver = dsm.GetDriver()
-    driverMetadata = driver.GetMetadata()
-    destImage = None
-    arrayX = None
-    arrayY = None
-    arrayZ = None
-    if driverMetadata.get(gdal.DCAP_CREATE) == "YES":
-        print("Create destination image of "
-              "size:({}, {}) ...".format(dsm.RasterXSize, dsm.RasterYSize))
-        # georeference information
-        projection = dsm.GetProjection()
-        transform = dsm.GetGeoTransform()
-        gcpProjection = dsm.GetGCPProjection()
-        gcps = dsm.GetGCPs()
-        options = ["COMPRESS=DEFLATE"]
-        # ensure that space will be reserved for geographic corner coordinates
-        # (in DMS) to be set later
-        if (driver.ShortName == "NITF" and not projection):
-            options.append("ICORDS=G")
-        # If I try to use AddBand with GTiff I get:
-        # Dataset does not support the AddBand() method.
-        # So I create all bands using the same type at the begining
-        destImage = driver.Create(
-            args_destination_image, xsize=dsm.RasterXSize,
-            ysize=dsm.RasterYSize,
-            bands=sourceImage.RasterCount, eType=sourceBand.DataType,
-            options=options)
-
-        if (projection):
-            # georeference through affine geotransform
-            destImage.SetProjection(projection)
-            destImage.SetGeoTransform(transform)
-            pixels = numpy.arange(0, dsm.RasterXSize)
-            pixels = numpy.tile(pixels, dsm.RasterYSize)
-            lines = numpy.arange(0, dsm.RasterYSize)
-            lines = numpy.repeat(lines, dsm.RasterXSize)
-            arrayX = transform[0] + pixels * transform[1] + lines * transform[2]
-            arrayY = transform[3] + pixels * transform[4] + lines * transform[5]
-            arrayZ = dsmRaster[lines, pixels]
-            validIdx = arrayZ != dsm_nodata_value
-            pixels = pixels[validIdx]
-            lines = lines[validIdx]
-            arrayX = arrayX[validIdx]
-            arrayY = arrayY[validIdx]
-            arrayZ = arrayZ[validIdx]
-
-        else:
-            # georeference through GCPs
-            destImage.SetGCPs(gcps, gcpProjection)
-            # not implemented: compute arrayX, arrayY, arrayZ
-            print("Not implemented yet")
-            return ERROR
-    else:
-        print("Driver {} does not supports Create().".format(driver))
+    destImage = create_destination_image(dsm, sourceImage, args_destination_image)
+    if destImage is None:
         return ERROR
 
+    points = dsm_lonlat_points(dsm, dtm, args_denoise_radius, args_occlusion_thresh,
+                               args_occlusion_engine)
+    return orthorectify_points(sourceImage, model, dsm, destImage, points,
+                               args_occlusion_thresh, args_occlusion_engine)
+
+
+def read_model(source_image, sourceImage, raytheon_rpc_file=None):
+    """Read the RPC model from a Raytheon RPC file if provided, otherwise
+    from the RPC metadata of the opened source image
+    """
+    if (raytheon_rpc_file):
+        # read the RPC from raytheon file
+        print("Reading RPC from Raytheon file: {}".format(raytheon_rpc_file))
+        return raytheon_rpc.read_raytheon_rpc_file(raytheon_rpc_file)
+    # read the RPC from RPC Metadata in the image file
+    print("Reading RPC Metadata from {}".format(source_image))
+    return rpc_cache.load_rpc(source_image)
+
+
+def dsm_lonlat_points(dsm, dtm=None, denoise_radius=2, occlusion_thresh=1.0,
+                      occlusion_engine='sort'):
+    """Compute the Long/Lat/height points of the valid pixels of the DSM
+
+    The DSM is filled from the DTM and denoised first.  If occlusion_thresh
+    is positive and the occlusion engine needs it, the points are sorted by
+    height so that higher points project last.  These points do not depend
+    on the source image and can be shared when orthorectifying several
+    images.
+
+    Returns the pixels, lines, longitudes, latitudes and heights.
+    """
+    dsmRaster = read_filtered_dsm(dsm, dtm, denoise_radius)
+    print("DSM raster shape {}".format(dsmRaster.shape))
+    dsm_nodata_value = dsm.GetRasterBand(1).GetNoDataValue()
+    pixels, lines, arrayX, arrayY, arrayZ = dsm_world_points(
+        dsm.GetGeoTransform(), dsmRaster, dsm_nodata_value)
+    del dsmRaster
+
     # convert coordinates to Long/Lat
-    srs = osr.SpatialReference(wkt=projection)
-    proj_srs = srs.ExportToProj4()
-    inProj = pyproj.Proj(proj_srs)
-    outProj = pyproj.Proj('+proj=longlat +datum=WGS84')
+    inProj, outProj = lonlat_projections(dsm.GetProjection())
     arrayX, arrayY = pyproj.transform(inProj, outProj, arrayX, arrayY)
 
     # Sort the points by height so that higher points project last
-    if (args_occlusion_thresh > 0):
+    if (occlusion_thresh > 0 and occlusion_engine in occlusion.SORTED_ENGINES):
         print("Sorting by Height")
         heightIdx = numpy.argsort(arrayZ)
         arrayX = arrayX[heightIdx]
@@ -173,6 +272,20 @@ def orthorectify(args_source_image, args_dsm, args_destination_image,
         arrayZ = arrayZ[heightIdx]
         lines = lines[heightIdx]
         pixels = pixels[heightIdx]
+    return pixels, lines, arrayX, arrayY, arrayZ
+
+
+def orthorectify_points(sourceImage, model, dsm, destImage, points,
+                        occlusion_thresh=1.0, occlusion_engine='sort'):
+    """
+    Orthorectify an image onto the DSM grid given the DSM points
+
+    points are the DSM points returned by dsm_lonlat_points() and destImage
+    is the destination image created on the DSM grid.  Returns the same
+    status codes as orthorectify().
+    """
+    returnValue = COMPLETE_DSM_INTERSECTION
+    pixels, lines, arrayX, arrayY, arrayZ = points
 
     # project the points
     minZ = numpy.amin(arrayZ)
@@ -183,7 +296,7 @@ def orthorectify(args_source_image, args_dsm, args_destination_image,
 
     print("Projecting Points")
     imgPoints = model.project(numpy.array([arrayX, arrayY, arrayZ]).transpose())
-    intImgPoints = imgPoints.astype(numpy.int).transpose()
+    intImgPoints = imgPoints.astype(int).transpose()
 
     # coumpute the bound of the relevant AOI in the source image
     print("Source Image size: ", [sourceImage.RasterXSize, sourceImage.RasterYSize])
@@ -217,17 +330,13 @@ def orthorectify(args_source_image, args_dsm, args_destination_image,
         returnValue = PARTIAL_DSM_INTERSECTION
 
     # use a height map to test for occlusion
-    if (args_occlusion_thresh > 0):
+    if (occlusion_thresh > 0):
         print("Mapping occluded points")
         valid_arrayZ = arrayZ[validIdx]
-        # render a height map in the source image space
-        height_map = numpy.full(cropSize[::-1], -numpy.inf, dtype=numpy.float32)
-        height_map[intImgPoints[1], intImgPoints[0]] = valid_arrayZ
-
         # get a mask of points that locally are (approximately)
-        # the highest point in the map
-        is_max_height = height_map[intImgPoints[1], intImgPoints[0]] \
-            <= valid_arrayZ + args_occlusion_thresh
+        # the highest point in the source image space
+        is_max_height = occlusion.get_engine(occlusion_engine)(
+            intImgPoints, valid_arrayZ, tuple(cropSize[::-1]), occlusion_thresh)
         num_occluded = numpy.size(is_max_height) - numpy.count_nonzero(is_max_height)
         print("Skipped {} occluded points".format(num_occluded))
 
@@ -268,3 +377,377 @@ def orthorectify(args_source_image, args_dsm, args_destination_image,
         destBand.SetNoDataValue(nodata_value)
         destBand.WriteArray(destRaster)
     return returnValue
+
+
+# DSM points shared by the worker processes of orthorectify_many()
+_shared_points = None
+
+
+def _share_array(arr):
+    """Copy an array into shared memory
+
+    Returns the shared buffer with the dtype and shape needed to view it
+    as an array again.
+    """
+    raw = multiprocessing.RawArray('b', max(1, arr.nbytes))
+    numpy.frombuffer(raw, dtype=arr.dtype, count=arr.size)[:] = arr.ravel()
+    return raw, arr.dtype.str, arr.shape
+
+
+def _init_shared_points(shared):
+    """Pool initializer that views the shared DSM points as arrays"""
+    global _shared_points
+    _shared_points = tuple(
+        numpy.frombuffer(raw, dtype=dtype, count=int(numpy.prod(shape))).reshape(shape)
+        for raw, dtype, shape in shared)
+
+
+def _orthorectify_shared(task):
+    """Orthorectify one image using the shared DSM points"""
+    (source_image, dsm_path, destination_image, raytheon_rpc_file,
+     occlusion_thresh, occlusion_engine) = task
+    sourceImage = gdal.Open(source_image, gdal.GA_ReadOnly)
+    if not sourceImage:
+        return ERROR
+    model = read_model(source_image, sourceImage, raytheon_rpc_file)
+    if model is None:
+        print("Error reading the RPC")
+        return ERROR
+    dsm = gdal.Open(dsm_path, gdal.GA_ReadOnly)
+    if not dsm:
+        raise RuntimeError("Error: Failed to open DSM {}".format(dsm_path))
+    destImage = create_destination_image(dsm, sourceImage, destination_image)
+    if destImage is None:
+        return ERROR
+    return orthorectify_points(sourceImage, model, dsm, destImage,
+                               _shared_points, occlusion_thresh, occlusion_engine)
+
+
+def orthorectify_many(source_images, dsm_path, destination_images,
+                      occlusion_thresh=1.0, denoise_radius=2,
+                      raytheon_rpcs=None, dtm_path=None, jobs=None,
+                      occlusion_engine='sort'):
+    """
+    Orthorectify several images onto the same DSM
+
+    The DSM is read, filled from the DTM, denoised, and converted to
+    Long/Lat points only once.  The points are kept in shared memory and
+    each image is then projected, checked for occlusion and resampled in
+    a pool of worker processes.  Each output is the same as the output of
+    orthorectify() for that image.
+
+    Args:
+        source_images: List of source image file names
+        dsm_path: Digital surface model (DSM) image file name
+        destination_images: List of orthorectified image file names
+        occlusion_thresh: Threshold on height difference for detecting
+                          and masking occluded regions (in meters)
+        denoise_radius: Apply morphological operations with this radius
+                        to the DSM reduce speckled noise
+        raytheon_rpcs: Optional list of Raytheon RPC file names, one per
+                       source image.  An entry of None reads the RPC
+                       from the source image.
+        dtm_path: Optional DTM file name used to fill nodata areas of the DSM
+        jobs: Number of worker processes, defaults to the number of CPUs.
+              With 1 job the images are processed in this process.
+        occlusion_engine: Name of the occlusion test in occlusion.ENGINES
+
+    Returns:
+        A list with the orthorectify() status code of each image
+
+    Raises:
+        RuntimeError if the DSM or DTM cannot be opened
+    """
+    if raytheon_rpcs is None:
+        raytheon_rpcs = [None] * len(source_images)
+    if len(destination_images) != len(source_images) or \
+       len(raytheon_rpcs) != len(source_images):
+        raise ValueError("Expected one destination image and RPC per source image")
+
+    dsm = gdal.Open(dsm_path, gdal.GA_ReadOnly)
+    if not dsm:
+        raise RuntimeError("Error: Failed to open DSM {}".format(dsm_path))
+    dtm = None
+    if dtm_path:
+        dtm = gdal.Open(dtm_path, gdal.GA_ReadOnly)
+        if not dtm:
+            raise RuntimeError("Error: Failed to open DTM {}".format(dtm_path))
+
+    points = dsm_lonlat_points(dsm, dtm, denoise_radius, occlusion_thresh,
+                               occlusion_engine)
+    shared = [_share_array(a) for a in points]
+    del points
+
+    tasks = [(source_image, dsm_path, destination_image, raytheon_rpc_file,
+              occlusion_thresh, occlusion_engine)
+             for source_image, destination_image, raytheon_rpc_file
+             in zip(source_images, destination_images, raytheon_rpcs)]
+    if jobs == 1:
+        _init_shared_points(shared)
+        return [_orthorectify_shared(task) for task in tasks]
+    with multiprocessing.Pool(jobs, initializer=_init_shared_points,
+                              initargs=(shared,)) as pool:
+        return pool.map(_orthorectify_shared, tasks, chunksize=1)
+
+
+# Approximate peak working memory in bytes used for each DSM pixel of a
+# block (pixel indices, world coordinates, polynomial terms, image points)
+BYTES_PER_DSM_PIXEL = 480
+# Smallest block size considered when deriving the block size from memory
+MIN_BLOCK_SIZE = 64
+
+
+def block_size_for_memory(max_memory_mb, halo=0):
+    """Compute the largest square block size for which the working memory
+    of a block, including its halo, is about max_memory_mb megabytes
+    """
+    side = int(numpy.sqrt(max_memory_mb * 2**20 / BYTES_PER_DSM_PIXEL))
+    return max(MIN_BLOCK_SIZE, side - 2 * halo)
+
+
+def iter_blocks(xsize, ysize, block_size):
+    """Generate (xoff, yoff, xsize, ysize) windows that tile a raster
+    """
+    for yoff in range(0, ysize, block_size):
+        for xoff in range(0, xsize, block_size):
+            yield (xoff, yoff,
+                   min(block_size, xsize - xoff), min(block_size, ysize - yoff))
+
+
+def expand_window(window, halo, xsize, ysize):
+    """Grow a window by halo pixels on each side, clipped to the raster
+    """
+    xoff, yoff, wxsize, wysize = window
+    x0 = max(0, xoff - halo)
+    y0 = max(0, yoff - halo)
+    x1 = min(xsize, xoff + wxsize + halo)
+    y1 = min(ysize, yoff + wysize + halo)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def read_filtered_dsm_block(dsm, dtm, denoise_radius, window):
+    """Read a window of the filtered DSM
+
+    The window is read with a halo large enough that the denoised values
+    are identical to the same window of the denoised full DSM.
+    """
+    read_window = expand_window(window, denoise_halo(denoise_radius),
+                                dsm.RasterXSize, dsm.RasterYSize)
+    dsmRaster = read_filtered_dsm(dsm, dtm, denoise_radius, read_window)
+    x0 = window[0] - read_window[0]
+    y0 = window[1] - read_window[1]
+    return dsmRaster[y0:y0 + window[3], x0:x0 + window[2]]
+
+
+def occlusion_halo(model, transform, inProj, outProj, minZ, maxZ, xsize, ysize):
+    """Bound the distance, in DSM pixels, between DSM points that project to
+    the same image pixel
+
+    Points that can occlude each other are separated on the ground by at
+    most the parallax between the lowest and highest DSM heights plus the
+    ground footprint of one image pixel.  Both are measured at the corners
+    and center of the DSM using the RPC back projection.
+    """
+    pixels = numpy.array([0, xsize, xsize, 0, xsize / 2])
+    lines = numpy.array([0, 0, ysize, ysize, ysize / 2])
+    arrayX = transform[0] + pixels * transform[1] + lines * transform[2]
+    arrayY = transform[3] + pixels * transform[4] + lines * transform[5]
+    arrayX, arrayY = pyproj.transform(inProj, outProj, arrayX, arrayY)
+    imgPoints = model.project(
+        numpy.array([arrayX, arrayY, numpy.full(len(pixels), minZ)]).transpose())
+
+    A = numpy.array([[transform[1], transform[2]], [transform[4], transform[5]]])
+    ref = numpy.array([pixels, lines])
+
+    def dsm_shift(world):
+        """Distance in DSM pixels from the sampled points to world points"""
+        x, y = pyproj.transform(outProj, inProj, world[:, 0], world[:, 1])
+        pl = numpy.linalg.solve(A, numpy.array([x - transform[0], y - transform[3]]))
+        return numpy.max(numpy.hypot(*(pl - ref)))
+
+    parallax = dsm_shift(model.back_project_batch(imgPoints, maxZ))
+    footprint = dsm_shift(model.back_project_batch(imgPoints + 1, minZ))
+    # add a margin for the variation of the RPC across the DSM
+    return int(numpy.ceil(1.1 * (parallax + footprint))) + 1
+
+
+def orthorectify_blocks(sourceImage, model, dsm, dtm, destination_image,
+                        occlusion_thresh=1.0, denoise_radius=2,
+                        tile_size=None, max_memory_mb=None,
+                        occlusion_engine='sort'):
+    """
+    Orthorectify an image given the DSM, processing one block at a time
+
+    This produces the same result as orthorectify() but only holds one
+    block of the DSM, with a halo, in memory at once.  A first pass over
+    the blocks computes the DSM height range and the region of the source
+    image covered by the DSM.  A second pass projects each block, expanded
+    by a halo that covers every DSM point that could occlude it, and writes
+    the block to the destination image.
+
+    Args:
+        sourceImage: Source image GDAL dataset
+        model: RPC model of the source image
+        dsm: Digital surface model (DSM) GDAL dataset
+        dtm: Optional DTM GDAL dataset used to fill DSM nodata areas
+        destination_image: Orthorectified image file name
+        occlusion_thresh: Threshold on height difference for detecting
+                          and masking occluded regions (in meters)
+        denoise_radius: Apply morphological operations with this radius
+                        to the DSM reduce speckled noise
+        tile_size: Block size in pixels
+        max_memory_mb: Approximate memory bound used to choose the block
+                       size if tile_size is not given
+        occlusion_engine: Name of the occlusion test in occlusion.ENGINES
+
+    Returns:
+        The same status codes as orthorectify()
+    """
+    returnValue = COMPLETE_DSM_INTERSECTION
+    engine = occlusion.get_engine(occlusion_engine)
+    destImage = create_destination_image(dsm, sourceImage, destination_image)
+    if destImage is None:
+        return ERROR
+    transform = dsm.GetGeoTransform()
+    inProj, outProj = lonlat_projections(dsm.GetProjection())
+    dsm_nodata_value = dsm.GetRasterBand(1).GetNoDataValue()
+    xsize = dsm.RasterXSize
+    ysize = dsm.RasterYSize
+    imageSize = numpy.array([sourceImage.RasterXSize, sourceImage.RasterYSize])
+
+    def project_block(window):
+        """Project the valid pixels of a DSM window into the source image"""
+        dsmRaster = read_filtered_dsm_block(dsm, dtm, denoise_radius, window)
+        pixels, lines, arrayX, arrayY, arrayZ = dsm_world_points(
+            transform, dsmRaster, dsm_nodata_value, window[0], window[1])
+        arrayX, arrayY = pyproj.transform(inProj, outProj, arrayX, arrayY)
+        return pixels, lines, arrayX, arrayY, arrayZ
+
+    # First pass: find the height range and the bounds of the projected DSM
+    block_size = tile_size or block_size_for_memory(max_memory_mb)
+    minZ = numpy.inf
+    maxZ = -numpy.inf
+    minImg = numpy.full(2, numpy.iinfo(int).max)
+    maxImg = numpy.full(2, numpy.iinfo(int).min)
+    for window in iter_blocks(xsize, ysize, block_size):
+        pixels, lines, arrayX, arrayY, arrayZ = project_block(window)
+        if len(arrayZ) == 0:
+            continue
+        minZ = min(minZ, numpy.amin(arrayZ))
+        maxZ = max(maxZ, numpy.amax(arrayZ))
+        intImgPoints = model.project(
+            numpy.array([arrayX, arrayY, arrayZ]).transpose()).astype(int).transpose()
+        minImg = numpy.minimum(minImg, numpy.min(intImgPoints, 1))
+        maxImg = numpy.maximum(maxImg, numpy.max(intImgPoints, 1))
+    print("Points min/max Z: {}/{}  ...".format(minZ, maxZ))
+
+    # compute the bound of the relevant AOI in the source image
+    print("Source Image size: ", imageSize)
+    minPoint = numpy.maximum([0, 0], minImg)
+    print("AOI min: ", minPoint)
+    maxPoint = numpy.minimum(maxImg, imageSize)
+    print("AOI max: ", maxPoint)
+    cropSize = maxPoint - minPoint
+    if numpy.any(cropSize < 1):
+        print("DSM does not intersect source image")
+        returnValue = EMPTY_DSM_INTERSECTION
+
+    # Second pass: orthorectify each block expanded by the occlusion halo
+    halo = 0
+    if occlusion_thresh > 0 and returnValue != EMPTY_DSM_INTERSECTION:
+        halo = occlusion_halo(model, transform, inProj, outProj,
+                              minZ, maxZ, xsize, ysize)
+        print("Occlusion halo: {} pixels".format(halo))
+        if not tile_size:
+            block_size = block_size_for_memory(max_memory_mb, halo)
+    print("Processing blocks of size {}".format(block_size))
+
+    sourceBands = []
+    for bandIndex in range(1, sourceImage.RasterCount + 1):
+        sourceBand = sourceImage.GetRasterBand(bandIndex)
+        nodata_value = sourceBand.GetNoDataValue()
+        # for now use zero as a no-data value if one is not specified
+        # it would probably be better to add a mask (alpha) band instead
+        if nodata_value is None:
+            nodata_value = 0
+        # read one value for data type
+        dtype = sourceBand.ReadAsArray(xoff=0, yoff=0, win_xsize=1, win_ysize=1).dtype
+        destImage.GetRasterBand(bandIndex).SetNoDataValue(nodata_value)
+        sourceBands.append((sourceBand, nodata_value, dtype))
+
+    numOut = 0
+    num_occluded = 0
+    for window in iter_blocks(xsize, ysize, block_size):
+        xoff, yoff, wxsize, wysize = window
+        destRasters = [numpy.full((wysize, wxsize), nodata_value, dtype=dtype)
+                       for _, nodata_value, dtype in sourceBands]
+
+        if returnValue != EMPTY_DSM_INTERSECTION:
+            ext = expand_window(window, halo, xsize, ysize)
+            pixels, lines, arrayX, arrayY, arrayZ = project_block(ext)
+            inBlock = numpy.logical_and.reduce((pixels >= xoff,
+                                                pixels < xoff + wxsize,
+                                                lines >= yoff,
+                                                lines < yoff + wysize))
+
+            # Sort the points by height so that higher points project last
+            if (occlusion_thresh > 0 and occlusion_engine in occlusion.SORTED_ENGINES):
+                heightIdx = numpy.argsort(arrayZ)
+                arrayX = arrayX[heightIdx]
+                arrayY = arrayY[heightIdx]
+                arrayZ = arrayZ[heightIdx]
+                lines = lines[heightIdx]
+                pixels = pixels[heightIdx]
+                inBlock = inBlock[heightIdx]
+
+            imgPoints = model.project(numpy.array([arrayX, arrayY, arrayZ]).transpose())
+            intImgPoints = imgPoints.astype(int).transpose()
+
+            # shift the projected image point to the cropped AOI space
+            intImgPoints[0] -= minPoint[0]
+            intImgPoints[1] -= minPoint[1]
+
+            # find indicies of points that fall inside the image bounds
+            validIdx = numpy.logical_and.reduce((intImgPoints[1] < cropSize[1],
+                                                 intImgPoints[1] >= 0,
+                                                 intImgPoints[0] < cropSize[0],
+                                                 intImgPoints[0] >= 0))
+            numOut += numpy.count_nonzero(inBlock & numpy.logical_not(validIdx))
+
+            # use a height map to test for occlusion
+            if (occlusion_thresh > 0 and numpy.any(validIdx)):
+                validPoints = intImgPoints[:, validIdx]
+                valid_arrayZ = arrayZ[validIdx]
+                # test for occlusion in the region of the source image
+                # covered by this block and its halo
+                lo = numpy.min(validPoints, 1)
+                mapSize = numpy.max(validPoints, 1) - lo + 1
+                is_max_height = engine(validPoints - lo[:, numpy.newaxis], valid_arrayZ,
+                                       tuple(mapSize[::-1]), occlusion_thresh)
+                occluded = numpy.nonzero(validIdx)[0][numpy.logical_not(is_max_height)]
+                num_occluded += numpy.count_nonzero(inBlock[occluded])
+                # disable occluded points in the valid pixel mask
+                validIdx[occluded] = False
+
+            # keep only the visible points of this block
+            keep = numpy.logical_and(validIdx, inBlock)
+            if numpy.any(keep):
+                keepPoints = intImgPoints[:, keep]
+                lo = numpy.min(keepPoints, 1)
+                readSize = numpy.max(keepPoints, 1) - lo + 1
+                for (sourceBand, _, _), destRaster in zip(sourceBands, destRasters):
+                    sourceRaster = sourceBand.ReadAsArray(
+                        xoff=int(minPoint[0] + lo[0]), yoff=int(minPoint[1] + lo[1]),
+                        win_xsize=int(readSize[0]), win_ysize=int(readSize[1]))
+                    destRaster[lines[keep] - yoff, pixels[keep] - xoff] = sourceRaster[
+                        keepPoints[1] - lo[1], keepPoints[0] - lo[0]]
+
+        for bandIndex, destRaster in enumerate(destRasters, 1):
+            destImage.GetRasterBand(bandIndex).WriteArray(destRaster, xoff, yoff)
+
+    if (numOut > 0 and not returnValue == EMPTY_DSM_INTERSECTION):
+        print("Skipped {} points outside of image".format(numOut))
+        returnValue = PARTIAL_DSM_INTERSECTION
+    if (occlusion_thresh > 0):
+        print("Skipped {} occluded points".format(num_occluded))
+    return returnValue
@@ -0,0 +1,172 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""Point cloud file utilities
+
+The bounds of point cloud files are read from the LAS/LAZ public header
+when possible, which holds the extents of the points, and otherwise from
+PDAL.  Bounds are cached in a JSON file keyed by file path, size and
+modification time.
+"""
+
+import concurrent.futures
+import json
+import logging
+import struct
+import subprocess
+
+from danesfield import file_cache
+
+# LAS public header block: file signature, and the maximum and minimum X, Y
+# and Z starting at byte 179, the same in all LAS versions and in LAZ
+LAS_SIGNATURE = b'LASF'
+LAS_EXTENTS = struct.Struct('<6d')
+LAS_EXTENTS_OFFSET = 179
+
+BOUNDS_CACHE_VERSION = 1
+
+
+def las_header_bounds(fpath):
+    """
+    Read the (minX, maxX, minY, maxY) bounds of a LAS or LAZ file from its
+    header, without reading the points.  Returns None if the file is not
+    a LAS file.
+    """
+    with open(fpath, 'rb') as f:
+        header = f.read(LAS_EXTENTS_OFFSET + LAS_EXTENTS.size)
+    if len(header) < LAS_EXTENTS_OFFSET + LAS_EXTENTS.size or \
+       not header.startswith(LAS_SIGNATURE):
+        return None
+    maxX, minX, maxY, minY, _, _ = LAS_EXTENTS.unpack_from(header, LAS_EXTENTS_OFFSET)
+    return minX, maxX, minY, maxY
+
+
+def pdal_stats_bounds(json_string):
+    """Bounds from the output of pdal info --stats --dimensions X,Y
+    """
+    j = json.loads(json_string)
+    j = j["stats"]["statistic"]
+    return j[0]["minimum"], j[0]["maximum"], j[1]["minimum"], j[1]["maximum"]
+
+
+def pdal_metadata_bounds(json_string):
+    """
+    Bounds from the output of pdal info --metadata, or None if the reader
+    metadata has no extents.
+    """
+    metadata = json.loads(json_string).get("metadata", {})
+    # older PDAL versions nest the metadata under the reader name
+    candidates = [metadata] + [m for m in metadata.values() if isinstance(m, dict)]
+    for m in candidates:
+        if all(k in m for k in ("minx", "maxx", "miny", "maxy")):
+            return m["minx"], m["maxx"], m["miny"], m["maxy"]
+    return None
+
+
+def pdal_metadata_srs(json_string):
+    """
+    WKT of the spatial reference system in the output of pdal info
+    --metadata, or an empty string if it has none.
+    """
+    metadata = json.loads(json_string).get("metadata", {})
+    candidates = [metadata] + [m for m in metadata.values() if isinstance(m, dict)]
+    for m in candidates:
+        srs = m.get("srs")
+        if isinstance(srs, dict) and srs.get("wkt"):
+            return srs["wkt"]
+        if m.get("comp_spatialreference"):
+            return m["comp_spatialreference"]
+    return ""
+
+
+def point_cloud_srs(fpath):
+    """WKT of the spatial reference system of a point cloud file, read by PDAL
+    """
+    return pdal_metadata_srs(subprocess.check_output(["pdal", "info", "--metadata", fpath]))
+
+
+def pdal_info_bounds(fpath):
+    """
+    Compute the bounds of a point cloud file with PDAL, from the reader
+    metadata if it has extents, otherwise from the statistics of all
+    the points.
+    """
+    out = subprocess.check_output(["pdal", "info", "--metadata", fpath])
+    bounds = pdal_metadata_bounds(out)
+    if bounds is None:
+        out = subprocess.check_output(["pdal", "info", "--stats", "--dimensions", "X,Y", fpath])
+        bounds = pdal_stats_bounds(out)
+    return bounds
+
+
+def point_cloud_bounds(fpaths, cache_fpath=None, jobs=None):
+    """
+    Find the (minX, maxX, minY, maxY) bounds of each point cloud file.
+
+    Bounds are taken from the cache file if given and up to date, then
+    from LAS/LAZ headers, and the remaining files are run through PDAL by
+    a pool of jobs processes.  The cache is updated with the new bounds.
+    """
+    cache = file_cache.read_file_cache(cache_fpath, BOUNDS_CACHE_VERSION) if cache_fpath else {}
+    keys = [file_cache.file_key(fpath) for fpath in fpaths]
+    bounds = [None] * len(fpaths)
+    missing = []
+    num_cached = 0
+    for i, (fpath, key) in enumerate(zip(fpaths, keys)):
+        cached = file_cache.cached_value(cache, key, 'bounds')
+        if cached is not None:
+            bounds[i] = tuple(cached)
+            num_cached += 1
+            continue
+        bounds[i] = las_header_bounds(fpath)
+        if bounds[i] is None:
+            missing.append(i)
+    logging.info("Bounds of {} point cloud files: {} cached, {} from LAS headers, "
+                 "{} from PDAL".format(len(fpaths), num_cached,
+                                       len(fpaths) - num_cached - len(missing),
+                                       len(missing)))
+    if missing:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            for i, b in zip(missing,
+                            executor.map(pdal_info_bounds, [fpaths[i] for i in missing])):
+                bounds[i] = tuple(b)
+    if cache_fpath:
+        for key, b in zip(keys, bounds):
+            file_cache.set_cached_value(cache, key, list(b), 'bounds')
+        file_cache.write_file_cache(cache_fpath, BOUNDS_CACHE_VERSION, cache)
+    return bounds
+
+
+def union_bounds(bounds):
+    """Union of (minX, maxX, minY, maxY) bounds
+    """
+    minX, maxX, minY, maxY = zip(*bounds)
+    return min(minX), max(maxX), min(minY), max(maxY)
+
+
+def read_point_chunks(fpaths, bounds=None, chunk_size=1000000, filters=()):
+    """
+    Stream the (X, Y, Z) coordinates of the points of point cloud files
+    in chunks with PDAL's Python bindings, cropped to the (minX, maxX,
+    minY, maxY) bounds if given, after the given PDAL filter stages.
+    """
+    import pdal
+
+    stages = list(fpaths) + list(filters)
+    if bounds is not None:
+        stages.append({"type": "filters.crop",
+                       "bounds": "([{}, {}], [{}, {}])".format(*bounds)})
+    pipeline = pdal.Pipeline(json.dumps({"pipeline": stages}))
+    if hasattr(pipeline, 'iterator'):
+        arrays = pipeline.iterator(chunk_size=chunk_size)
+    else:
+        # older bindings without streaming, chunk the arrays of the whole
+        # point cloud
+        pipeline.execute()
+        arrays = (array[i:i + chunk_size] for array in pipeline.arrays
+                  for i in range(0, len(array), chunk_size))
+    for array in arrays:
+        yield array['X'], array['Y'], array['Z']
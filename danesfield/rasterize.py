@@ -8,6 +8,7 @@ import subprocess
 
 import gdal
 import numpy
+import ogr
 from scipy.ndimage import morphology
 
 from . import gdal_utils
@@ -25,6 +26,10 @@ ROADS_QUERY = (
     "type not in ('rail')"
 )
 
+# Values of the label raster returned by rasterize_road_labels
+ROAD_LABEL = 1
+ELEVATED_ROAD_LABEL = 2
+
 
 def rasterize_file_dilated_line(
         vector_filename_in, reference_file, thin_line_raster_filename_out,
@@ -73,3 +78,86 @@ def rasterize_file_thin_line(vector_filename_in, reference_file,
                    stdin=subprocess.DEVNULL,
                    stdout=subprocess.DEVNULL,
                    stderr=subprocess.PIPE)
+
+
+def rasterize_road_labels(vector_filename_in, reference_file, query=None,
+                          elevated_query=ELEVATED_ROADS_QUERY, roads=True):
+    """
+    Rasterize the road vector geometry at vector_filename_in in memory,
+    returning a uint8 label ndarray that is ROAD_LABEL on roads,
+    ELEVATED_ROAD_LABEL on elevated roads and 0 elsewhere.  Use the
+    image dimensions, boundary, and other metadata from reference_file
+    (an in-memory object).  Lines are only 1px thick.
+
+    The roads are the features selected by the SQL where-clause query, or
+    all features if it is None, and the elevated roads the features
+    selected by elevated_query.  Elevated roads are labeled as such even
+    if they are not selected by query.  If roads is False, only the
+    elevated roads are rasterized.
+    """
+    vector_file = gdal_utils.ogr_open(vector_filename_in)
+    labels_file = gdal.GetDriverByName('MEM').Create(
+        '', reference_file.RasterXSize, reference_file.RasterYSize, 1, gdal.GDT_Byte)
+    labels_file.SetGeoTransform(reference_file.GetGeoTransform())
+    labels_file.SetProjection(reference_file.GetProjection())
+    burns = [(ROAD_LABEL, query)] if roads else []
+    # Elevated roads are burned last so that they take precedence
+    burns.append((ELEVATED_ROAD_LABEL, elevated_query))
+    for i in range(vector_file.GetLayerCount()):
+        layer = vector_file.GetLayerByIndex(i)
+        for label, where in burns:
+            if layer.SetAttributeFilter(where) != ogr.OGRERR_NONE:
+                raise RuntimeError("Invalid query {!r}".format(where))
+            if gdal.RasterizeLayer(labels_file, [1], layer, burn_values=[label]) != 0:
+                raise RuntimeError("Unable to rasterize {!r}".format(vector_filename_in))
+        layer.SetAttributeFilter(None)
+    return labels_file.GetRasterBand(1).ReadAsArray()
+
+
+def buffer_mask(mask, radius):
+    """
+    Return a boolean ndarray of the pixels within a Euclidean distance of
+    radius pixels from a true pixel of mask.  The distance transform is
+    only computed over the bounding box of mask grown by radius.
+    """
+    mask = numpy.asarray(mask, dtype=bool)
+    buffered = numpy.zeros(mask.shape, dtype=bool)
+    rows, cols = numpy.nonzero(mask.any(axis=1))[0], numpy.nonzero(mask.any(axis=0))[0]
+    if len(rows) == 0:
+        return buffered
+    pad = int(numpy.ceil(radius))
+    window = (slice(max(rows[0] - pad, 0), rows[-1] + pad + 1),
+              slice(max(cols[0] - pad, 0), cols[-1] + pad + 1))
+    buffered[window] = morphology.distance_transform_edt(~mask[window]) <= radius
+    return buffered
+
+
+def rasterize_file_buffered_roads(vector_filename_in, reference_file, buffer_radius,
+                                  road_raster_filename_out=None,
+                                  elevated_road_raster_filename_out=None, query=None,
+                                  roads=True):
+    """
+    Rasterize the road vector geometry at vector_filename_in in memory,
+    see rasterize_road_labels, and return a pair of boolean ndarrays of
+    the roads (including elevated roads) and of the elevated roads,
+    buffered by buffer_radius pixels.
+
+    If given, rasterizations with only 1px-thick lines of the roads and
+    of the elevated roads are written to road_raster_filename_out and
+    elevated_road_raster_filename_out respectively.
+
+    If roads is False, only the elevated roads are rasterized and
+    buffered, and None is returned for the roads.
+    """
+    labels = rasterize_road_labels(vector_filename_in, reference_file, query,
+                                   roads=roads)
+    elevated_roads = labels == ELEVATED_ROAD_LABEL
+    roads = labels != 0 if roads else None
+    for thin_lines, filename in ((roads, road_raster_filename_out),
+                                 (elevated_roads, elevated_road_raster_filename_out)):
+        if filename and thin_lines is not None:
+            gdal_utils.gdal_save(thin_lines.astype(numpy.uint8), reference_file,
+                                 filename, gdal.GDT_Byte)
+    if roads is not None:
+        roads = buffer_mask(roads, buffer_radius)
+    return roads, buffer_mask(elevated_roads, buffer_radius)
@@ -0,0 +1,157 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""Statistics of the connected regions of a label image
+
+The statistics of all regions are computed together in a single pass over
+the labeled pixels, rather than by building a mask for each label.
+"""
+
+import numpy
+import scipy.ndimage
+
+# Fields of the array returned by region_stats.  The row and column
+# moments are taken over the pixel indices of each region.
+REGION_STATS_DTYPE = numpy.dtype([('label', numpy.int64),
+                                  ('count', numpy.int64),
+                                  ('row', numpy.float64),
+                                  ('col', numpy.float64),
+                                  ('var_row', numpy.float64),
+                                  ('var_col', numpy.float64),
+                                  ('cov', numpy.float64)])
+
+# Fields of the array returned by component_stats: the region statistics,
+# the bounding box of each component as slice bounds, and its estimated
+# dimensions
+COMPONENT_STATS_DTYPE = numpy.dtype(REGION_STATS_DTYPE.descr +
+                                    [('row_start', numpy.int64),
+                                     ('row_stop', numpy.int64),
+                                     ('col_start', numpy.int64),
+                                     ('col_stop', numpy.int64),
+                                     ('length', numpy.float64),
+                                     ('width', numpy.float64)])
+
+# If an object was a perfect rectangle, the standard deviation of its
+# pixel coordinates along an axis would be the length of that axis times
+# the square root of this ratio.  (For an ellipse the value is 1/16)
+VARIANCE_RATIO = 1 / 12
+
+
+def region_stats(label_img, num_labels=None):
+    """
+    Compute the pixel count, centroid and covariance of the pixel
+    coordinates of every label of a label image, as returned by
+    scipy.ndimage.label.
+
+    Returns a structured array of REGION_STATS_DTYPE with an entry for
+    each label from 1 to num_labels, which must be at least the largest
+    label and defaults to it.  Labels with no pixels have a count of 0
+    and NaN moments.
+    """
+    label_img = numpy.asarray(label_img)
+    if num_labels is None:
+        num_labels = int(label_img.max()) if label_img.size else 0
+    flat = label_img.ravel()
+    idx = numpy.flatnonzero(flat)
+    labels = flat[idx]
+    rows, cols = numpy.divmod(idx, label_img.shape[-1])
+    rows = rows.astype(numpy.float64)
+    cols = cols.astype(numpy.float64)
+
+    def label_sums(weights=None):
+        return numpy.bincount(labels, weights, minlength=num_labels + 1)[1:num_labels + 1]
+
+    stats = numpy.zeros(num_labels, dtype=REGION_STATS_DTYPE)
+    stats['label'] = numpy.arange(1, num_labels + 1)
+    stats['count'] = label_sums()
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        count = stats['count'].astype(numpy.float64)
+        stats['row'] = label_sums(rows) / count
+        stats['col'] = label_sums(cols) / count
+        # Center the coordinates on the centroid of their region before
+        # the second pass of sums to avoid the cancellation of E[x^2] - E[x]^2
+        rows -= stats['row'][labels - 1]
+        cols -= stats['col'][labels - 1]
+        stats['var_row'] = label_sums(rows * rows) / count
+        stats['var_col'] = label_sums(cols * cols) / count
+        stats['cov'] = label_sums(rows * cols) / count
+    return stats
+
+
+def principal_variances(stats):
+    """
+    Compute the eigenvalues of the 2x2 covariance matrix of each region,
+    in closed form.  Returns an (n, 2) array of the large and small
+    variances along the principal axes.
+    """
+    half_trace = (stats['var_row'] + stats['var_col']) / 2
+    half_diff = (stats['var_row'] - stats['var_col']) / 2
+    radius = numpy.hypot(half_diff, stats['cov'])
+    # Clip rounding errors of degenerate (line or point) regions
+    return numpy.stack([half_trace + radius,
+                        numpy.maximum(half_trace - radius, 0)], axis=-1)
+
+
+def object_scales(stats):
+    """
+    Estimate the large and small dimension of each region from the PCA of
+    its pixel coordinates.  Returns an (n, 2) array.
+    """
+    return numpy.sqrt(principal_variances(stats) / VARIANCE_RATIO)
+
+
+def elongation(stats):
+    """
+    Ratio of the large to the small dimension of each region.  Regions one
+    pixel wide have an infinite ratio and single pixels a NaN ratio.
+    """
+    scales = object_scales(stats)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return scales[:, 0] / scales[:, 1]
+
+
+def component_stats(label_img, num_labels=None):
+    """
+    Compute the statistics of every component of a label image, as
+    returned by scipy.ndimage.label: the region statistics, the bounding
+    box found by scipy.ndimage.find_objects, and the large and small
+    dimensions estimated by PCA.
+
+    Returns a structured array of COMPONENT_STATS_DTYPE with an entry for
+    each label from 1 to num_labels, see region_stats.  Labels with no
+    pixels have empty bounding boxes.
+    """
+    label_img = numpy.asarray(label_img)
+    region = region_stats(label_img, num_labels)
+    stats = numpy.zeros(len(region), dtype=COMPONENT_STATS_DTYPE)
+    for name in REGION_STATS_DTYPE.names:
+        stats[name] = region[name]
+    objects = scipy.ndimage.find_objects(label_img, len(stats))
+    found = numpy.array([slices is not None for slices in objects], dtype=bool)
+    if found.any():
+        bounds = numpy.array([[slices[0].start, slices[0].stop,
+                               slices[1].start, slices[1].stop]
+                              for slices in objects if slices is not None])
+        for j, name in enumerate(['row_start', 'row_stop', 'col_start', 'col_stop']):
+            stats[name][found] = bounds[:, j]
+    scales = object_scales(region)
+    stats['length'] = scales[:, 0]
+    stats['width'] = scales[:, 1]
+    return stats
+
+
+def select_components(stats, min_count=0, max_elongation=None):
+    """
+    Return the labels of the components, described by component_stats,
+    that have at least min_count pixels and, if max_elongation is given,
+    a non-zero width and a ratio of length to width less than
+    max_elongation.
+    """
+    keep = stats['count'] >= max(min_count, 1)
+    if max_elongation is not None:
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            keep &= (stats['width'] > 0) & (stats['length'] / stats['width'] < max_elongation)
+    return stats['label'][keep]
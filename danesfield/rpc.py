@@ -13,6 +13,17 @@
 
 import numpy
 
+# Number of points projected at a time by RPCModel.project_batch, small
+# enough for the terms of a chunk to stay in cache
+PROJECT_CHUNK_SIZE = 8192
+
+# Pairs of terms whose product is each quadratic and cubic term, as
+# indices in the order of power_vector: the product of terms
+# POWER_FACTORS[i] is term i + 4
+POWER_FACTORS = [(1, 2), (1, 3), (2, 3), (1, 1), (2, 2), (3, 3),
+                 (4, 3), (7, 1), (8, 1), (9, 1), (7, 2), (8, 2),
+                 (9, 2), (7, 3), (8, 3), (9, 3)]
+
 
 class RPCModel(object):
     """Represents a Rational Polynomial Camera (RPC) model
@@ -49,6 +60,18 @@ class RPCModel(object):
         self.dy_coeff = self.coeff[:, dy_ind]
         self.dy_coeff[:, [2, 4, 6]] *= 2
         self.dy_coeff[:, 8] *= 3
+        # remember which coefficients the derivatives were computed from
+        self._deriv_src_coeff = self.coeff.copy()
+
+    def update_partial_deriv_coeffs(self):
+        """Compute the partial derivative coefficients only if needed
+
+        The derivative coefficients are cached on the model and only
+        recomputed if the RPC coefficients have changed since the last call.
+        """
+        src = getattr(self, '_deriv_src_coeff', None)
+        if src is None or not numpy.array_equal(src, self.coeff):
+            self.compute_partial_deriv_coeffs()
 
     def jacobian(self, point):
         """Compute the Jacobian of the RPC at the given normalized world point
@@ -73,6 +96,42 @@ class RPCModel(object):
         norm_pt = numpy.array([polys[0] / polys[1], polys[2] / polys[3]])
         return J, norm_pt
 
+    def batch_jacobian(self, points):
+        """Compute the Jacobians of the RPC at many normalized world points
+
+        This is the vectorized equivalent of jacobian() for an (n,3) matrix
+        of points.  The Jacobian entries are returned as a (2,2,n) array
+        along with the (2,n) array of normalized projected points.
+        """
+        pv = self.power_vector(points)
+        # evaluate the polynomials for all points at once
+        polys = numpy.dot(self.coeff, pv)
+        dx_polys = numpy.dot(self.dx_coeff, pv[:10])
+        dy_polys = numpy.dot(self.dy_coeff, pv[:10])
+
+        J = numpy.empty((2, 2, len(points)), dtype=self.coeff.dtype)
+        # use the quotient rule to evaluate the partial derivatives
+        sq_den = polys[[1, 3]] ** 2
+        J[:, 0] = (polys[[1, 3]] * dx_polys[[0, 2]]
+                   - polys[[0, 2]] * dx_polys[[1, 3]]) / sq_den
+        J[:, 1] = (polys[[1, 3]] * dy_polys[[0, 2]]
+                   - polys[[0, 2]] * dy_polys[[1, 3]]) / sq_den
+
+        # also evaluate the projected points in normalized coordinates
+        norm_pts = polys[[0, 2]] / polys[[1, 3]]
+        return J, norm_pts
+
+    @staticmethod
+    def solve_2x2(A, b):
+        """Solve a stack of 2x2 linear systems in closed form
+
+        A is a (2,2,n) array of matrices and b is a (2,n) array of right
+        hand sides.  Returns the (2,n) array of solutions.
+        """
+        det = A[0, 0] * A[1, 1] - A[0, 1] * A[1, 0]
+        return numpy.array([A[1, 1] * b[0] - A[0, 1] * b[1],
+                            A[0, 0] * b[1] - A[1, 0] * b[0]]) / det
+
     @staticmethod
     def power_vector(point):
         """Compute the vector of polynomial terms
@@ -109,13 +168,62 @@ class RPCModel(object):
 
         This function can also project an (n,3) matrix where each row of the
         matrix is a point to project.  The result is an (n,2) matrix of image
-        coordinates.
+        coordinates, computed by project_batch.
         """
+        if numpy.ndim(point) == 2:
+            return self.project_batch(point)
         norm_pt = (numpy.array(point) - self.world_offset) / self.world_scale
         polys = numpy.dot(self.coeff, self.power_vector(norm_pt))
         img_pt = numpy.array([polys[0] / polys[1], polys[2] / polys[3]])
         return img_pt.transpose() * self.image_scale + self.image_offset
 
+    def project_batch(self, points, dtype=numpy.float64, chunk_size=PROJECT_CHUNK_SIZE,
+                      out=None):
+        """Project an (n,3) matrix of long, lat, elev points into image coordinates
+
+        The points are normalized, evaluated and denormalized by chunks
+        of chunk_size points in preallocated buffers, rather than with
+        (n,20) temporaries.  The terms of the polynomials are computed
+        once per chunk and shared by the four polynomials, which are
+        evaluated together by a single matrix product.
+
+        With dtype=numpy.float32 the points are still normalized in double
+        precision, but the polynomials are evaluated in single precision,
+        which is faster and within a hundredth of a pixel for typical
+        satellite images.  The result is written to out if given, an (n,2)
+        array of dtype, and returned.
+        """
+        points = numpy.asarray(points)
+        num_pts = len(points)
+        if out is None:
+            out = numpy.empty((num_pts, 2), dtype)
+        coeff = self.coeff.astype(dtype)
+        world_offset = numpy.reshape(self.world_offset, (3, 1))
+        world_inv_scale = 1 / numpy.reshape(self.world_scale, (3, 1))
+        image_offset = numpy.reshape(self.image_offset, (2, 1))
+        image_scale = numpy.reshape(self.image_scale, (2, 1))
+        chunk_size = max(1, min(chunk_size, num_pts))
+        terms = numpy.empty((20, chunk_size), dtype)
+        terms[0] = 1
+        polys = numpy.empty((4, chunk_size), dtype)
+        for start in range(0, num_pts, chunk_size):
+            stop = min(start + chunk_size, num_pts)
+            t = terms[:, :stop - start]
+            # normalize the world points
+            norm_pts = (points[start:stop].T - world_offset) * world_inv_scale
+            t[1:4] = norm_pts
+            for i, (a, b) in enumerate(POWER_FACTORS):
+                numpy.multiply(t[a], t[b], out=t[i + 4])
+            p = polys[:, :stop - start]
+            numpy.matmul(coeff, t, out=p)
+            # divide and denormalize into the output
+            img_pts = out[start:stop].T
+            numpy.divide(p[0], p[1], out=img_pts[0])
+            numpy.divide(p[2], p[3], out=img_pts[1])
+            img_pts *= image_scale
+            img_pts += image_offset
+        return out
+
     def back_project(self, image_point, elev):
         """Back project an image point with known elevation to long, lat
 
@@ -151,7 +259,7 @@ class RPCModel(object):
         by = numpy.reshape(by, (-1))
 
         # make sure the partial derivatives are up to date
-        self.compute_partial_deriv_coeffs()
+        self.update_partial_deriv_coeffs()
 
         # allocate a matrix for the solution
         soln = numpy.empty((len(bx), 3))
@@ -177,6 +285,65 @@ class RPCModel(object):
                     break
         return soln * self.world_scale + self.world_offset
 
+    def back_project_batch(self, image_points, elevs, tol=1e-16, max_iter=10):
+        """Back project many image points with known elevations to long, lat
+
+        This computes the same result as back_project() but solves for all
+        points simultaneously.  The 2x2 systems for the initialization and
+        for each Newton iteration are solved in closed form for all points
+        at once.  Points drop out of later iterations as soon as their step
+        size falls below tol.
+
+        image_points is an (n,2) matrix of image coordinates and elevs is
+        either a scalar or a length n vector of elevations.  The result is
+        an (n,3) matrix of long, lat, elev points.
+        """
+        # map the image points and elevations to normalized space
+        norm_img_pts = (numpy.reshape(image_points, (-1, 2)) - self.image_offset) \
+            / self.image_scale
+        num_pts = len(norm_img_pts)
+        norm_elevs = (numpy.broadcast_to(elevs, (num_pts,)) - self.world_offset[2]) \
+            / self.world_scale[2]
+
+        # assign some short variable names
+        x, y = norm_img_pts.transpose()
+        h = norm_elevs
+
+        # Use a first order approximation to the RPC to initialize.
+        # This sets all non-linear terms of the RPC to zero and then
+        # inverts the resulting linear mapping.
+        A = numpy.empty((2, 2, num_pts))
+        A[0] = self.coeff[0, 1:3, numpy.newaxis] - self.coeff[1, 1:3, numpy.newaxis] * x
+        A[1] = self.coeff[2, 1:3, numpy.newaxis] - self.coeff[3, 1:3, numpy.newaxis] * y
+        b = numpy.array([(self.coeff[1, 0] + self.coeff[1, 3] * h) * x
+                         - (self.coeff[0, 0] + self.coeff[0, 3] * h),
+                         (self.coeff[3, 0] + self.coeff[3, 3] * h) * y
+                         - (self.coeff[2, 0] + self.coeff[2, 3] * h)])
+
+        # make sure the partial derivatives are up to date
+        self.update_partial_deriv_coeffs()
+
+        # allocate a matrix for the solution
+        soln = numpy.empty((num_pts, 3))
+        # copy in the known heights
+        soln[:, 2] = h
+        # compute the first-order initial solution
+        soln[:, 0:2] = self.solve_2x2(A, b).transpose()
+
+        # Apply Newton iterations to the points that have not yet converged
+        active = numpy.arange(num_pts)
+        for k in range(max_iter):
+            if len(active) == 0:
+                break
+            # evaluate the jacobians and projections at the current solution
+            J, pts = self.batch_jacobian(soln[active])
+            # solve for the next incremental steps
+            step = self.solve_2x2(J, norm_img_pts[active].transpose() - pts)
+            soln[active, 0:2] += step.transpose()
+            # drop the points that have converged
+            active = active[numpy.max(numpy.abs(step), axis=0) >= tol]
+        return soln * self.world_scale + self.world_offset
+
 
 def rpc_from_gdal_dict(md_dict):
     """Construct a RPCModel from a GDAL RPC meta-data dictionary
@@ -0,0 +1,134 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""Cache of the RPC models of images
+
+Reading the RPC metadata requires opening the image, which is slow for
+large NITF files.  The model is saved in a small .npz sidecar next to the
+image, or in a cache directory, together with the absolute path, size and
+modification time of the image, and is used instead of opening the image
+while the image is unchanged.
+"""
+
+import logging
+import os
+
+import numpy
+
+from danesfield import file_cache
+from danesfield import raytheon_rpc
+from danesfield import rpc
+
+CACHE_VERSION = 1
+
+# Suffix added to the image file name to make the name of its sidecar
+CACHE_SUFFIX = '.rpc.npz'
+
+
+def is_raytheon_rpc_file(fpath):
+    """Whether a path is a Raytheon RPC file rather than an image
+    """
+    return fpath.lower().endswith('.rpc')
+
+
+def cache_path(fpath, cache_dir=None):
+    """Path of the sidecar caching the RPC model of the image fpath
+    """
+    if cache_dir:
+        return os.path.join(cache_dir, os.path.basename(fpath) + CACHE_SUFFIX)
+    return fpath + CACHE_SUFFIX
+
+
+def model_to_array(model):
+    """Pack the coefficients, offsets and scales of a RPCModel in an array
+    """
+    return numpy.concatenate([numpy.ravel(a) for a in (
+        model.coeff, model.world_offset, model.world_scale,
+        model.image_offset, model.image_scale)])
+
+
+def model_from_array(array):
+    """Unpack a RPCModel packed by model_to_array
+    """
+    model = rpc.RPCModel()
+    model.coeff = array[:80].reshape(4, 20)
+    model.world_offset = array[80:83]
+    model.world_scale = array[83:86]
+    model.image_offset = array[86:88]
+    model.image_scale = array[88:90]
+    return model
+
+
+def save_rpc(cache_fpath, model, key):
+    """Save a RPCModel read from the file with the given file_cache.file_key
+    """
+    path, size, mtime = key
+    # the model is packed with the version, size and time in one array,
+    # loading each member of a .npz has a significant cost
+    values = numpy.concatenate([[CACHE_VERSION, size, mtime], model_to_array(model)])
+    # write to a temporary file and rename, so that concurrent runs never
+    # read a partial sidecar
+    temp_fpath = '{}.{}.tmp'.format(cache_fpath, os.getpid())
+    with open(temp_fpath, 'wb') as f:
+        numpy.savez(f, values=values, path=path)
+    os.replace(temp_fpath, cache_fpath)
+
+
+def read_rpc_cache(cache_fpath, key):
+    """
+    Read a RPCModel from a sidecar, returns None if the sidecar doesn't
+    exist, is invalid or doesn't match the file key.
+    """
+    path, size, mtime = key
+    try:
+        with numpy.load(cache_fpath, allow_pickle=False) as cache:
+            values = cache['values']
+            if (len(values) != 93 or tuple(values[:3]) != (CACHE_VERSION, size, mtime) or
+                    str(cache['path']) != path):
+                return None
+            return model_from_array(values[3:])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def read_image_rpc(fpath):
+    """Read the RPC model from the metadata of an image, None if it has none
+    """
+    # GDAL is only needed for images, not for Raytheon RPC files
+    import gdal
+    image = gdal.Open(fpath, gdal.GA_ReadOnly)
+    if not image:
+        raise RuntimeError("Error: Failed to open image {}".format(fpath))
+    md = image.GetMetadata('RPC')
+    return rpc.rpc_from_gdal_dict(md) if md else None
+
+
+def load_rpc(fpath, cache_dir=None, use_cache=True):
+    """
+    Load the RPC model of an image, or of a Raytheon RPC file ending with
+    .rpc.  The model of an image is taken from its cache if up to date,
+    otherwise it is read and cached next to the image, or in cache_dir if
+    given.  Returns None if the file doesn't exist or an image has no RPC
+    metadata.
+    """
+    if not os.path.isfile(fpath):
+        return None
+    if is_raytheon_rpc_file(fpath):
+        # parsing the small text file is as fast as loading a sidecar
+        return raytheon_rpc.read_raytheon_rpc_file(fpath)
+    if not use_cache:
+        return read_image_rpc(fpath)
+    key = file_cache.file_key(fpath)
+    cache_fpath = cache_path(fpath, cache_dir)
+    model = read_rpc_cache(cache_fpath, key)
+    if model is None:
+        model = read_image_rpc(fpath)
+        if model is not None:
+            try:
+                save_rpc(cache_fpath, model, key)
+            except OSError as e:
+                logging.warning("Cannot cache the RPC of {}: {}".format(fpath, e))
+    return model
@@ -0,0 +1,82 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import importlib.util
+import os
+
+import numpy
+import pytest
+
+pytest.importorskip('vtk')
+gdal = pytest.importorskip('gdal')
+osr = pytest.importorskip('osr')
+
+TOOL_PATH = os.path.join(os.path.dirname(__file__), '..', 'tools', 'buildings_to_dsm.py')
+
+# origin of the synthetic DTM in UTM zone 17N
+UTM_ORIGIN = (500000.0, 4000000.0)
+
+
+def load_tool():
+    spec = importlib.util.spec_from_file_location('buildings_to_dsm', TOOL_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_box(fpath, x0, y0, x1, y1, height):
+    """Write a box as an OBJ file with coordinates relative to the origin"""
+    with open(fpath, 'w') as f:
+        f.write('#x offset: {}\n#y offset: {}\n#z offset: 0\n'.format(*UTM_ORIGIN))
+        for z in (0, height):
+            for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1)):
+                f.write('v {} {} {}\n'.format(x, y, z))
+        for face in ((1, 4, 3, 2), (5, 6, 7, 8), (1, 2, 6, 5),
+                     (2, 3, 7, 6), (3, 4, 8, 7), (4, 1, 5, 8)):
+            f.write('f {} {} {} {}\n'.format(*face))
+
+
+def make_scene(tmpdir, xsize=70, ysize=45):
+    """Write a flat DTM and two buildings, with edges between pixel centers"""
+    srs = osr.SpatialReference()
+    srs.SetUTM(17, True)
+    srs.SetWellKnownGeogCS('WGS84')
+    dtm_path = str(tmpdir.join('dtm.tif'))
+    ds = gdal.GetDriverByName('GTiff').Create(dtm_path, xsize, ysize, 1, gdal.GDT_Float32)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform((UTM_ORIGIN[0], 1.0, 0.0, UTM_ORIGIN[1] + ysize, 0.0, -1.0))
+    ds.GetRasterBand(1).WriteArray(numpy.full((ysize, xsize), 5.0))
+    ds = None
+    obj_paths = [str(tmpdir.join('1_building.obj')), str(tmpdir.join('2_building.obj'))]
+    write_box(obj_paths[0], 3.25, 4.25, 40.25, 20.25, 12.0)
+    write_box(obj_paths[1], 30.25, 25.25, 66.25, 41.25, 20.0)
+    return dtm_path, obj_paths
+
+
+def render(tool, tmpdir, dtm_path, obj_paths, tile_size):
+    outputs = [str(tmpdir.join('{}_{}.tif'.format(name, tile_size)))
+               for name in ('dsm', 'cls', 'ids')]
+    tool.main([dtm_path, outputs[0], '--output_cls', outputs[1],
+               '--output_building_ids', outputs[2], '--tile_size', str(tile_size),
+               '--input_obj_paths'] + obj_paths)
+    return [gdal.Open(path).ReadAsArray() for path in outputs]
+
+
+def test_tiled_matches_single_window(tmpdir):
+    tool = load_tool()
+    dtm_path, obj_paths = make_scene(tmpdir)
+    dsm, cls, ids = render(tool, tmpdir, dtm_path, obj_paths, 4096)
+    assert set(numpy.unique(cls)) == {2, 6}
+    assert set(numpy.unique(ids)) == {0, 1, 2}
+    numpy.testing.assert_allclose(dsm[ids == 0], 5.0)
+    numpy.testing.assert_allclose(dsm[ids == 2], 20.0, atol=1e-3)
+
+    # tiles that don't divide the DTM size
+    for tile_size in (16, 25):
+        tiled_dsm, tiled_cls, tiled_ids = render(tool, tmpdir, dtm_path, obj_paths, tile_size)
+        numpy.testing.assert_allclose(tiled_dsm, dsm, atol=1e-3)
+        numpy.testing.assert_array_equal(tiled_cls, cls)
+        numpy.testing.assert_array_equal(tiled_ids, ids)
@@ -0,0 +1,161 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import importlib.util
+import os
+
+from danesfield.dtm import DTMEstimator
+
+import numpy
+import pytest
+
+FIT_DTM_PATH = os.path.join(os.path.dirname(__file__), '..', 'tools', 'fit_dtm.py')
+
+
+def synthetic_dsm(shape=(420, 390), nodata=-9999, seed=0):
+    """Rolling terrain with box shaped buildings and a few no-data pixels
+    """
+    rng = numpy.random.RandomState(seed)
+    rows, cols = numpy.indices(shape)
+    dsm = 100 + 10 * numpy.sin(rows / 80.0) + 8 * numpy.cos(cols / 110.0)
+    for _ in range(shape[0] * shape[1] // 2000):
+        i, j = rng.randint(0, shape[0] - 30), rng.randint(0, shape[1] - 30)
+        h, w = rng.randint(6, 30, 2)
+        dsm[i:i + h, j:j + w] += rng.uniform(5, 40)
+    dsm = dsm.astype(numpy.float32)
+    dsm[rng.rand(*shape) < 0.001] = nodata
+    return dsm
+
+
+@pytest.mark.parametrize('num_workers', [2, 3, 8])
+def test_parallel_matches_serial(num_workers):
+    dsm = synthetic_dsm()
+    serial = DTMEstimator(-9999, 20, 10).fit_dtm(dsm)
+    parallel = DTMEstimator(-9999, 20, 10, num_workers=num_workers).fit_dtm(dsm)
+    assert parallel.dtype == serial.dtype
+    assert numpy.allclose(parallel, serial, rtol=0, atol=1e-3)
+
+
+def test_num_bands():
+    estimator = DTMEstimator(num_inner_iter=10, num_workers=4)
+    assert estimator.num_bands((1000, 50)) == 4
+    # bands must be at least twice as tall as the halo
+    assert estimator.num_bands((60, 1000)) == 3
+    assert estimator.num_bands((30, 1000)) == 1
+    assert DTMEstimator(num_workers=1).num_bands((1000, 1000)) == 1
+
+
+def test_level_stats():
+    estimator = DTMEstimator(-9999, 20, 10)
+    estimator.fit_dtm(synthetic_dsm())
+    # coarsest level first
+    assert [s['shape'] for s in estimator.level_stats] == [(105, 98), (210, 195), (420, 390)]
+    assert [s['iterations'] for s in estimator.level_stats] == [20, 10, 5]
+    assert not any(s['converged'] for s in estimator.level_stats)
+    assert all(s['max_update'] >= s['mean_update'] >= 0 for s in estimator.level_stats)
+
+
+@pytest.mark.parametrize('num_workers', [1, 4])
+def test_early_termination(num_workers):
+    dsm = synthetic_dsm()
+    full = DTMEstimator(-9999, 40, 10)
+    full_dtm = full.fit_dtm(dsm)
+    early = DTMEstimator(-9999, 40, 10, num_workers=num_workers, tolerance=0.05, min_iter=5)
+    early_dtm = early.fit_dtm(dsm)
+    iterations = [s['iterations'] for s in early.level_stats]
+    assert all(i >= 5 or i == s['max_iterations']
+               for i, s in zip(iterations, early.level_stats))
+    assert sum(iterations) < sum(s['iterations'] for s in full.level_stats)
+    for s in early.level_stats:
+        assert s['converged'] == (s['max_update'] < 0.05)
+    valid = dsm != -9999
+    assert numpy.sqrt(numpy.mean((early_dtm - full_dtm)[valid] ** 2)) < 1.0
+
+
+def test_tiny_tolerance_runs_full_schedule():
+    dsm = synthetic_dsm()
+    full_dtm = DTMEstimator(-9999, 20, 10).fit_dtm(dsm)
+    estimator = DTMEstimator(-9999, 20, 10, tolerance=1e-12)
+    assert numpy.array_equal(estimator.fit_dtm(dsm), full_dtm)
+
+
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_inplace_matches_default(num_workers):
+    dsm = synthetic_dsm().astype(numpy.float64)
+    default = DTMEstimator(-9999, 20, 10).fit_dtm(dsm)
+    inplace = DTMEstimator(-9999, 20, 10, num_workers=num_workers, inplace=True).fit_dtm(dsm)
+    assert inplace.dtype == numpy.float64
+    assert numpy.allclose(inplace, default, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('tolerance', [None, 0.05])
+def test_float32_inplace(tolerance):
+    dsm = synthetic_dsm().astype(numpy.float64)
+    default = DTMEstimator(-9999, 20, 10, tolerance=tolerance).fit_dtm(dsm)
+    estimator = DTMEstimator(-9999, 20, 10, tolerance=tolerance,
+                             dtype=numpy.float32, inplace=True)
+    dtm = estimator.fit_dtm(dsm)
+    assert dtm.dtype == numpy.float32
+    assert dtm.shape == dsm.shape
+    valid = dsm != -9999
+    assert numpy.abs(dtm - default)[valid].max() < 0.01
+
+
+def array_reader(dsm):
+    def read_dsm(row, col, rows, cols, factor):
+        return dsm[row * factor::factor, col * factor::factor][:rows, :cols]
+    return read_dsm
+
+
+@pytest.mark.parametrize('tile_size', [64, 150, 1000])
+def test_tiled_matches_in_memory(tile_size, tmpdir):
+    dsm = synthetic_dsm((450, 380))
+    expected = DTMEstimator(-9999, 20, 10).fit_dtm(dsm)
+    estimator = DTMEstimator(-9999, 20, 10)
+    dtm = numpy.full(dsm.shape, numpy.nan, numpy.float32)
+    tiles = []
+
+    def write_dtm(row, col, tile):
+        assert row % tile_size == 0 and col % tile_size == 0
+        tiles.append(tile.shape)
+        dtm[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+
+    estimator.fit_dtm_tiled(array_reader(dsm), write_dtm, dsm.shape, tile_size,
+                            temp_dir=str(tmpdir))
+    assert all(t[0] <= tile_size and t[1] <= tile_size for t in tiles)
+    assert numpy.allclose(dtm, expected, rtol=0, atol=1e-3)
+    assert [s['shape'] for s in estimator.level_stats] == [(113, 95), (225, 190), (450, 380)]
+    assert [s['iterations'] for s in estimator.level_stats] == [20, 10, 5]
+    # the memory mapped levels are removed
+    assert not tmpdir.listdir()
+
+
+def test_pyramid_shapes():
+    assert DTMEstimator.pyramid_shapes((450, 380)) == [(450, 380), (225, 190), (113, 95)]
+    assert DTMEstimator.pyramid_shapes((90, 1000)) == [(90, 1000)]
+
+
+# GTiff blocks are multiples of 16, neither of which divides the raster
+@pytest.mark.parametrize('tile_size', [64, 144])
+def test_tiled_gdal_matches_in_memory(tile_size, tmpdir):
+    gdal = pytest.importorskip('gdal')
+    spec = importlib.util.spec_from_file_location('fit_dtm', FIT_DTM_PATH)
+    fit_dtm = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fit_dtm)
+
+    # odd sizes, so that the decimated windows are clipped at the edges
+    dsm = synthetic_dsm((451, 383))
+    dsm_path = str(tmpdir.join('dsm.tif'))
+    ds = gdal.GetDriverByName('GTiff').Create(dsm_path, dsm.shape[1], dsm.shape[0], 1,
+                                              gdal.GDT_Float32)
+    ds.GetRasterBand(1).WriteArray(dsm)
+    ds = None
+    dtm_path = str(tmpdir.join('dtm.tif'))
+    fit_dtm.fit_dtm_tiled(DTMEstimator(-9999, 20, 10), gdal.Open(dsm_path), dtm_path,
+                          tile_size)
+    dtm = gdal.Open(dtm_path).ReadAsArray()
+    expected = DTMEstimator(-9999, 20, 10).fit_dtm(dsm)
+    assert numpy.allclose(dtm, expected, rtol=0, atol=1e-3)
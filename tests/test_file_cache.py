@@ -0,0 +1,53 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import json
+import os
+
+import pytest
+
+from danesfield import file_cache
+
+
+def line_count(fpath):
+    with open(fpath) as f:
+        return {'lines': len(f.readlines())}
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_map_files_cached(tmpdir, jobs):
+    fpaths = []
+    for i in range(4):
+        fpath = os.path.join(str(tmpdir), 'file{}.txt'.format(i))
+        with open(fpath, 'w') as f:
+            f.write('line\n' * i)
+        fpaths.append(fpath)
+    cache_fpath = os.path.join(str(tmpdir), 'cache.json')
+    values, num_cached = file_cache.map_files_cached(line_count, fpaths, cache_fpath,
+                                                     jobs=jobs)
+    assert values == [{'lines': i} for i in range(4)]
+    assert num_cached == 0
+
+    # up to date entries are taken from the cache
+    with open(cache_fpath) as f:
+        cache = json.load(f)
+    cache['files'][os.path.abspath(fpaths[1])]['value'] = {'lines': 100}
+    with open(cache_fpath, 'w') as f:
+        json.dump(cache, f)
+    values, num_cached = file_cache.map_files_cached(line_count, fpaths, cache_fpath,
+                                                     jobs=jobs)
+    assert values[1] == {'lines': 100} and num_cached == 4
+
+    # modified files and other cache versions are computed again
+    with open(fpaths[1], 'a') as f:
+        f.write('line\n')
+    values, num_cached = file_cache.map_files_cached(line_count, fpaths, cache_fpath,
+                                                     jobs=jobs)
+    assert values[1] == {'lines': 2} and num_cached == 3
+    values, num_cached = file_cache.map_files_cached(line_count, fpaths, cache_fpath,
+                                                     version=2, jobs=jobs)
+    assert num_cached == 0
+    assert not [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')]
@@ -0,0 +1,91 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import numpy
+import pytest
+
+from danesfield import gridding
+
+
+def random_points(n=20000, seed=0):
+    rng = numpy.random.RandomState(seed)
+    x = rng.uniform(99, 131, n)
+    y = rng.uniform(-1, 21, n)
+    z = rng.normal(50, 10, n)
+    return x, y, z
+
+
+def test_grid_geometry():
+    grid = gridding.PointGrid((100.0, 129.5, 0.0, 19.5), 0.5)
+    # one more cell than fits in the bounds, as PDAL's writers.gdal
+    assert grid.shape == (40, 60)
+    assert grid.geotransform == (100.0, 0.5, 0.0, 20.0, 0.0, -0.5)
+    idx, inside = grid.cell_indices(numpy.array([100.0, 100.4, 129.9, 130.0, 99.9]),
+                                    numpy.array([19.9, 0.0, 0.1, 10.0, 10.0]))
+    assert inside.tolist() == [True, True, True, False, False]
+    assert idx.tolist() == [0, 39 * 60, 39 * 60 + 59]
+    with pytest.raises(ValueError):
+        gridding.PointGrid((0, 1, 0, 1), 0.5, ['median'])
+
+
+def test_statistics_match_loop():
+    x, y, z = random_points()
+    grid = gridding.PointGrid((100.0, 129.5, 0.0, 19.5), 0.5, gridding.STATISTICS)
+    # streaming in chunks gives the same result as a single chunk
+    for i in range(0, len(x), 3000):
+        grid.add_points(x[i:i + 3000], y[i:i + 3000], z[i:i + 3000])
+    idx, inside = grid.cell_indices(x, y)
+    assert grid.num_points == inside.sum()
+    cells = {}
+    for i, v in zip(idx, z[inside]):
+        cells.setdefault(i, []).append(v)
+    rasters = {s: grid.raster(s).ravel() for s in gridding.STATISTICS}
+    for i, values in cells.items():
+        assert rasters['max'][i] == numpy.float32(max(values))
+        assert rasters['min'][i] == numpy.float32(min(values))
+        assert rasters['count'][i] == len(values)
+        assert rasters['mean'][i] == pytest.approx(numpy.mean(values), rel=1e-6)
+    empty = numpy.setdiff1d(numpy.arange(grid.count.size), list(cells))
+    assert (rasters['max'][empty] == gridding.NODATA_VALUE).all()
+    assert (rasters['count'][empty] == 0).all()
+
+
+def test_fill_voids():
+    rng = numpy.random.RandomState(1)
+    values = rng.uniform(0, 10, (30, 40)).astype(numpy.float32)
+    empty = rng.rand(30, 40) < 0.6
+    empty[5:20, 10:30] = True
+    filled = gridding.fill_voids(values.copy(), gridding.void_fill_cells(empty, 4))
+    rows, cols = numpy.nonzero(~empty)
+    for r, c in zip(*numpy.nonzero(empty)):
+        d = numpy.hypot(rows - r, cols - c)
+        if d.min() <= 4:
+            # any of the nearest cells, in case of ties
+            assert filled[r, c] in values[rows[d == d.min()], cols[d == d.min()]]
+        else:
+            assert filled[r, c] == gridding.NODATA_VALUE
+    assert numpy.array_equal(filled[~empty], values[~empty])
+    all_empty = gridding.void_fill_cells(numpy.ones_like(empty), 4)
+    assert (gridding.fill_voids(values.copy(), all_empty) == gridding.NODATA_VALUE).all()
+
+
+def test_max_into_matches_sorted_writes():
+    rng = numpy.random.RandomState(2)
+    rows = rng.randint(-5, 45, 5000)
+    cols = rng.randint(-5, 65, 5000)
+    z = rng.normal(20, 5, 5000)
+    raster = numpy.full((40, 60), -numpy.inf, numpy.float32)
+    # split in chunks, as streamed
+    inside = numpy.concatenate([gridding.max_into(raster, rows[i:i + 700], cols[i:i + 700],
+                                                  z[i:i + 700])
+                                for i in range(0, 5000, 700)])
+    expected_inside = (rows >= 0) & (rows < 40) & (cols >= 0) & (cols < 60)
+    assert numpy.array_equal(inside, expected_inside)
+    # writing the points sorted by height keeps the highest one
+    expected = numpy.full((40, 60), -numpy.inf, numpy.float32)
+    order = numpy.argsort(z[inside])
+    expected[rows[inside][order], cols[inside][order]] = z[inside][order]
+    assert numpy.array_equal(raster, expected)
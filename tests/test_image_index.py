@@ -0,0 +1,28 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import pytest
+
+pytest.importorskip('gdal')
+
+from danesfield import image_index  # noqa: E402
+
+
+def test_rank_images():
+    dsm_bounds = [0.0, 0.0, 1.0, 1.0]
+
+    def image(bounds, cloud_cover, angle):
+        return {'bounds': bounds, 'cloud_cover': cloud_cover, 'angle': angle}
+
+    metadata = [image([0.5, 0.0, 2.0, 1.0], 0, 5),
+                image([-1.0, -1.0, 2.0, 2.0], 10, 20),
+                image([-1.0, -1.0, 2.0, 2.0], 0, 30),
+                image([-1.0, -1.0, 2.0, 2.0], 0, 10),
+                image([2.0, 2.0, 3.0, 3.0], 0, 0)]
+    order, areas = image_index.rank_images(dsm_bounds, metadata)
+    assert areas.tolist() == [0.5, 0.0, 0.0, 0.0, 1.0]
+    # most coverage, then least cloud cover, then most nadir
+    assert order.tolist() == [3, 2, 1, 0, 4]
@@ -0,0 +1,64 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import importlib.util
+import io
+import os
+
+TOOL_PATH = os.path.join(os.path.dirname(__file__), '..', 'tools', 'merge_raw_obj_meshes.py')
+
+MESH_A = ('#x offset: 1.5\n#y offset: 2\n#z offset: 0\n'
+          'v 0 0 0\nv 1 0 0\nv 0 1 0\nvt 0 0\nvt 1 1\nvn 0 0 1\n'
+          'f 1/1/1 2/2/1 3/1/1\nf 3 2 1\n')
+MESH_B = ('#x offset: 1.5\n#y offset: 2\n#z offset: 0\n'
+          'v 5 5 5\nv 6 5 5\nv 5 6 5\nvt 0.5 0.5\nvn 0 0 1\n'
+          'f 1/1/1 2/1/1 3/1/1\nf 1//1 2//1 3//1\nf -1 -2 -3\nf 1 2 3')
+MERGED = ('#x offset: 1.5\n#y offset: 2.0\n#z offset: 0.0\n'
+          'v 0 0 0\nv 1 0 0\nv 0 1 0\nvt 0 0\nvt 1 1\nvn 0 0 1\n'
+          'f 1/1/1 2/2/1 3/1/1\nf 3 2 1\n'
+          'v 5 5 5\nv 6 5 5\nv 5 6 5\nvt 0.5 0.5\nvn 0 0 1\n'
+          'f 4/3/2 5/3/2 6/3/2\nf 4//2 5//2 6//2\nf -1 -2 -3\nf 4 5 6\n')
+
+
+def load_tool():
+    spec = importlib.util.spec_from_file_location('merge_raw_obj_meshes', TOOL_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_merge_files(tmpdir):
+    tool = load_tool()
+    paths = [str(tmpdir.join('a.obj')), str(tmpdir.join('b.obj'))]
+    for path, text in zip(paths, (MESH_A, MESH_B)):
+        with open(path, 'w') as f:
+            f.write(text)
+    output = str(tmpdir.join('merged.obj'))
+    tool.merge_files(paths, output, True)
+    with open(output) as f:
+        assert f.read() == MERGED
+
+
+def test_copy_records_by_chunks():
+    tool = load_tool()
+    text = ''.join('v {} 0 0\n'.format(i) for i in range(50))
+    text += ''.join('f {} {} {}\n'.format(i + 1, i + 2, i + 3) for i in range(48))
+    for chunk_bytes in (7, 64, 1000):
+        out = io.StringIO()
+        counts = tool.copy_records(io.StringIO(text), out, [10, 0, 0], chunk_bytes)
+        assert counts == [50, 0, 0]
+        expected = text[:text.index('f')]
+        expected += ''.join('f {} {} {}\n'.format(i + 11, i + 12, i + 13) for i in range(48))
+        assert out.getvalue() == expected
+
+
+def test_write_faces_mixed_layouts():
+    tool = load_tool()
+    # same number of "//" and of indices in both lines, in different places
+    block = 'f 1//1 2/1/1 3/1/1\nf 1/1/1 2//1 3/1/1\n'
+    out = io.StringIO()
+    tool.write_faces(out, block, [10, 20, 30])
+    assert out.getvalue() == 'f 11//31 12/21/31 13/21/31\nf 11/21/31 12//31 13/21/31\n'
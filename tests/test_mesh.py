@@ -0,0 +1,171 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import numpy
+
+from danesfield import mesh
+
+
+def interpolate(points, z, faces, query):
+    """Linear interpolation of a triangle mesh at query points, by brute force"""
+    a, b, c = (points[faces[:, i]] for i in range(3))
+    det = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1])
+    d = query[:, None, :] - a[None]
+    l1 = (d[..., 0] * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * d[..., 1]) / det
+    l2 = ((b[:, 0] - a[:, 0]) * d[..., 1] - d[..., 0] * (b[:, 1] - a[:, 1])) / det
+    inside = (l1 >= -1e-9) & (l2 >= -1e-9) & (l1 + l2 <= 1 + 1e-9)
+    face = numpy.argmax(inside, axis=1)
+    n = numpy.arange(len(query))
+    values = ((1 - l1[n, face] - l2[n, face]) * z[faces[face, 0]] +
+              l1[n, face] * z[faces[face, 1]] + l2[n, face] * z[faces[face, 2]])
+    return values, inside.any(axis=1)
+
+
+def test_grid_faces():
+    rows, cols = 4, 5
+    expected = []
+    for j in range(rows - 1):
+        for i in range(cols - 1):
+            id0 = j * cols + i
+            expected += [[id0, id0 + cols, id0 + 1], [id0 + cols, id0 + cols + 1, id0 + 1]]
+    numpy.testing.assert_array_equal(mesh.grid_faces(rows, cols), expected)
+
+    valid = numpy.ones((rows, cols), dtype=bool)
+    valid[1, 2] = False
+    faces = mesh.grid_faces(rows, cols, valid)
+    # 6 triangles share the vertex
+    assert len(faces) == len(expected) - 6
+    assert not numpy.any(faces == 1 * cols + 2)
+
+
+def test_adaptive_grid_mesh():
+    rows, cols = 21, 26
+    row, col = numpy.mgrid[0:rows, 0:cols]
+    plane = 0.3 * row - 0.2 * col + 5
+    vertex_index, faces = mesh.adaptive_grid_mesh(plane, 0.01)
+    assert len(vertex_index) == 4 and len(faces) == 2
+
+    rng = numpy.random.RandomState(0)
+    z = numpy.sin(row / 4.0) * numpy.cos(col / 5.0) * 3 + rng.rand(rows, cols) * 0.1
+    max_error = 0.25
+    vertex_index, faces = mesh.adaptive_grid_mesh(z, max_error)
+    assert len(vertex_index) < z.size / 2
+    points = numpy.stack([col.ravel(), row.ravel()], axis=1).astype(float)
+    values, inside = interpolate(points[vertex_index], z.ravel()[vertex_index], faces, points)
+    assert inside.all()
+    assert numpy.max(numpy.abs(values - z.ravel())) <= max_error + 1e-9
+    # same orientation as the grid faces
+    e1 = points[vertex_index][faces[:, 1]] - points[vertex_index][faces[:, 0]]
+    e2 = points[vertex_index][faces[:, 2]] - points[vertex_index][faces[:, 0]]
+    assert numpy.all(e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0] < 0)
+
+    valid = numpy.ones(z.shape, dtype=bool)
+    valid[5:10, 5:12] = False
+    check_masked_mesh(z, max_error, valid)
+
+
+def face_area(points, faces):
+    e1 = points[faces[:, 1]] - points[faces[:, 0]]
+    e2 = points[faces[:, 2]] - points[faces[:, 0]]
+    return numpy.abs(e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0]).sum() / 2
+
+
+def check_masked_mesh(z, max_error, valid):
+    """Check that an adaptive mesh covers the valid cells, within max_error"""
+    rows, cols = z.shape
+    row, col = numpy.mgrid[0:rows, 0:cols]
+    points = numpy.stack([col.ravel(), row.ravel()], axis=1).astype(float)
+    vertex_index, faces = mesh.adaptive_grid_mesh(z, max_error, valid)
+    assert valid.ravel()[vertex_index[faces]].all()
+    grid = mesh.grid_faces(rows, cols, valid)
+    # the same area as the valid cells, with the samples of the valid cells inside
+    assert face_area(points[vertex_index], faces) == face_area(points, grid)
+    samples = numpy.unique(grid)
+    values, inside = interpolate(points[vertex_index], z.ravel()[vertex_index], faces,
+                                 points[samples])
+    assert inside.all()
+    assert numpy.max(numpy.abs(values - z.ravel()[samples])) <= max_error + 1e-9
+    return vertex_index, faces
+
+
+def test_adaptive_grid_mesh_nodata_border():
+    row, col = numpy.mgrid[0:40, 0:60]
+    z = 0.05 * row + 0.02 * col + 10
+    valid = numpy.ones(z.shape, dtype=bool)
+    valid[:, :3] = False
+    z[~valid] = -9999
+    vertex_index, faces = check_masked_mesh(z, 0.2, valid)
+    # the plane only needs the corners of the valid area, and its border
+    assert len(vertex_index) < z.size / 10
+
+    valid[-5:, 20:] = False
+    check_masked_mesh(z, 0.2, valid)
+
+    # a single invalid corner
+    z = numpy.zeros((50, 50))
+    valid = numpy.ones(z.shape, dtype=bool)
+    valid[0, 0] = False
+    check_masked_mesh(z, 0.2, valid)
+
+
+def test_remove_unused_vertices():
+    vertices = numpy.arange(15.0).reshape(5, 3)
+    faces = numpy.array([[0, 2, 4], [4, 2, 3]])
+    new_vertices, new_faces = mesh.remove_unused_vertices(vertices, faces)
+    numpy.testing.assert_array_equal(new_vertices[new_faces], vertices[faces])
+    assert len(new_vertices) == 4
+
+
+def test_write_mesh(tmpdir):
+    vertices = numpy.array([[0.1, 2.0, 3.5], [500000.25, 4000000.125, -1.0 / 3], [1, 1, 1]])
+    faces = numpy.array([[0, 1, 2], [2, 1, 0]])
+    header = ['#x offset: 1.5\n']
+
+    obj_path = str(tmpdir.join('mesh.obj'))
+    mesh.write_mesh(obj_path, vertices, faces, header)
+    with open(obj_path) as f:
+        lines = f.readlines()
+    assert lines[0] == header[0]
+    numpy.testing.assert_array_equal(
+        numpy.array([line.split()[1:] for line in lines[1:4]], dtype=float), vertices)
+    assert lines[4:] == ['f 1 2 3\n', 'f 3 2 1\n']
+
+    ply_path = str(tmpdir.join('mesh.ply'))
+    mesh.write_mesh(ply_path, vertices, faces, header)
+    with open(ply_path, 'rb') as f:
+        data = f.read()
+    end = data.index(b'end_header\n') + len(b'end_header\n')
+    header_lines = data[:end].decode('ascii').splitlines()
+    assert 'comment x offset: 1.5' in header_lines
+    assert 'element vertex 3' in header_lines and 'element face 2' in header_lines
+    ply_vertices = numpy.frombuffer(data, '<f8', 9, end).reshape(3, 3)
+    numpy.testing.assert_array_equal(ply_vertices, vertices)
+    ply_faces = numpy.frombuffer(data, [('count', 'u1'), ('index', '<i4', 3)], 2, end + 72)
+    numpy.testing.assert_array_equal(ply_faces['count'], 3)
+    numpy.testing.assert_array_equal(ply_faces['index'], faces)
+
+
+def test_write_mesh_float32(tmpdir):
+    vertices = numpy.array([[0.1, 2.0, 3.5], [747594.7, 4407371.8, -1.0 / 3]], numpy.float32)
+    faces = numpy.array([[0, 1, 1]])
+
+    obj_path = str(tmpdir.join('mesh.obj'))
+    mesh.write_mesh(obj_path, vertices, faces)
+    with open(obj_path) as f:
+        lines = f.readlines()
+    # single precision vertices are written with the digits of a float
+    assert lines[0] == 'v 0.100000001 2 3.5\n'
+    numpy.testing.assert_array_equal(
+        numpy.array([line.split()[1:] for line in lines[:2]], dtype=numpy.float32), vertices)
+
+    ply_path = str(tmpdir.join('mesh.ply'))
+    mesh.write_mesh(ply_path, vertices, faces)
+    with open(ply_path, 'rb') as f:
+        data = f.read()
+    end = data.index(b'end_header\n') + len(b'end_header\n')
+    assert b'property float x' in data[:end]
+    numpy.testing.assert_array_equal(numpy.frombuffer(data, '<f4', 6, end).reshape(2, 3),
+                                     vertices)
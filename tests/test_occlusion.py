@@ -0,0 +1,57 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+from danesfield import occlusion
+
+import numpy
+import pytest
+
+
+def random_points(num_points=20000, shape=(60, 80), seed=0):
+    """Random image points with single precision heights on a coarse grid,
+    so that many points fall on the same pixel and many heights tie
+    """
+    rng = numpy.random.RandomState(seed)
+    img_points = numpy.array([rng.randint(0, shape[1], num_points),
+                              rng.randint(0, shape[0], num_points)])
+    heights = numpy.round(rng.rand(num_points) * 50, 1).astype(numpy.float32)
+    return img_points, heights.astype(numpy.float64)
+
+
+@pytest.mark.parametrize('tolerance', [0.0, 0.5, 1.0])
+def test_zbuffer_matches_sort(tolerance):
+    shape = (60, 80)
+    img_points, heights = random_points(shape=shape)
+    order = numpy.argsort(heights)
+    sorted_mask = occlusion.visible_mask_sort(
+        img_points[:, order], heights[order], shape, tolerance)
+    # the z-buffer does not need sorted points
+    zbuffer_mask = occlusion.visible_mask_zbuffer(img_points, heights, shape, tolerance)
+    assert numpy.array_equal(sorted_mask, zbuffer_mask[order])
+
+
+def test_zbuffer_highest_visible():
+    img_points = numpy.array([[0, 0, 0, 1], [0, 0, 0, 1]])
+    heights = numpy.array([5.0, 10.0, 9.5, 1.0])
+    mask = occlusion.visible_mask_zbuffer(img_points, heights, (2, 2), 1.0)
+    assert mask.tolist() == [False, True, True, True]
+    mask = occlusion.visible_mask_zbuffer(img_points, heights, (2, 2), 0.0)
+    assert mask.tolist() == [False, True, False, True]
+
+
+@pytest.mark.parametrize('engine', sorted(occlusion.ENGINES))
+def test_integer_heights_below_zero(engine):
+    # points below 0 m in separate pixels are all visible
+    img_points = numpy.array([[0, 1], [0, 0]])
+    heights = numpy.array([-10, -5], dtype=numpy.int16)
+    mask = occlusion.get_engine(engine)(img_points, heights, (1, 2), 1.0)
+    assert mask.tolist() == [True, True]
+
+
+def test_get_engine():
+    assert occlusion.get_engine('zbuffer') is occlusion.visible_mask_zbuffer
+    with pytest.raises(ValueError):
+        occlusion.get_engine('raytrace')
@@ -0,0 +1,133 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import os
+import tracemalloc
+
+import numpy
+import pytest
+
+gdal = pytest.importorskip('gdal')
+osr = pytest.importorskip('osr')
+pyproj = pytest.importorskip('pyproj')
+
+from danesfield import ortho  # noqa: E402
+from danesfield.rpc import RPCModel, rpc_to_gdal_dict  # noqa: E402
+
+# origin of the synthetic DSM in UTM zone 17N
+UTM_ORIGIN = (500000.0, 4000000.0)
+
+
+def make_scene(tmpdir, dsm_size=400, image_size=800, seed=0):
+    """Write a synthetic urban DSM, a flat DTM and a source image with a
+    synthetic RPC that has significant height parallax
+    """
+    rng = numpy.random.RandomState(seed)
+    nodata = -9999.0
+    dsm = numpy.full((dsm_size, dsm_size), 10.0)
+    for _ in range(dsm_size // 6):
+        i, j = rng.randint(0, dsm_size - 12, 2)
+        h, w = rng.randint(3, 12, 2)
+        dsm[i:i + h, j:j + w] = 10 + rng.rand() * 40
+    dsm += rng.rand(dsm_size, dsm_size) * 0.3
+    dsm[rng.rand(dsm_size, dsm_size) < 0.01] = nodata
+
+    srs = osr.SpatialReference()
+    srs.SetUTM(17, True)
+    srs.SetWellKnownGeogCS('WGS84')
+    x0, y0 = UTM_ORIGIN
+    transform = (x0, 1.0, 0.0, y0 + dsm_size, 0.0, -1.0)
+    driver = gdal.GetDriverByName('GTiff')
+    paths = {}
+    for name, raster, nd in (('dsm', dsm, nodata),
+                             ('dtm', numpy.full(dsm.shape, 9.0), None)):
+        paths[name] = os.path.join(str(tmpdir), name + '.tif')
+        ds = driver.Create(paths[name], dsm_size, dsm_size, 1, gdal.GDT_Float64)
+        ds.SetProjection(srs.ExportToWkt())
+        ds.SetGeoTransform(transform)
+        band = ds.GetRasterBand(1)
+        if nd is not None:
+            band.SetNoDataValue(nd)
+        band.WriteArray(raster)
+        ds = None
+
+    lon, lat = pyproj.transform(pyproj.Proj(srs.ExportToProj4()),
+                                pyproj.Proj('+proj=longlat +datum=WGS84'),
+                                [x0, x0 + dsm_size], [y0, y0 + dsm_size])
+    model = RPCModel()
+    model.world_offset = numpy.array([numpy.mean(lon), numpy.mean(lat), 30.0])
+    model.world_scale = numpy.array([numpy.ptp(lon) / 2, numpy.ptp(lat) / 2, 50.0])
+    model.image_offset = numpy.array([image_size / 2, image_size / 2])
+    model.image_scale = numpy.array([image_size / 2.4, image_size / 2.4])
+    model.coeff[:] = 0
+    model.coeff[0, [1, 3, 7]] = [1, 0.2, 0.01]
+    model.coeff[1, [0, 1]] = [1, 0.001]
+    model.coeff[2, [2, 3]] = [-1, 0.1]
+    model.coeff[3, 0] = 1
+
+    paths['src'] = os.path.join(str(tmpdir), 'src.tif')
+    ds = driver.Create(paths['src'], image_size, image_size, 3, gdal.GDT_UInt16)
+    ds.SetMetadata(rpc_to_gdal_dict(model), 'RPC')
+    for i in range(3):
+        ds.GetRasterBand(i + 1).WriteArray(
+            rng.randint(1, 60000, (image_size, image_size)).astype(numpy.uint16))
+    ds = None
+    return paths
+
+
+def read_bands(path):
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    return ds.ReadAsArray()
+
+
+def run_ortho(paths, out, **kwargs):
+    tracemalloc.start()
+    ret = ortho.orthorectify(paths['src'], paths['dsm'], out, 1.0, 2,
+                             None, paths['dtm'], **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ret, peak
+
+
+@pytest.mark.parametrize('tile_size', [64, 100])
+def test_tiled_matches_monolithic(tmpdir, tile_size):
+    paths = make_scene(tmpdir)
+    whole = os.path.join(str(tmpdir), 'whole.tif')
+    tiled = os.path.join(str(tmpdir), 'tiled.tif')
+    ret_whole, _ = run_ortho(paths, whole)
+    ret_tiled, _ = run_ortho(paths, tiled, args_tile_size=tile_size)
+    assert ret_whole == ret_tiled
+    assert numpy.array_equal(read_bands(whole), read_bands(tiled))
+
+
+def test_tiled_peak_memory(tmpdir):
+    paths = make_scene(tmpdir, dsm_size=1200, image_size=2400)
+    _, peak_whole = run_ortho(paths, os.path.join(str(tmpdir), 'whole.tif'))
+    _, peak_tiled = run_ortho(paths, os.path.join(str(tmpdir), 'tiled.tif'),
+                              args_max_memory_mb=64)
+    print("peak memory: monolithic {:.0f} MB, tiled {:.0f} MB".format(
+        peak_whole / 2**20, peak_tiled / 2**20))
+    assert peak_tiled < 100 * 2**20
+    assert peak_tiled < peak_whole / 4
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_many_matches_single(tmpdir, jobs):
+    paths = make_scene(tmpdir)
+    # a second source image with different pixels
+    sources = [paths['src'], make_scene(tmpdir.mkdir('other'), seed=1)['src']]
+    singles = [os.path.join(str(tmpdir), 'single{}.tif'.format(i)) for i in range(2)]
+    manys = [os.path.join(str(tmpdir), 'many{}.tif'.format(i)) for i in range(2)]
+    expected = [ortho.orthorectify(src, paths['dsm'], out, 1.0, 2, None, paths['dtm'])
+                for src, out in zip(sources, singles)]
+    ret = ortho.orthorectify_many(sources, paths['dsm'], manys, 1.0, 2,
+                                  dtm_path=paths['dtm'], jobs=jobs)
+    assert ret == expected
+    for single, many in zip(singles, manys):
+        assert numpy.array_equal(read_bands(single), read_bands(many))
+
+    with pytest.raises(RuntimeError):
+        ortho.orthorectify_many(sources, str(tmpdir.join('missing.tif')), manys, jobs=jobs)
@@ -0,0 +1,65 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import json
+import os
+import struct
+
+from danesfield import pointcloud
+
+
+def write_las_header(fpath, minX, maxX, minY, maxY, version=(1, 2)):
+    """A LAS public header block with the given extents and no points"""
+    header = bytearray(227)
+    header[0:4] = b'LASF'
+    header[24:26] = bytes(version)
+    struct.pack_into('<6d', header, 179, maxX, minX, maxY, minY, 30.0, -2.0)
+    with open(fpath, 'wb') as f:
+        f.write(header)
+
+
+def test_las_header_bounds(tmpdir):
+    las_fpath = os.path.join(str(tmpdir), 'tile.las')
+    write_las_header(las_fpath, 500010.5, 500990.25, 4000020.0, 4000980.75, (1, 4))
+    assert pointcloud.las_header_bounds(las_fpath) == (500010.5, 500990.25,
+                                                       4000020.0, 4000980.75)
+    ply_fpath = os.path.join(str(tmpdir), 'tile.ply')
+    with open(ply_fpath, 'w') as f:
+        f.write('ply\nformat ascii 1.0\nend_header\n')
+    assert pointcloud.las_header_bounds(ply_fpath) is None
+
+
+def test_pdal_metadata_bounds():
+    extents = {'minx': 1.0, 'maxx': 2.0, 'miny': 3.0, 'maxy': 4.0}
+    assert pointcloud.pdal_metadata_bounds(
+        json.dumps({'metadata': dict(extents, count=10)})) == (1.0, 2.0, 3.0, 4.0)
+    assert pointcloud.pdal_metadata_bounds(
+        json.dumps({'metadata': {'readers.las': extents}})) == (1.0, 2.0, 3.0, 4.0)
+    assert pointcloud.pdal_metadata_bounds(json.dumps({'metadata': {'count': 10}})) is None
+
+
+def test_point_cloud_bounds_cache(tmpdir):
+    fpaths = [os.path.join(str(tmpdir), 'tile{}.las'.format(i)) for i in range(3)]
+    for i, fpath in enumerate(fpaths):
+        write_las_header(fpath, 10.0 * i, 10.0 * i + 8, -5.0 * i, 20.0)
+    cache_fpath = os.path.join(str(tmpdir), 'bounds.json')
+    bounds = pointcloud.point_cloud_bounds(fpaths, cache_fpath)
+    assert bounds[2] == (20.0, 28.0, -10.0, 20.0)
+    assert pointcloud.union_bounds(bounds) == (0.0, 28.0, -10.0, 20.0)
+
+    # up to date cache entries are used instead of the files
+    with open(cache_fpath) as f:
+        cache = json.load(f)
+    cache['files'][os.path.abspath(fpaths[0])]['bounds'] = [-1.0, 1.0, -1.0, 1.0]
+    with open(cache_fpath, 'w') as f:
+        json.dump(cache, f)
+    assert pointcloud.point_cloud_bounds(fpaths, cache_fpath)[0] == (-1.0, 1.0, -1.0, 1.0)
+
+    # modified files are read again
+    stat = os.stat(fpaths[0])
+    os.utime(fpaths[0], (stat.st_atime, stat.st_mtime + 10))
+    assert pointcloud.point_cloud_bounds(fpaths, cache_fpath)[0] == (0.0, 8.0, 0.0, 20.0)
+    assert pointcloud.point_cloud_bounds(fpaths)[0] == (0.0, 8.0, 0.0, 20.0)
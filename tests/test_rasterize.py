@@ -0,0 +1,92 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import json
+import os
+
+import numpy
+import pytest
+
+gdal = pytest.importorskip('gdal')
+ogr = pytest.importorskip('ogr')
+osr = pytest.importorskip('osr')
+
+from danesfield import rasterize  # noqa: E402
+
+
+def make_reference(tmpdir, size=(100, 120)):
+    """Reference GeoTIFF in UTM zone 17N, with 1m pixels"""
+    srs = osr.SpatialReference()
+    srs.SetUTM(17, True)
+    srs.SetWellKnownGeogCS('WGS84')
+    reference = gdal.GetDriverByName('GTiff').Create(
+        os.path.join(str(tmpdir), 'reference.tif'), size[1], size[0], 1, gdal.GDT_Float32)
+    reference.SetGeoTransform((500000.0, 1.0, 0.0, 4000100.0, 0.0, -1.0))
+    reference.SetProjection(srs.ExportToWkt())
+    return reference
+
+
+def write_roads(fpath):
+    """A horizontal road at row 20.5, and an elevated highway at column 60.5"""
+    def feature(coordinates, **properties):
+        return {'type': 'Feature',
+                'geometry': {'type': 'LineString', 'coordinates': coordinates},
+                'properties': properties}
+
+    features = [feature([[500005.0, 4000079.5], [500115.0, 4000079.5]],
+                        type='residential', bridge=0, **{'class': 'highway'}),
+                feature([[500060.5, 4000095.0], [500060.5, 4000005.0]],
+                        type='primary', bridge=1, **{'class': 'highway'})]
+    with open(fpath, 'w') as f:
+        json.dump({'type': 'FeatureCollection',
+                   'crs': {'type': 'name',
+                           'properties': {'name': 'urn:ogc:def:crs:EPSG::32617'}},
+                   'features': features}, f)
+
+
+def test_rasterize_road_labels(tmpdir):
+    vector_fpath = os.path.join(str(tmpdir), 'roads.geojson')
+    write_roads(vector_fpath)
+    labels = rasterize.rasterize_road_labels(vector_fpath, make_reference(tmpdir))
+    assert labels.shape == (100, 120)
+    assert labels[20, 30] == rasterize.ROAD_LABEL
+    assert labels[50, 60] == rasterize.ELEVATED_ROAD_LABEL
+    # the elevated road takes precedence where they cross
+    assert labels[20, 60] == rasterize.ELEVATED_ROAD_LABEL
+    assert labels[60, 30] == 0
+    assert set(numpy.unique(labels)) == {0, 1, 2}
+
+
+def test_buffer_mask():
+    rng = numpy.random.RandomState(0)
+    mask = numpy.zeros((80, 90), dtype=bool)
+    mask[rng.randint(10, 70, 5), rng.randint(10, 80, 5)] = True
+    radius = 7.5
+    rows, cols = numpy.indices(mask.shape)
+    expected = numpy.zeros(mask.shape, dtype=bool)
+    for r, c in zip(*numpy.nonzero(mask)):
+        expected |= (rows - r) ** 2 + (cols - c) ** 2 <= radius ** 2
+    assert numpy.array_equal(rasterize.buffer_mask(mask, radius), expected)
+    assert not rasterize.buffer_mask(numpy.zeros((5, 5)), 3).any()
+
+
+def test_rasterize_file_buffered_roads(tmpdir):
+    vector_fpath = os.path.join(str(tmpdir), 'roads.geojson')
+    write_roads(vector_fpath)
+    road_fpath = os.path.join(str(tmpdir), 'roads.tif')
+    reference = make_reference(tmpdir)
+    roads, bridges = rasterize.rasterize_file_buffered_roads(
+        vector_fpath, reference, 5, road_raster_filename_out=road_fpath)
+    assert roads[25, 30] and not roads[26, 30]
+    assert bridges[50, 65] and not bridges[50, 66]
+    assert not bridges[25, 30]
+    thin_lines = gdal.Open(road_fpath).GetRasterBand(1).ReadAsArray()
+    assert thin_lines[20, 30] == 1 and thin_lines[25, 30] == 0
+
+    roads, only_bridges = rasterize.rasterize_file_buffered_roads(
+        vector_fpath, reference, 5, roads=False)
+    assert roads is None
+    assert numpy.array_equal(only_bridges, bridges)
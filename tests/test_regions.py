@@ -0,0 +1,118 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+from danesfield import regions
+
+import numpy
+import scipy.ndimage.measurements as ndm
+
+
+def random_label_image(shape=(300, 400), seed=0):
+    """Label image of random rectangles, lines and blobs, some of them
+    merged into larger irregular components
+    """
+    rng = numpy.random.RandomState(seed)
+    mask = numpy.zeros(shape, dtype=bool)
+    for _ in range(150):
+        r, c = rng.randint(0, shape[0]), rng.randint(0, shape[1])
+        h, w = rng.randint(1, 30), rng.randint(1, 30)
+        mask[r:r + h, c:c + w] = True
+    mask |= rng.rand(*shape) > 0.97
+    return ndm.label(mask)[0]
+
+
+def estimate_object_scale(img):
+    """The per-label PCA that segment_by_height.py used"""
+    points = numpy.transpose(img.nonzero())
+    points = points - points.mean(0)
+    s = numpy.linalg.svd(points, compute_uv=False) / len(points) ** 0.5
+    return s / regions.VARIANCE_RATIO ** 0.5
+
+
+def test_region_stats():
+    label_img = random_label_image()
+    stats = regions.region_stats(label_img)
+    assert len(stats) == label_img.max()
+    for s in stats[::7]:
+        rows, cols = numpy.nonzero(label_img == s['label'])
+        assert s['count'] == len(rows)
+        assert abs(s['row'] - rows.mean()) < 1e-9
+        assert abs(s['col'] - cols.mean()) < 1e-9
+        cov = numpy.cov(rows, cols, bias=True)
+        assert abs(s['var_row'] - cov[0, 0]) < 1e-9
+        assert abs(s['var_col'] - cov[1, 1]) < 1e-9
+        assert abs(s['cov'] - cov[0, 1]) < 1e-9
+
+
+def test_object_scales_match_svd():
+    label_img = random_label_image()
+    stats = regions.region_stats(label_img)
+    scales = regions.object_scales(stats)
+    for s, scale in zip(stats, scales):
+        if s['count'] > 1:
+            expected = estimate_object_scale(label_img == s['label'])
+            assert numpy.allclose(scale, expected, atol=1e-6)
+
+
+def test_elongation_filter_keeps_same_labels():
+    label_img = random_label_image(seed=1)
+    # The SVD of a single pixel only has one singular value
+    labels, counts = numpy.unique(label_img, return_counts=True)
+    selected = labels[(labels > 0) & (counts > 1)]
+    stats = regions.region_stats(label_img)
+    ratios = regions.elongation(stats[selected - 1])
+    # Rectangles such as 17x3 pixels have a ratio of exactly 6, which
+    # either computation may round to either side
+    ties = numpy.abs(ratios - 6) < 1e-9
+    assert numpy.count_nonzero(~ties) > 100
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        expected = []
+        for i in selected[~ties]:
+            dim_large, dim_small = estimate_object_scale(label_img == i)
+            if dim_large / dim_small < 6:
+                expected.append(i)
+    kept = selected[~ties][ratios[~ties] < 6]
+    assert len(expected) > 0
+    assert list(kept) == expected
+
+
+def test_region_stats_missing_labels():
+    label_img = numpy.zeros((4, 5), dtype=int)
+    label_img[1, 1:4] = 2
+    stats = regions.region_stats(label_img, num_labels=3)
+    assert list(stats['count']) == [0, 3, 0]
+    assert numpy.isnan(stats['row'][0])
+    assert stats['row'][1] == 1 and stats['col'][1] == 2
+    assert numpy.isinf(regions.elongation(stats)[1])
+
+
+def test_component_stats():
+    label_img = random_label_image(seed=2)
+    stats = regions.component_stats(label_img)
+    region = regions.region_stats(label_img)
+    assert numpy.array_equal(stats['count'], region['count'])
+    assert numpy.allclose(stats['length'], regions.object_scales(region)[:, 0])
+    for s, slices in zip(stats, ndm.find_objects(label_img)):
+        assert (s['row_start'], s['row_stop']) == (slices[0].start, slices[0].stop)
+        assert (s['col_start'], s['col_stop']) == (slices[1].start, slices[1].stop)
+
+
+def test_select_components_matches_loop():
+    label_img = random_label_image(seed=3)
+    stats = regions.component_stats(label_img)
+    ratios = stats['length'] / numpy.maximum(stats['width'], 1e-300)
+    ties = numpy.abs(ratios - 6) < 1e-9
+    # The filter of segment_bridges.py
+    expected = []
+    for s in stats[~ties]:
+        if s['count'] < 64:
+            continue
+        dim_large, dim_small = estimate_object_scale(label_img == s['label'])
+        if dim_small > 0 and dim_large / dim_small < 6:
+            expected.append(s['label'])
+    kept = regions.select_components(stats[~ties], min_count=64, max_elongation=6)
+    assert len(expected) > 0
+    assert list(kept) == expected
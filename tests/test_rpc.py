@@ -88,3 +88,72 @@ def test_rpc_multi_back_projection():
     bp = model.back_project(img_pts, [p[2] for p in points])
     print("diff: ", bp - points)
     assert numpy.max(numpy.abs(bp - points)) < 1e-16
+
+
+def test_rpc_batch_back_projection():
+    model = rpc_from_gdal_dict(rpc_md)
+    img_pts = model.project(points)
+    bp = model.back_project_batch(img_pts, [p[2] for p in points])
+    print("diff: ", bp - points)
+    assert numpy.max(numpy.abs(bp - points)) < 1e-16
+
+
+def test_rpc_batch_back_projection_matches_loop():
+    model = rpc_from_gdal_dict(rpc_md)
+    # a grid of image points spanning the image at a range of elevations
+    samp, line = numpy.meshgrid(numpy.linspace(0, 42500, 25),
+                                numpy.linspace(0, 42955, 25))
+    img_pts = numpy.stack((samp.ravel(), line.ravel()), axis=1)
+    elevs = numpy.linspace(-100, 200, len(img_pts))
+    loop_bp = model.back_project(img_pts, elevs)
+    batch_bp = model.back_project_batch(img_pts, elevs)
+    assert batch_bp.shape == loop_bp.shape
+    assert numpy.max(numpy.abs(batch_bp - loop_bp)) < 1e-12
+
+
+def test_rpc_batch_back_projection_scalar_elev():
+    model = rpc_from_gdal_dict(rpc_md)
+    corners = [[0, 0], [1000, 0], [1000, 1000], [0, 1000]]
+    loop_bp = model.back_project(corners, 30.0)
+    batch_bp = model.back_project_batch(corners, 30.0)
+    assert numpy.max(numpy.abs(batch_bp - loop_bp)) < 1e-12
+
+
+def reference_projection(model, pts):
+    """The projection of each point by the 20-term power vector"""
+    norm_pts = (numpy.asarray(pts) - model.world_offset) / model.world_scale
+    polys = numpy.dot(model.coeff, model.power_vector(norm_pts))
+    img_pts = numpy.array([polys[0] / polys[1], polys[2] / polys[3]])
+    return img_pts.transpose() * model.image_scale + model.image_offset
+
+
+def random_world_points(n=20000, seed=0):
+    """Points spread over the footprint of the sample image"""
+    rng = numpy.random.RandomState(seed)
+    return numpy.stack([rng.uniform(-58.656, -58.5632, n),
+                        rng.uniform(-34.5086, -34.4378, n),
+                        rng.uniform(-50, 150, n)], axis=1)
+
+
+def test_rpc_project_batch_matches_reference():
+    model = rpc_from_gdal_dict(rpc_md)
+    pts = random_world_points()
+    reference = reference_projection(model, pts)
+    for chunk_size in [1, 7, 4096, 100000]:
+        img_pts = model.project_batch(pts, chunk_size=chunk_size)
+        assert img_pts.shape == (len(pts), 2)
+        # within 1e-8 pixels of the reference
+        assert numpy.max(numpy.abs(img_pts - reference)) < 1e-8
+    out = numpy.empty((len(pts), 2))
+    assert model.project_batch(pts, out=out) is out
+    assert numpy.array_equal(model.project(pts), out)
+    assert model.project(points[:1]).shape == (1, 2)
+
+
+def test_rpc_project_batch_float32():
+    model = rpc_from_gdal_dict(rpc_md)
+    pts = random_world_points()
+    img_pts = model.project_batch(pts, dtype=numpy.float32)
+    assert img_pts.dtype == numpy.float32
+    # within 0.05 pixels of the reference, over a 42000 pixel image
+    assert numpy.max(numpy.abs(img_pts - reference_projection(model, pts))) < 0.05
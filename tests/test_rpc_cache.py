@@ -0,0 +1,56 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import os
+
+import numpy
+import pytest
+
+from danesfield import file_cache
+from danesfield import rpc_cache
+from danesfield.rpc import rpc_from_gdal_dict, rpc_to_gdal_dict
+
+from test_rpc import rpc_md, points
+
+
+def test_save_read_rpc_cache(tmpdir):
+    fpath = str(tmpdir.join('image.NTF'))
+    with open(fpath, 'w') as f:
+        f.write('image')
+    model = rpc_from_gdal_dict(rpc_md)
+    key = file_cache.file_key(fpath)
+    cache_fpath = rpc_cache.cache_path(fpath)
+    assert rpc_cache.read_rpc_cache(cache_fpath, key) is None
+
+    rpc_cache.save_rpc(cache_fpath, model, key)
+    cached = rpc_cache.read_rpc_cache(cache_fpath, key)
+    numpy.testing.assert_array_equal(rpc_cache.model_to_array(cached),
+                                     rpc_cache.model_to_array(model))
+    numpy.testing.assert_array_equal(cached.project(points), model.project(points))
+
+    # the sidecar is ignored once the image is modified
+    path, size, mtime = key
+    assert rpc_cache.read_rpc_cache(cache_fpath, (path, size, mtime + 1)) is None
+    assert rpc_cache.read_rpc_cache(cache_fpath, (path, size + 1, mtime)) is None
+    assert rpc_cache.read_rpc_cache(cache_fpath, (path + '2', size, mtime)) is None
+
+
+def test_load_rpc(tmpdir):
+    assert rpc_cache.load_rpc(str(tmpdir.join('missing.NTF'))) is None
+
+    gdal = pytest.importorskip('gdal')
+    fpath = str(tmpdir.join('image.tif'))
+    model = rpc_from_gdal_dict(rpc_md)
+    ds = gdal.GetDriverByName('GTiff').Create(fpath, 16, 16, 1, gdal.GDT_Byte)
+    ds.SetMetadata(rpc_to_gdal_dict(model), 'RPC')
+    ds = None
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    loaded = rpc_cache.load_rpc(fpath, cache_dir)
+    assert os.path.isfile(rpc_cache.cache_path(fpath, cache_dir))
+    cached = rpc_cache.load_rpc(fpath, cache_dir)
+    numpy.testing.assert_allclose(loaded.project(points), model.project(points))
+    numpy.testing.assert_array_equal(cached.project(points), loaded.project(points))
@@ -0,0 +1,199 @@
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+TOOL_PATH = os.path.join(os.path.dirname(__file__), '..', 'tools', 'run_danesfield.py')
+
+
+def load_tool():
+    spec = importlib.util.spec_from_file_location('run_danesfield', TOOL_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write(fpath, text):
+    with open(fpath, 'w') as f:
+        f.write(text)
+
+
+def read(fpath):
+    with open(fpath) as f:
+        return f.read()
+
+
+def copy_step(tool, root, cache_dir, name='copy', outputs=True, suffix=''):
+    """Run a step copying input.txt to output.txt in `root`, returning its metrics"""
+    input_fpath = os.path.join(root, 'input.txt')
+    output_fpath = os.path.join(root, 'output.txt')
+    command = ['sh', '-c', 'cat "$0" > "$1"' + suffix, input_fpath, output_fpath]
+    metrics = {}
+    tool.run_step(os.path.join(root, name), name, command, inputs=[input_fpath],
+                  outputs=[output_fpath] if outputs else (), cache_dir=cache_dir,
+                  root=root, metrics=metrics)
+    return metrics
+
+
+def test_step_cache_restore(tmpdir):
+    tool = load_tool()
+    cache_dir = str(tmpdir.join('cache'))
+    roots = [str(tmpdir.mkdir('work1')), str(tmpdir.mkdir('work2'))]
+    for root in roots:
+        write(os.path.join(root, 'input.txt'), 'heights')
+
+    assert copy_step(tool, roots[0], cache_dir)['status'] == 'ran'
+    # completed steps are skipped
+    assert copy_step(tool, roots[0], cache_dir)['status'] == 'skipped'
+    # a pipeline in another directory restores the outputs
+    assert copy_step(tool, roots[1], cache_dir)['status'] == 'restored'
+    assert read(os.path.join(roots[1], 'output.txt')) == 'heights'
+
+
+def test_step_cache_invalidation(tmpdir):
+    tool = load_tool()
+    cache_dir = str(tmpdir.join('cache'))
+    root = str(tmpdir.mkdir('work'))
+    input_fpath = os.path.join(root, 'input.txt')
+    write(input_fpath, 'heights')
+    assert copy_step(tool, root, cache_dir)['status'] == 'ran'
+
+    # changed input content
+    write(input_fpath, 'other heights')
+    assert copy_step(tool, root, cache_dir)['status'] == 'ran'
+    assert read(os.path.join(root, 'output.txt')) == 'other heights'
+
+    # changed command
+    assert copy_step(tool, root, cache_dir, suffix=' && echo >> "$1"')['status'] == 'ran'
+    assert read(os.path.join(root, 'output.txt')) == 'other heights\n'
+
+    # back to the first input, restored from the cache
+    write(input_fpath, 'heights')
+    assert copy_step(tool, root, cache_dir)['status'] == 'restored'
+    assert read(os.path.join(root, 'output.txt')) == 'heights'
+
+
+def test_step_key_ignores_jobs():
+    tool = load_tool()
+    command = ['python', 'fit_dtm.py', 'dsm.tif', 'dtm.tif']
+    key = tool.step_key(command)
+    assert tool.step_key(command + ['--jobs', '8']) == key
+    assert tool.step_key(command[:2] + ['-j', '4'] + command[2:]) == key
+    assert tool.step_key(command + ['--jobs=8']) == key
+    assert tool.step_key(command + ['--tile-size', '8']) != key
+
+
+def test_step_without_outputs_not_cached(tmpdir):
+    tool = load_tool()
+    cache_dir = str(tmpdir.join('cache'))
+    roots = [str(tmpdir.mkdir('work1')), str(tmpdir.mkdir('work2'))]
+    for root in roots:
+        write(os.path.join(root, 'input.txt'), 'heights')
+        assert copy_step(tool, root, cache_dir, outputs=False)['status'] == 'ran'
+        assert read(os.path.join(root, 'output.txt')) == 'heights'
+    assert not os.path.isdir(cache_dir) or not os.listdir(cache_dir)
+
+
+def test_step_dependencies():
+    tool = load_tool()
+    steps = [tool.Step('work', 'dsm', 'true', inputs=['points.las'], outputs=['dsm.tif']),
+             tool.Step('dtm', 'dtm', 'true', inputs=['dsm.tif'], outputs=['dtm.tif']),
+             tool.Step('work', 'cls', 'true', inputs=['./dsm.tif', 'dtm.tif'],
+                       outputs=['cls.tif', 'roads.tif']),
+             tool.Step('work', 'meshes', 'true', inputs=['cls.tif'], outputs=['meshes'])]
+    assert tool.step_dependencies(steps) == {'dsm': set(), 'dtm': {'dsm'},
+                                             'cls': {'dsm', 'dtm'}, 'meshes': {'cls'}}
+
+
+def wait_for_step(tool, root, name, other, output_fpath):
+    """A step that only completes if the step `other` runs at the same time"""
+    start_fpath = os.path.join(root, name + '.start')
+    command = ['sh', '-c', 'touch "$0"; i=0; while [ ! -e "$1" ]; do '
+               'sleep 0.05; i=$((i + 1)); [ $i -gt 200 ] && exit 1; done; '
+               'echo "$2" > "$3"',
+               start_fpath, os.path.join(root, other + '.start'), name, output_fpath]
+    return tool.Step(os.path.join(root, name), name, command, outputs=[output_fpath])
+
+
+def test_run_steps_parallel(tmpdir):
+    tool = load_tool()
+    root = str(tmpdir)
+    a, b, c = (os.path.join(root, name + '.txt') for name in 'abc')
+    steps = [wait_for_step(tool, root, 'a', 'b', a),
+             wait_for_step(tool, root, 'b', 'a', b),
+             tool.Step(os.path.join(root, 'c'), 'c',
+                       ['sh', '-c', 'cat "$0" "$1" > "$2"', a, b, c],
+                       inputs=[a, b], outputs=[c])]
+    tool.run_steps(steps, jobs=2)
+    # c runs once both a and b, which ran concurrently, are done
+    assert read(c) == 'a\nb\n'
+
+
+@pytest.mark.parametrize('abort_on_error', [True, False])
+def test_run_steps_abort_on_error(tmpdir, abort_on_error):
+    tool = load_tool()
+    root = str(tmpdir)
+    failed_output = os.path.join(root, 'failed.txt')
+    outputs = [os.path.join(root, name + '.txt') for name in ('independent', 'dependent')]
+    steps = [tool.Step(os.path.join(root, 'failed'), 'failed', 'false',
+                       outputs=[failed_output], abort_on_error=abort_on_error),
+             tool.Step(os.path.join(root, 'independent'), 'independent',
+                       ['touch', outputs[0]], outputs=[outputs[0]]),
+             tool.Step(os.path.join(root, 'dependent'), 'dependent',
+                       ['touch', outputs[1]], inputs=[failed_output], outputs=[outputs[1]])]
+    if abort_on_error:
+        with pytest.raises(SystemExit):
+            tool.run_steps(steps, jobs=2)
+        # the running steps finish, but no step is started after the failure
+        assert not os.path.exists(outputs[1])
+    else:
+        tool.run_steps(steps, jobs=2)
+        assert os.path.exists(outputs[1])
+    assert os.path.exists(outputs[0])
+    assert os.path.isfile(os.path.join(root, 'failed', 'failed.exitstatus.1'))
+
+
+def test_step_metrics(tmpdir):
+    tool = load_tool()
+    if not tool.read_proc_io(os.getpid()):
+        pytest.skip('/proc/<pid>/io is not available')
+    root = str(tmpdir)
+    output_fpath = os.path.join(root, 'output.bin')
+    # allocate and write 8 MB, taking a few RSS samples
+    command = [sys.executable, '-c',
+               'import sys, time; data = bytearray(8 << 20); time.sleep(0.3); '
+               'open(sys.argv[1], "wb").write(data)', output_fpath]
+    metrics = {}
+    tool.run_step(os.path.join(root, 'write'), 'write', command, outputs=[output_fpath],
+                  metrics=metrics)
+    metrics_fpath = os.path.join(root, 'pipeline_metrics.json')
+    tool.write_pipeline_metrics(metrics_fpath, [metrics, {'step': 'done', 'status': 'skipped',
+                                                          'returncode': 0}], 1.5, 2)
+    with open(metrics_fpath) as f:
+        written = json.load(f)
+    assert written['wall_time'] == 1.5 and written['jobs'] == 2
+    step = written['steps'][0]
+    assert step['step'] == 'write' and step['status'] == 'ran' and step['returncode'] == 0
+    assert 0.3 <= step['wall_time'] < 10
+    assert step['user_time'] + step['system_time'] > 0
+    assert step['max_rss'] >= 8 << 20
+    assert step['peak_sampled_rss'] > 0 and len(step['rss_samples']) >= 1
+    assert step['io']['wchar'] >= 8 << 20
+    assert step['output_files'] == 1 and step['output_bytes'] == 8 << 20
+
+    lines = tool.format_metrics_table(written['steps']).splitlines()
+    assert lines[0].split() == ['step', 'status', 'wall', 's', 'cpu', 's', 'max', 'rss', 'MB',
+                                'read', 'MB', 'write', 'MB', 'output', 'MB']
+    assert set(lines[1]) == {'-'} and len(lines[1]) == len(lines[0])
+    row = lines[2].split()
+    assert row[:2] == ['write', 'ran'] and row[-1] == '8' and row[-2] == '8'
+    assert lines[3].split() == ['done', 'skipped'] + ['-'] * 6
+    assert lines[4].split()[0] == 'total'
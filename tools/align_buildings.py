@@ -388,21 +388,14 @@ def main(args):
                 print("Rasterizing bridges ...")
                 outputNoExt = os.path.splitext(args.output_mask)[0]
                 input = os.path.basename(outputNoExt + "_" + VECTOR_TYPES[i] + ".shp")
-                output = os.path.basename(outputNoExt + "_" + VECTOR_TYPES[i] + "_bridges.tif")
-                bridges = rasterize.rasterize_file_dilated_line(
-                    input, inputImage, output,
-                    numpy.ones((3, 3)), dilation_iterations=20,
-                    query=rasterize.ELEVATED_ROADS_QUERY,
-                )
-                if not args.debug:
-                    os.remove(output)
-                if args.render_roads:
-                    output = os.path.basename(outputNoExt + "_" + VECTOR_TYPES[i] + "_roads.tif")
-                    roads = rasterize.rasterize_file_dilated_line(
-                        input, inputImage, output,
-                        numpy.ones((3, 3)), dilation_iterations=20, query=rasterize.ROADS_QUERY)
-                    if not args.debug:
-                        os.remove(output)
+                # Thin line rasters are only written for debugging
+                roads, bridges = rasterize.rasterize_file_buffered_roads(
+                    input, inputImage, 20,
+                    os.path.basename(outputNoExt + "_" + VECTOR_TYPES[i] + "_roads.tif")
+                    if args.debug else None,
+                    os.path.basename(outputNoExt + "_" + VECTOR_TYPES[i] + "_bridges.tif")
+                    if args.debug else None,
+                    query=rasterize.ROADS_QUERY, roads=args.render_roads)
                 buildingsData = gdal_utils.gdal_open(
                     os.path.basename(outputNoExt + "_" + VECTOR_TYPES[0] + ".tif"),
                     gdal.GA_ReadOnly)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""
+Benchmark DTM fitting on a synthetic DSM of rolling terrain with buildings,
+either for several numbers of threads, with --tolerance for several
+convergence tolerances against the full schedule of iterations, with
+--memory for the float32 and in-place memory modes, or with --tile-size
+for out of core fitting by tiles.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+import danesfield.dtm
+
+
+def synthetic_dsm(rows, cols, nodata=-9999, seed=0):
+    """
+    Rolling terrain with box shaped buildings of 8 to 40 pixels and a few
+    no-data pixels.
+    """
+    rng = numpy.random.RandomState(seed)
+    r, c = numpy.indices((rows, cols))
+    dsm = 100 + 10 * numpy.sin(r / 150.0) + 8 * numpy.cos(c / 200.0)
+    for _ in range(rows * cols // 4000):
+        i, j = rng.randint(0, rows - 40), rng.randint(0, cols - 40)
+        h, w = rng.randint(8, 40, 2)
+        dsm[i:i + h, j:j + w] += rng.uniform(5, 40)
+    dsm = dsm.astype(numpy.float32)
+    dsm[rng.rand(rows, cols) < 0.001] = nodata
+    return dsm
+
+
+def fit_dtm(dsm, args, jobs=1, tolerance=None, dtype=None, inplace=False):
+    """
+    Fit a DTM, returning the estimator, the DTM and the elapsed time.
+    """
+    estimator = danesfield.dtm.DTMEstimator(-9999, args.num_iterations, args.tension,
+                                            num_workers=jobs, tolerance=tolerance,
+                                            dtype=dtype, inplace=inplace)
+    start = time.time()
+    dtm = estimator.fit_dtm(dsm)
+    return estimator, dtm, time.time() - start
+
+
+def pixel_iterations(estimator):
+    """
+    Total work of a fit, as the number of outer iterations times the
+    number of pixels summed over the pyramid levels.
+    """
+    return sum(s['iterations'] * s['shape'][0] * s['shape'][1]
+               for s in estimator.level_stats)
+
+
+def benchmark_tolerances(dsm, args):
+    valid = dsm != -9999
+    estimator, reference, ref_time = fit_dtm(dsm, args, args.jobs[0])
+    ref_work = pixel_iterations(estimator)
+    print("full schedule: {:.2f} s, iterations per level (coarse to fine) {}".format(
+        ref_time, [s['iterations'] for s in estimator.level_stats]))
+    print("{:>10} {:>10} {:>10} {:>12} {:>10} {:>10}  {}".format(
+        "tolerance", "time (s)", "speedup", "work saved", "rms diff", "max diff",
+        "iterations per level"))
+    for tolerance in args.tolerance:
+        estimator, dtm, elapsed = fit_dtm(dsm, args, args.jobs[0], tolerance)
+        diff = (dtm - reference)[valid]
+        print("{:>10g} {:>10.2f} {:>10.2f} {:>11.1f}% {:>10.3g} {:>10.3g}  {}".format(
+            tolerance, elapsed, ref_time / elapsed,
+            100 * (1 - pixel_iterations(estimator) / ref_work),
+            numpy.sqrt(numpy.mean(diff ** 2)), numpy.abs(diff).max(),
+            [s['iterations'] for s in estimator.level_stats]))
+
+
+def benchmark_memory(dsm, args):
+    """
+    Compare the peak memory allocated while fitting, not counting the
+    input DSM, and the time of the memory modes on a float64 DSM.
+    """
+    dsm = dsm.astype(numpy.float64)
+    valid = dsm != -9999
+    mb = 1024 * 1024
+    print("{:>18} {:>10} {:>10} {:>14} {:>10}".format(
+        "mode", "time (s)", "speedup", "peak (MB)", "max diff"))
+    reference = None
+    for name, dtype, inplace in (("float64", None, False),
+                                 ("float64 inplace", None, True),
+                                 ("float32", numpy.float32, False),
+                                 ("float32 inplace", numpy.float32, True)):
+        # time without tracing allocations, which slows them down
+        estimator, dtm, elapsed = fit_dtm(dsm, args, args.jobs[0], dtype=dtype,
+                                          inplace=inplace)
+        del dtm
+        tracemalloc.start()
+        estimator, dtm, _ = fit_dtm(dsm, args, args.jobs[0], dtype=dtype, inplace=inplace)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if reference is None:
+            reference = (dtm, elapsed)
+        print("{:>18} {:>10.2f} {:>10.2f} {:>14.0f} {:>10.3g}".format(
+            name, elapsed, reference[1] / elapsed, peak / mb,
+            numpy.abs(dtm - reference[0])[valid].max()))
+
+
+def benchmark_tiled(dsm, args):
+    """
+    Compare fitting in memory to fitting by tiles of several sizes, with
+    the DSM and DTM in memory mapped files as they would be on disk.
+    """
+    valid = dsm != -9999
+    mb = 1024 * 1024
+    print("{:>10} {:>10} {:>14} {:>10}".format("tile size", "time (s)", "peak (MB)",
+                                               "max diff"))
+    tracemalloc.start()
+    _, reference, elapsed = fit_dtm(dsm, args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{:>10} {:>10.2f} {:>14.0f} {:>10}".format("none", elapsed, peak / mb, 0))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = numpy.memmap(os.path.join(temp_dir, 'dsm.dat'), dsm.dtype, 'w+',
+                              shape=dsm.shape)
+        source[:] = dsm
+        dtm = numpy.memmap(os.path.join(temp_dir, 'dtm.dat'), dsm.dtype, 'w+',
+                           shape=dsm.shape)
+
+        def read_dsm(row, col, rows, cols, factor):
+            return numpy.array(source[row * factor::factor, col * factor::factor][:rows, :cols])
+
+        def write_dtm(row, col, tile):
+            dtm[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+
+        for tile_size in args.tile_size:
+            estimator = danesfield.dtm.DTMEstimator(-9999, args.num_iterations, args.tension)
+            tracemalloc.start()
+            start = time.time()
+            estimator.fit_dtm_tiled(read_dsm, write_dtm, dsm.shape, tile_size, temp_dir)
+            elapsed = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("{:>10} {:>10.2f} {:>14.0f} {:>10.3g}".format(
+                tile_size, elapsed, peak / mb, numpy.abs(dtm - reference)[valid].max()))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, nargs=2, default=[4000, 4000],
+                        metavar=("ROWS", "COLS"), help="Size of the synthetic DSM")
+    parser.add_argument('-n', "--num-iterations", type=int, default=100,
+                        help="Base number of iteration at the coarsest scale")
+    parser.add_argument('-t', "--tension", type=int, default=10,
+                        help="Number of inner smoothing iterations")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Numbers of threads to benchmark")
+    parser.add_argument("--tolerance", type=float, nargs="+",
+                        help="Convergence tolerances to benchmark, using the first "
+                             "number of threads")
+    parser.add_argument("--memory", action="store_true",
+                        help="Benchmark the float32 and in-place memory modes, using "
+                             "the first number of threads")
+    parser.add_argument("--tile-size", type=int, nargs="+",
+                        help="Tile sizes of out of core fitting to benchmark")
+    args = parser.parse_args(args)
+
+    dsm = synthetic_dsm(*args.size)
+    print("DSM raster shape {}".format(dsm.shape))
+    if args.tolerance:
+        benchmark_tolerances(dsm, args)
+        return
+    if args.memory:
+        benchmark_memory(dsm, args)
+        return
+    if args.tile_size:
+        benchmark_tiled(dsm, args)
+        return
+    print("{:>6} {:>10} {:>8} {:>12}".format("jobs", "time (s)", "speedup", "max diff"))
+    reference = None
+    for jobs in args.jobs:
+        estimator, dtm, elapsed = fit_dtm(dsm, args, jobs)
+        if reference is None:
+            reference = (dtm, elapsed)
+        print("{:>6} {:>10.2f} {:>8.2f} {:>12.3g}".format(
+            jobs, elapsed, reference[1] / elapsed, numpy.abs(dtm - reference[0]).max()))
+
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(1)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+"""
+Benchmark merge_raw_obj_meshes on synthetic OBJ meshes of grids of
+triangles, against the previous merge that read every mesh in memory and
+offset the faces line by line.
+"""
+
+import argparse
+import filecmp
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+import merge_raw_obj_meshes
+from danesfield import mesh
+
+
+def synthetic_meshes(directory, num_meshes, faces_per_mesh, seed=0):
+    """Write meshes of square grids of triangles with an offset header"""
+    rng = numpy.random.RandomState(seed)
+    side = int(numpy.sqrt(faces_per_mesh / 2)) + 1
+    faces = mesh.grid_faces(side, side)
+    header = ["#x offset: 747594.5\n", "#y offset: 4407371.25\n", "#z offset: 225.0\n"]
+    paths = []
+    for i in range(num_meshes):
+        vertices = numpy.zeros((side * side, 3))
+        vertices[:, :2] = numpy.indices((side, side)).reshape(2, -1).T + rng.rand(2) * 1000
+        vertices[:, 2] = rng.rand(side * side) * 30
+        paths.append(os.path.join(directory, "{}.obj".format(i)))
+        mesh.write_obj(paths[-1], vertices, faces, header)
+    return paths, num_meshes * len(faces)
+
+
+def merge_in_memory(mesh_files, output_file):
+    """The previous merge: read all the lines and offset each face line"""
+    merged_lines = []
+    current_nb_vertices = 0
+    for filename in mesh_files:
+        with open(filename) as f:
+            lines = f.readlines()
+        nb_vertices = 0
+        for i in range(len(lines)):
+            if lines[i][0] == "v":
+                nb_vertices += 1
+            elif lines[i][0] == "f":
+                f = list(map(lambda x: str(int(x) + current_nb_vertices),
+                             lines[i].split(" ")[1:]))
+                lines[i] = " ".join(["f"] + f)+"\n"
+        current_nb_vertices += nb_vertices
+        merged_lines += lines[3:]
+    offset_lines = merged_lines and lines[:3]
+    with open(output_file, "w") as out:
+        out.writelines(offset_lines + merged_lines)
+
+
+def measure(function, args, memory=False):
+    """
+    Run a function, returning the elapsed time and, if memory is True,
+    the peak traced memory in MB.  Tracing slows down the function.
+    """
+    if memory:
+        tracemalloc.start()
+    start = time.time()
+    function(*args)
+    elapsed = time.time() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Benchmark merging OBJ meshes with merge_raw_obj_meshes")
+    parser.add_argument("--faces", type=int, default=1000000,
+                        help="Total number of faces of the meshes")
+    parser.add_argument("--meshes", type=int, default=10, help="Number of meshes")
+    parser.add_argument("--memory", action="store_true",
+                        help="Also merge with memory tracing to report the peak memory")
+    args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths, num_faces = synthetic_meshes(directory, args.meshes, args.faces // args.meshes)
+        size = sum(os.path.getsize(p) for p in paths) / 2**20
+        print("{} meshes, {} faces, {:.0f} MB".format(len(paths), num_faces, size))
+        reference = os.path.join(directory, "reference.out")
+        merged = os.path.join(directory, "merged.out")
+        for name, function, output in (
+                ("in memory", merge_in_memory, reference),
+                ("streaming", lambda p, o: merge_raw_obj_meshes.merge_files(p, o, True),
+                 merged)):
+            elapsed, _ = measure(function, (paths, output))
+            line = "{:>10}: {:.2f} s".format(name, elapsed)
+            if args.memory:
+                line += ", peak memory {:.0f} MB".format(measure(function, (paths, output),
+                                                                 True)[1])
+            print(line)
+        print("identical output: {}".format(filecmp.cmp(reference, merged, shallow=False)))
+
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(1)
@@ -18,6 +18,65 @@ from vtk.numpy_interface import dataset_adapter as dsa
 from vtk.util import numpy_support
 from danesfield import gdal_utils
 
+# labels for no building, buildings and elevated roads
+BACKGROUND_LABEL = 2
+LABELS = [6, 17]
+
+# names of the point arrays rendered for the CLS and building IDs rasters
+LABEL_ARRAY = "Label"
+BUILDING_ID_ARRAY = "BuildingId"
+
+
+def add_building_id(poly, buildingId):
+    """Add a point array with the ID of the building to its polydata
+    """
+    ids = numpy_support.numpy_to_vtk(
+        numpy.full(poly.GetNumberOfPoints(), buildingId, numpy.float32), deep=1)
+    ids.SetName(BUILDING_ID_ARRAY)
+    poly.GetPointData().AddArray(ids)
+
+
+def create_raster(dtm, fileName, eType):
+    """Create a raster with the size and georeference of the DTM
+    """
+    dtmDriver = dtm.GetDriver()
+    projection = dtm.GetProjection()
+    options = ["COMPRESS=DEFLATE"]
+    # ensure that space will be reserved for geographic corner coordinates
+    # (in DMS) to be set later
+    if (dtmDriver.ShortName == "NITF" and not projection):
+        options.append("ICORDS=G")
+    raster = dtmDriver.Create(
+        fileName, xsize=dtm.RasterXSize,
+        ysize=dtm.RasterYSize, bands=1, eType=eType,
+        options=options)
+    if (projection):
+        # georeference through affine geotransform
+        raster.SetProjection(projection)
+        raster.SetGeoTransform(dtm.GetGeoTransform())
+    else:
+        # georeference through GCPs
+        raster.SetGCPs(dtm.GetGCPs(), dtm.GetGCPProjection())
+    return raster
+
+
+def render_array(renWin, ren, valuePass, arrayName, size):
+    """
+    Render a cell array of the scene with the value pass and return it as
+    an image of the given (x, y) size, NaN where there is no building.
+    """
+    valuePass.SetInputArrayToProcess(vtk.VTK_SCALAR_MODE_USE_CELL_FIELD_DATA, arrayName)
+    renWin.Render()
+    valuesFlat = numpy_support.vtk_to_numpy(valuePass.GetFloatImageDataArray(ren))
+    # VTK X,Y corresponds to numpy cols,rows. VTK stores arrays
+    # in Fortran order.
+    valuesTranspose = numpy.reshape(valuesFlat, size, "F")
+    # changes from cols, rows to rows,cols.
+    values = numpy.transpose(valuesTranspose)
+    # numpy rows increase as you go down, Y for VTK images increases as you go up.
+    # Copy as the buffer of the value pass is reused by the next render.
+    return numpy.flip(values, 0).copy()
+
 
 def main(args):
     parser = argparse.ArgumentParser(
@@ -38,11 +97,24 @@ def main(args):
     parser.add_argument("--render_cls", action="store_true",
                         help="Render a buildings mask: render buildings label (6), "
                              "background (2) and no DTM.")
+    parser.add_argument("--output_cls", type=str,
+                        help="Also write the buildings mask described for --render_cls "
+                             "to this file, rendered from the same scene as the DSM.")
+    parser.add_argument("--output_building_ids", type=str,
+                        help="Also write a raster of building IDs to this file: the "
+                             "1-based index of the OBJ file of the building in "
+                             "--input_obj_paths, 0 for no building.")
+    parser.add_argument("--tile_size", type=int, default=4096,
+                        help="The DSM is rendered by tiles of at most this size in pixels, "
+                             "which bounds the size of the render window and the memory "
+                             "used.")
     parser.add_argument("--buildings_only", action="store_true",
                         help="Do not use the DTM, use only the buildings.")
     parser.add_argument("--debug", action="store_true",
                         help="Save intermediate results")
     args = parser.parse_args(args)
+    if (args.output_cls or args.output_building_ids) and (args.render_png or args.render_cls):
+        parser.error("--output_cls and --output_building_ids require rendering a DSM")
 
     # open the DTM
     dtm = gdal.Open(args.input_dtm, gdal.GA_ReadOnly)
@@ -57,32 +129,16 @@ def main(args):
         print("Create destination image "
               "size:({}, {}) ...".format(dtm.RasterXSize,
                                          dtm.RasterYSize))
-        # georeference information
-        projection = dtm.GetProjection()
         transform = dtm.GetGeoTransform()
-        gcpProjection = dtm.GetGCPProjection()
-        gcps = dtm.GetGCPs()
-        options = ["COMPRESS=DEFLATE"]
-        # ensure that space will be reserved for geographic corner coordinates
-        # (in DMS) to be set later
-        if (dtmDriver.ShortName == "NITF" and not projection):
-            options.append("ICORDS=G")
         if args.render_cls:
             eType = gdal.GDT_Byte
         else:
             eType = gdal.GDT_Float32
-        dsm = dtmDriver.Create(
-            args.output_dsm, xsize=dtm.RasterXSize,
-            ysize=dtm.RasterYSize, bands=1, eType=eType,
-            options=options)
-        if (projection):
-            # georeference through affine geotransform
-            dsm.SetProjection(projection)
-            dsm.SetGeoTransform(transform)
-        else:
-            # georeference through GCPs
-            dsm.SetGCPs(gcps, gcpProjection)
-            gdal.GCPsToGeoTransform(gcps, transform)
+        dsm = create_raster(dtm, args.output_dsm, eType)
+        cls = create_raster(dtm, args.output_cls, gdal.GDT_Byte) if args.output_cls else None
+        buildingIds = None
+        if args.output_building_ids:
+            buildingIds = create_raster(dtm, args.output_building_ids, gdal.GDT_UInt32)
         corners = [[0, 0], [0, dtm.RasterYSize],
                    [dtm.RasterXSize, dtm.RasterYSize], [dtm.RasterXSize, 0]]
         geoCorners = numpy.zeros((4, 2))
@@ -98,16 +154,14 @@ def main(args):
         dtmBounds[3] = numpy.max(geoCorners[:, 1])
 
         if args.render_cls:
-            # label for no building
-            dtmRaster = numpy.full([dtm.RasterYSize, dtm.RasterXSize], 2)
             nodata = 0
         else:
-            print("Reading the DTM {} size: ({}, {})\n"
+            # the DTM is read by tiles while rendering
+            print("DTM {} size: ({}, {})\n"
                   "\tbounds: ({}, {}), ({}, {})...".format(
                       args.input_dtm, dtm.RasterXSize, dtm.RasterYSize,
                       dtmBounds[0], dtmBounds[1],
                       dtmBounds[2], dtmBounds[3]))
-            dtmRaster = dtm.GetRasterBand(1).ReadAsArray()
             nodata = dtm.GetRasterBand(1).GetNoDataValue()
         print("Nodata: {}".format(nodata))
     else:
@@ -115,13 +169,12 @@ def main(args):
 
     # read the buildings polydata, set Z as a scalar and project to XY plane
     print("Reading the buildings ...")
-    # labels for buildings and elevated roads
-    labels = [6, 17]
     if (args.input_vtp_path and os.path.isfile(args.input_vtp_path)):
         polyReader = vtk.vtkXMLPolyDataReader()
         polyReader.SetFileName(args.input_vtp_path)
         polyReader.Update()
         polyVtkList = [polyReader.GetOutput()]
+        add_building_id(polyVtkList[0], 1)
     elif (args.input_obj_paths):
         # buildings start with numbers
         # optional elevated roads start with Road*.obj
@@ -143,6 +196,8 @@ def main(args):
         else:
             raise RuntimeError("No OBJ files found in {}".format(args.input_obj_paths))
         polyVtkList = []
+        # IDs follow the order of the files in input_obj_paths
+        fileIds = {fileName: i + 1 for i, fileName in enumerate(args.input_obj_paths)}
         for category in range(len(files)):
             append = vtk.vtkAppendPolyData()
             for i, fileName in enumerate(files[category]):
@@ -157,7 +212,10 @@ def main(args):
                 transformFilter = vtk.vtkTransformFilter()
                 transformFilter.SetTransform(transform)
                 transformFilter.SetInputConnection(objReader.GetOutputPort())
-                append.AddInputConnection(transformFilter.GetOutputPort())
+                transformFilter.Update()
+                building = transformFilter.GetOutput()
+                add_building_id(building, fileIds[fileName])
+                append.AddInputDataObject(building)
             append.Update()
             polyVtkList.append(append.GetOutput())
     else:
@@ -170,10 +228,15 @@ def main(args):
         polyElevation = poly.Points[:, 2]
         if args.render_cls:
             # label for buildings
-            polyElevation[:] = labels[category]
+            polyElevation[:] = LABELS[category]
         polyElevationVtk = numpy_support.numpy_to_vtk(polyElevation)
         polyElevationVtk.SetName(arrayName)
         poly.PointData.SetScalars(polyElevationVtk)
+        if cls is not None:
+            polyLabelVtk = numpy_support.numpy_to_vtk(
+                numpy.full(len(polyElevation), LABELS[category], numpy.float32), deep=1)
+            polyLabelVtk.SetName(LABEL_ARRAY)
+            poly.PointData.AddArray(polyLabelVtk)
         append.AddInputDataObject(polyVtkList[category])
     append.Update()
 
@@ -181,7 +244,6 @@ def main(args):
     ren = vtk.vtkRenderer()
     renWin = vtk.vtkRenderWindow()
     renWin.OffScreenRenderingOn()
-    renWin.SetSize(dtm.RasterXSize, dtm.RasterYSize)
     renWin.SetMultiSamples(0)
     renWin.AddRenderer(ren)
 
@@ -211,6 +273,7 @@ def main(args):
 
     if (args.render_png):
         print("Render into a PNG ...")
+        renWin.SetSize(dtm.RasterXSize, dtm.RasterYSize)
         # Show the terrain.
         print("Converting the DTM into a surface ...")
         # read the DTM as a VTK object
@@ -275,19 +338,20 @@ def main(args):
         writerPng.SetInputConnection(windowToImageFilter.GetOutputPort())
         writerPng.Write()
     else:
-        print("Render into a floating point buffer ...")
+        # render tiles of the DTM grid, each one with a camera covering
+        # its sub-window, so that the window never exceeds the tile size
+        tileSize = [min(args.tile_size, dtm.RasterXSize), min(args.tile_size, dtm.RasterYSize)]
+        print("Render into a floating point buffer by tiles of {} ...".format(tileSize))
+        renWin.SetSize(tileSize[0], tileSize[1])
+        pixelSize = [(dtmBounds[1] - dtmBounds[0]) / dtm.RasterXSize,
+                     (dtmBounds[3] - dtmBounds[2]) / dtm.RasterYSize]
 
         ren.ResetCamera()
         camera = ren.GetActiveCamera()
         camera.ParallelProjectionOn()
-        camera.SetParallelScale((dtmBounds[3] - dtmBounds[2])/2)
+        camera.SetParallelScale(tileSize[1] * pixelSize[1] / 2)
         distance = camera.GetDistance()
-        focalPoint = [(dtmBounds[0] + dtmBounds[1]) * 0.5,
-                      (dtmBounds[3] + dtmBounds[2]) * 0.5,
-                      (buildingsScalarRange[0] + buildingsScalarRange[1]) * 0.5]
-        position = [focalPoint[0], focalPoint[1], focalPoint[2] + distance]
-        camera.SetFocalPoint(focalPoint)
-        camera.SetPosition(position)
+        focalZ = (buildingsScalarRange[0] + buildingsScalarRange[1]) * 0.5
 
         valuePass = vtk.vtkValuePass()
         valuePass.SetRenderingMode(vtk.vtkValuePass.FLOATING_POINT)
@@ -302,29 +366,49 @@ def main(args):
         cameraPass = vtk.vtkCameraPass()
         cameraPass.SetDelegatePass(sequence)
         ren.SetPass(cameraPass)
-        # We have to render the points first, otherwise we get a segfault.
-        renWin.Render()
-        valuePass.SetInputArrayToProcess(vtk.VTK_SCALAR_MODE_USE_CELL_FIELD_DATA, arrayName)
-        renWin.Render()
-        elevationFlatVtk = valuePass.GetFloatImageDataArray(ren)
-        valuePass.ReleaseGraphicsResources(renWin)
 
-        print("Writing the DSM ...")
-        elevationFlat = numpy_support.vtk_to_numpy(elevationFlatVtk)
-        # VTK X,Y corresponds to numpy cols,rows. VTK stores arrays
-        # in Fortran order.
-        elevationTranspose = numpy.reshape(
-            elevationFlat, [dtm.RasterXSize, dtm.RasterYSize], "F")
-        # changes from cols, rows to rows,cols.
-        elevation = numpy.transpose(elevationTranspose)
-        # numpy rows increase as you go down, Y for VTK images increases as you go up
-        elevation = numpy.flip(elevation, 0)
-        if args.buildings_only:
-            dsmElevation = elevation
-        else:
-            # elevation has nans in places other than buildings
-            dsmElevation = numpy.fmax(dtmRaster, elevation)
-        dsm.GetRasterBand(1).WriteArray(dsmElevation)
+        for row in range(0, dtm.RasterYSize, tileSize[1]):
+            for col in range(0, dtm.RasterXSize, tileSize[0]):
+                focalPoint = [dtmBounds[0] + (col + tileSize[0] * 0.5) * pixelSize[0],
+                              dtmBounds[3] - (row + tileSize[1] * 0.5) * pixelSize[1],
+                              focalZ]
+                position = [focalPoint[0], focalPoint[1], focalPoint[2] + distance]
+                camera.SetFocalPoint(focalPoint)
+                camera.SetPosition(position)
+                if row == 0 and col == 0:
+                    # We have to render the points first, otherwise we get a segfault.
+                    renWin.Render()
+                # tiles on the right and bottom edges are cropped to the DTM
+                rows = min(tileSize[1], dtm.RasterYSize - row)
+                cols = min(tileSize[0], dtm.RasterXSize - col)
+                elevation = render_array(
+                    renWin, ren, valuePass, arrayName, tileSize)[:rows, :cols]
+                # the other rasters are rendered from the same scene, only the
+                # rendered array changes
+                if cls is not None:
+                    label = render_array(
+                        renWin, ren, valuePass, LABEL_ARRAY, tileSize)[:rows, :cols]
+                    if not args.buildings_only:
+                        label = numpy.fmax(BACKGROUND_LABEL, label)
+                    cls.GetRasterBand(1).WriteArray(label, col, row)
+                if buildingIds is not None:
+                    ids = render_array(
+                        renWin, ren, valuePass, BUILDING_ID_ARRAY, tileSize)[:rows, :cols]
+                    ids[numpy.isnan(ids)] = 0
+                    buildingIds.GetRasterBand(1).WriteArray(
+                        numpy.rint(ids).astype(numpy.uint32), col, row)
+
+                if args.buildings_only:
+                    dsmElevation = elevation
+                else:
+                    if args.render_cls:
+                        dtmRaster = numpy.full([rows, cols], BACKGROUND_LABEL)
+                    else:
+                        dtmRaster = dtm.GetRasterBand(1).ReadAsArray(col, row, cols, rows)
+                    # elevation has nans in places other than buildings
+                    dsmElevation = numpy.fmax(dtmRaster, elevation)
+                dsm.GetRasterBand(1).WriteArray(dsmElevation, col, row)
+        valuePass.ReleaseGraphicsResources(renWin)
         if nodata:
             dsm.GetRasterBand(1).SetNoDataValue(nodata)
 
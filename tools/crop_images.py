@@ -15,7 +15,7 @@ import logging
 import numpy as np
 
 from danesfield import rpc
-from danesfield import raytheon_rpc
+from danesfield import rpc_cache
 from danesfield import gdal_utils
 
 import gdalconst
@@ -44,8 +44,7 @@ def read_raytheon_RPC(rpc_path, img_file):
             rpc_file = rpc_path + 'GRA_' + file_no_ext + '_0.up.rpc'
             if os.path.isfile(rpc_file) is False:
                         return None
-    with open(rpc_file, 'r') as f:
-        return raytheon_rpc.parse_raytheon_rpc_file(f)
+    return rpc_cache.load_rpc(rpc_file)
 
 
 def filesFromArgs(src_root, dest_dir, dest_file_postfix=''):
@@ -289,7 +288,7 @@ def main(args):
 
         corners = [[0, 0], [px_width, 0], [px_width, px_height], [0, px_height]]
         corner_names = ['UpperLeft', 'UpperRight', 'LowerRight', 'LowerLeft']
-        world_corners = model.back_project(corners, elevation)
+        world_corners = model.back_project_batch(corners, elevation)
 
         corner_gcps = []
         for (p, l), (x, y, h), n in zip(corners, world_corners, corner_names):
@@ -12,24 +12,41 @@ import gdal
 import gdalconst
 import logging
 import numpy as np
-import scipy.misc
 import scipy.ndimage
 import sys
-import cv2
+
+from danesfield import mesh
 
 # This script generates a mesh from a DTM.
 # The DTM is downsampled by the parameter --downsample (40 by default)
 
 
+def smooth(dtm, size, valid=None):
+    """
+    Average the DTM over size x size windows, ignoring the invalid
+    samples if a mask of valid samples is given
+    """
+    smooth_kernel = np.full((size, size), 1.0 / (size * size))
+    if valid is None:
+        return scipy.ndimage.filters.convolve(dtm, smooth_kernel)
+    weights = scipy.ndimage.filters.convolve(valid.astype(np.float64), smooth_kernel)
+    dtm = scipy.ndimage.filters.convolve(np.where(valid, dtm, 0), smooth_kernel)
+    return dtm / np.maximum(weights, np.finfo(np.float64).tiny)
+
+
 def main(args):
     parser = argparse.ArgumentParser(
         description='Transform a DTM into a mesh')
     parser.add_argument("dtm_file", help="DTM image (.tif)")
-    parser.add_argument("output_file", help="Output mesh file (.obj)")
+    parser.add_argument("output_file",
+                        help="Output mesh file (.obj), or binary PLY file if it ends with .ply")
     parser.add_argument("--offset", action="store", nargs=3, type=float,
                         help="Offset used to re-center the mesh")
     parser.add_argument("--downsample", action="store", type=int, default=40,
                         help="Downsampling factor for the DTM")
+    parser.add_argument("--max_error", action="store", type=float,
+                        help="Decimate the mesh of the downsampled DTM adaptively, "
+                        "keeping it within this height error (in meters) of every sample")
     args = parser.parse_args(args)
 
     dtm_file = args.dtm_file
@@ -41,54 +58,55 @@ def main(args):
     if not mesh_offset:
         mesh_offset = [0, 0, 0]
 
-    # read DTM image
-    dtm = cv2.imread(dtm_file, cv2.IMREAD_LOAD_GDAL)
+    # read DTM image, origin and scale
+    gdal.AllRegister()
+    dataset = gdal.Open(dtm_file, gdalconst.GA_ReadOnly)
+    if not dataset:
+        raise RuntimeError("Error: Failed to open DTM {}".format(dtm_file))
+    band = dataset.GetRasterBand(1)
+    dtm = band.ReadAsArray()
+    nodata = band.GetNoDataValue()
+    valid = None
+    if nodata is not None and np.any(dtm == nodata):
+        valid = dtm != nodata
+    geo_transform = dataset.GetGeoTransform()
+    origin = np.array([geo_transform[0], geo_transform[3]])
+    scale = np.array([geo_transform[1], geo_transform[5]])
 
     # smooth and downsample the DTM
     smooth_size = int(reduction_factor / 4)
-    smooth_kernel = np.full((smooth_size, smooth_size),
-                            1.0 / (smooth_size * smooth_size))
-    dtm = scipy.ndimage.filters.convolve(dtm, smooth_kernel)
+    if smooth_size > 1:
+        dtm = smooth(dtm, smooth_size, valid)
     nb_u_samples = int(dtm.shape[1] / reduction_factor)
     nb_v_samples = int(dtm.shape[0] / reduction_factor)
     downsampled_u = np.linspace(0, dtm.shape[1] - 1, nb_u_samples)
     downsampled_v = np.linspace(0, dtm.shape[0] - 1, nb_v_samples)
-    dtm = dtm[downsampled_v.astype(int), :]
-    dtm = dtm[:, downsampled_u.astype(int)]
-
-    # read DTM origin and scale
-    gdal.AllRegister()
-    dataset = gdal.Open(dtm_file, gdalconst.GA_ReadOnly)
-    geo_transform = dataset.GetGeoTransform()
-    origin = np.array([geo_transform[0], geo_transform[3]])
-    scale = np.array([geo_transform[1], geo_transform[5]])
+    sample_index = np.ix_(downsampled_v.astype(int), downsampled_u.astype(int))
+    dtm = dtm[sample_index]
+    if valid is not None:
+        valid = valid[sample_index]
 
     # build array of 3D points in utm world coordinates
-    x = np.tile(downsampled_u, nb_v_samples) * scale[0] + origin[0]
-    y = np.repeat(downsampled_v, nb_u_samples) * scale[1] + origin[1]
-    z = dtm.ravel()
-    xyz = np.vstack((x, y, z)).T
+    u, v = np.meshgrid(downsampled_u, downsampled_v)
+    xyz = np.stack([u.ravel() * scale[0] + origin[0],
+                    v.ravel() * scale[1] + origin[1],
+                    dtm.ravel()], axis=1)
 
     # translate points with the same offset
     xyz -= mesh_offset
 
-    # build list of faces
-    faces = []
-    for j in range(nb_v_samples-1):
-        for i in range(nb_u_samples-1):
-            id0 = j * nb_u_samples + i
-            id1 = id0 + 1
-            id2 = id0 + nb_u_samples
-            id3 = id2 + 1
-            faces.append([id0, id2, id1])
-            faces.append([id2, id3, id1])
-
-    # write DTM mesh to OBJ file
-    with open(output_file, "w") as file:
-        for pt in xyz:
-            file.write("v " + str(pt[0]) + " " + str(pt[1]) + " " + str(pt[2]) + "\n")
-        for f in faces:
-            file.write("f " + str(f[0]+1) + " " + str(f[1]+1) + " " + str(f[2]+1) + "\n")
+    # build the faces
+    if args.max_error is not None:
+        vertex_index, faces = mesh.adaptive_grid_mesh(dtm, args.max_error, valid)
+        xyz = xyz[vertex_index]
+        print("Decimated {} samples to {} vertices".format(dtm.size, len(xyz)))
+    else:
+        faces = mesh.grid_faces(nb_v_samples, nb_u_samples, valid)
+    if valid is not None:
+        xyz, faces = mesh.remove_unused_vertices(xyz, faces)
+
+    # write DTM mesh
+    mesh.write_mesh(output_file, xyz, faces)
     print("Done.")
 
 
@@ -11,6 +11,8 @@ import argparse
 import gdal
 import gdalnumeric
 import logging
+import numpy
+import os
 import sys
 
 import danesfield.dtm
@@ -29,7 +31,31 @@ def main(args):
     parser.add_argument('-t', "--tension", type=int, default=10,
                         help="Number of inner smoothing iterations, "
                              "greater values increase surface tension.")
+    parser.add_argument('-j', "--jobs", type=int, default=1,
+                        help="Number of threads used to drape the cloth on "
+                             "bands of rows of large images")
+    parser.add_argument("--tolerance", type=float,
+                        help="Stop the draping of each pyramid level once the cloth "
+                             "height changes by less than this (in DSM units) in an "
+                             "iteration.  By default all iterations are run.")
+    parser.add_argument("--min-iter", type=int, default=1,
+                        help="Minimum number of iterations at each pyramid level "
+                             "when using --tolerance")
+    parser.add_argument("--dtype", choices=["float32", "float64"],
+                        help="Floating point type in which to read the DSM and compute "
+                             "the DTM.  Defaults to the type of the DSM.")
+    parser.add_argument("--inplace", action="store_true",
+                        help="Compute the DTM in two preallocated buffers shared by "
+                             "all scales, reducing memory use")
+    parser.add_argument("--tile-size", type=int,
+                        help="Fit the DTM out of core: the coarse scales are fit to a "
+                             "decimated read of the DSM and the fine scales are refined "
+                             "in tiles of this size, a multiple of 16, read and written "
+                             "as windows of the images.  The DTM is written as a tiled "
+                             "GeoTIFF with blocks of this size.")
     args = parser.parse_args(args)
+    if args.tile_size is not None and (args.tile_size <= 0 or args.tile_size % 16):
+        parser.error("--tile-size must be a positive multiple of 16")
 
     # open the DSM
     dsm = gdal.Open(args.source_dsm, gdal.GA_ReadOnly)
@@ -37,15 +63,26 @@ def main(args):
         print("Unable to open {}".format(args.source_dsm))
         sys.exit(1)
     band = dsm.GetRasterBand(1)
-    dsmRaster = band.ReadAsArray(
-        xoff=0, yoff=0,
-        win_xsize=dsm.RasterXSize, win_ysize=dsm.RasterYSize)
-    print("DSM raster shape {}".format(dsmRaster.shape))
+    buf_type = {"float32": gdal.GDT_Float32, "float64": gdal.GDT_Float64}.get(args.dtype)
 
     # Estimate the DTM data from the DSM data
     estimator = danesfield.dtm.DTMEstimator(band.GetNoDataValue(),
                                             args.num_iterations,
-                                            args.tension)
+                                            args.tension,
+                                            num_workers=args.jobs,
+                                            tolerance=args.tolerance,
+                                            min_iter=args.min_iter,
+                                            dtype=args.dtype,
+                                            inplace=args.inplace)
+    if args.tile_size is not None:
+        fit_dtm_tiled(estimator, dsm, args.destination_dtm, args.tile_size, buf_type)
+        print("Done")
+        return
+
+    dsmRaster = band.ReadAsArray(
+        xoff=0, yoff=0,
+        win_xsize=dsm.RasterXSize, win_ysize=dsm.RasterYSize, buf_type=buf_type)
+    print("DSM raster shape {}".format(dsmRaster.shape))
     dtm = estimator.fit_dtm(dsmRaster)
 
     # create the DTM image
@@ -75,7 +112,57 @@ def main(args):
     print("Done")
 
 
+def fit_dtm_tiled(estimator, dsm, destination_dtm, tile_size, buf_type=None):
+    """
+    Fit a DTM by tiles, reading windows of the DSM and writing windows of
+    a tiled GeoTIFF whose blocks are the full resolution tiles
+    """
+    if tile_size <= 0 or tile_size % 16:
+        raise ValueError("The tile size must be a positive multiple of 16, "
+                         "got {}".format(tile_size))
+    band = dsm.GetRasterBand(1)
+    print("DSM raster shape {}, fitting in tiles of {} pixels".format(
+        (dsm.RasterYSize, dsm.RasterXSize), tile_size))
+
+    def read_dsm(row, col, rows, cols, factor):
+        # Decimate by reading every factor-th full resolution row and
+        # slicing it, rather than with GDAL's resampling, which samples
+        # pixel centers and may read overviews
+        x, y = col * factor, row * factor
+        win_xsize = min(cols * factor, dsm.RasterXSize - x)
+        if factor == 1:
+            return band.ReadAsArray(xoff=x, yoff=y, win_xsize=win_xsize,
+                                    win_ysize=min(rows, dsm.RasterYSize - y),
+                                    buf_type=buf_type)
+        return numpy.concatenate([
+            band.ReadAsArray(xoff=x, yoff=r, win_xsize=win_xsize, win_ysize=1,
+                             buf_type=buf_type)[:, ::factor]
+            for r in range(y, min(y + rows * factor, dsm.RasterYSize), factor)])
+
+    print("Create destination DTM of "
+          "size:({}, {}) ...".format(dsm.RasterXSize, dsm.RasterYSize))
+    options = ["TILED=YES", "BLOCKXSIZE={}".format(tile_size),
+               "BLOCKYSIZE={}".format(tile_size), "COMPRESS=DEFLATE", "PREDICTOR=3",
+               "BIGTIFF=IF_SAFER"]
+    destImage = gdal.GetDriverByName("GTiff").Create(
+        destination_dtm, xsize=dsm.RasterXSize, ysize=dsm.RasterYSize,
+        bands=1, eType=band.DataType, options=options)
+    if not destImage:
+        raise RuntimeError("Unable to create {}".format(destination_dtm))
+    gdalnumeric.CopyDatasetInfo(dsm, destImage)
+    destBand = destImage.GetRasterBand(1)
+
+    def write_dtm(row, col, dtm):
+        destBand.WriteArray(dtm, xoff=col, yoff=row)
+
+    estimator.fit_dtm_tiled(read_dsm, write_dtm, (dsm.RasterYSize, dsm.RasterXSize),
+                            tile_size,
+                            temp_dir=os.path.dirname(os.path.abspath(destination_dtm)))
+    del destImage
+
+
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     try:
         main(sys.argv[1:])
     except Exception as e:
@@ -8,20 +8,53 @@
 
 
 import argparse
-import json
+import gdal
 import logging
 import numpy
+import os
 import subprocess
 
+from danesfield import gridding
+from danesfield import pointcloud
 
-def getMinMax(json_string):
-    j = json.loads(json_string)
-    j = j["stats"]["statistic"]
-    minX = j[0]["minimum"]
-    maxX = j[0]["maximum"]
-    minY = j[1]["minimum"]
-    maxY = j[1]["maximum"]
-    return minX, maxX, minY, maxY
+
+def write_grid(grid, rasters, statistics, srs, destination_image, tile_size=256):
+    """
+    Write the rasters of a PointGrid as the bands of a tiled, compressed
+    GeoTIFF, in the order of statistics
+    """
+    options = ["TILED=YES", "BLOCKXSIZE={}".format(tile_size),
+               "BLOCKYSIZE={}".format(tile_size), "COMPRESS=DEFLATE", "PREDICTOR=3",
+               "BIGTIFF=IF_SAFER"]
+    image = gdal.GetDriverByName("GTiff").Create(
+        destination_image, xsize=grid.shape[1], ysize=grid.shape[0],
+        bands=len(statistics), eType=gdal.GDT_Float32, options=options)
+    if not image:
+        raise RuntimeError("Error: Failed to create {}".format(destination_image))
+    image.SetGeoTransform(grid.geotransform)
+    if srs:
+        image.SetProjection(srs)
+    for i, statistic in enumerate(statistics):
+        band = image.GetRasterBand(i + 1)
+        band.SetDescription(statistic)
+        if statistic != "count":
+            band.SetNoDataValue(gridding.NODATA_VALUE)
+        # write by strips of blocks to avoid a float32 copy of the whole raster
+        raster = rasters[statistic]
+        for row in range(0, grid.shape[0], tile_size):
+            band.WriteArray(raster[row:row + tile_size].astype(numpy.float32), 0, row)
+    del image
+
+
+def generate_dsm(source_points, bounds, gsd, statistics=("max",), window_size=20,
+                 chunk_size=1000000):
+    """
+    Grid point cloud files in process, streaming their points with PDAL.
+    Returns the PointGrid and a dict of the raster of each statistic, so
+    that a driver can keep the DSM in memory.
+    """
+    chunks = pointcloud.read_point_chunks(source_points, bounds, chunk_size)
+    return gridding.grid_points(chunks, bounds, gsd, statistics, window_size)
 
 
 def main(args):
@@ -34,7 +67,36 @@ def main(args):
                              "of the source_points file): minX, maxX, minY, maxY. "
                              "If not specified, it is computed from source_points files")
     parser.add_argument("--gsd", help="Ground sample distance")
+    parser.add_argument("--bounds-cache",
+                        help="JSON file caching the bounds of the source_points files, "
+                             "keyed by path, size and modification time.  Defaults to "
+                             "point_cloud_bounds.json next to the destination image.")
+    parser.add_argument("--no-bounds-cache", action="store_true",
+                        help="Do not read or write the bounds cache")
+    parser.add_argument("--engine", choices=["pdal", "python"], default="pdal",
+                        help="Grid the points with a 'pdal pipeline' subprocess, or in "
+                             "process by binning the points streamed by PDAL's Python "
+                             "bindings into the cells")
+    parser.add_argument("--statistics", nargs="+", choices=gridding.STATISTICS,
+                        default=["max"],
+                        help="Statistics of the points in each cell written as the "
+                             "bands of the destination image, in order, with the python "
+                             "engine")
+    parser.add_argument("--window-size", type=int, default=20,
+                        help="Empty cells are filled from non-empty cells at most this "
+                             "number of cells away")
+    parser.add_argument("--chunk-size", type=int, default=1000000,
+                        help="Number of points streamed at a time with the python engine")
+    parser.add_argument("--tile-size", type=int, default=256,
+                        help="Size of the GeoTIFF blocks written by the python engine, "
+                             "a multiple of 16")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of processes running PDAL on the source_points "
+                             "files that are not LAS/LAZ.  Defaults to the number of "
+                             "CPUs.")
     args = parser.parse_args(args)
+    if args.tile_size <= 0 or args.tile_size % 16:
+        parser.error("--tile-size must be a positive multiple of 16")
 
     if not args.gsd:
         args.gsd = 0.25
@@ -50,31 +112,30 @@ def main(args):
     else:
         print("Computing the bounding box for {} point cloud files ...".format(
             len(args.source_points)))
-        minX = numpy.inf
-        maxX = - numpy.inf
-        minY = numpy.inf
-        maxY = - numpy.inf
-        pdal_info_template = ["pdal", "info", "--stats", "--dimensions", "X,Y"]
-        for i, s in enumerate(args.source_points):
-            pdal_info_args = pdal_info_template + [s]
-            out = subprocess.check_output(pdal_info_args)
-            tempMinX, tempMaxX, tempMinY, tempMaxY = getMinMax(out)
-            if tempMinX < minX:
-                minX = tempMinX
-            if tempMaxX > maxX:
-                maxX = tempMaxX
-            if tempMinY < minY:
-                minY = tempMinY
-            if tempMaxY > maxY:
-                maxY = tempMaxY
-            if i % 10 == 0:
-                print("Iteration {}".format(i))
+        cache_fpath = None
+        if not args.no_bounds_cache:
+            cache_fpath = args.bounds_cache or os.path.join(
+                os.path.dirname(os.path.abspath(args.destination_image)),
+                "point_cloud_bounds.json")
+        minX, maxX, minY, maxY = pointcloud.union_bounds(pointcloud.point_cloud_bounds(
+            args.source_points, cache_fpath, args.jobs))
     print("Bounds ({}, {}, {}, {})".format(minX, maxX, minY, maxY))
 
     # compensate for PDAL expanding the extents by 1 pixel
     maxX -= float(args.gsd)
     maxY -= float(args.gsd)
 
+    if args.engine == "python":
+        print("Generating DSM in process ...")
+        bounds = (minX, maxX, minY, maxY)
+        grid, rasters = generate_dsm(args.source_points, bounds, args.gsd,
+                                     args.statistics, args.window_size, args.chunk_size)
+        print("Gridded {} points into {} cells".format(grid.num_points, grid.shape))
+        write_grid(grid, rasters, args.statistics,
+                   pointcloud.point_cloud_srs(args.source_points[0]),
+                   args.destination_image, args.tile_size)
+        return
+
     # read the pdal file and project the points
     jsonTemplate = """
     {
@@ -89,7 +150,7 @@ def main(args):
           "data_type": "float",
           "filename":"%s",
           "output_type": "max",
-          "window_size": "20",
+          "window_size": "%s",
           "bounds": "([%s, %s], [%s, %s])",
           "gdalopts": "COMPRESS=DEFLATE"
         }
@@ -99,7 +160,7 @@ def main(args):
     all_sources = ",\n".join("\"" + str(e) + "\"" for e in args.source_points)
     pipeline = jsonTemplate % (all_sources,
                                minX, maxX, minY, maxY,
-                               args.gsd, args.destination_image,
+                               args.gsd, args.destination_image, args.window_size,
                                minX, maxX, minY, maxY)
     pdal_pipeline_args = ["pdal", "pipeline", "--stream", "--stdin"]
     response = subprocess.run(pdal_pipeline_args, input=pipeline.encode(),
@@ -115,6 +176,7 @@ def main(args):
 
 if __name__ == '__main__':
     import sys
+    logging.basicConfig(level=logging.INFO)
     try:
         main(sys.argv[1:])
     except Exception as e:
@@ -9,91 +9,145 @@
 
 import argparse
 import glob
+import itertools
 import logging
+import numpy
 import os
+import re
 import sys
 
+from danesfield import mesh
+
 # This script merges several OBJ meshes into one file and check that their
 # offsets are consistent (only handles vertices and faces)
 
+OFFSET_KEYWORDS = ["#x offset", "#y offset", "#z offset"]
+
+# Number of characters read at a time from each mesh
+MERGE_CHUNK_BYTES = 1 << 22
+
+# Consecutive face records
+FACE_BLOCK = re.compile(r"^f[^\n]*\n(?:f[^\n]*\n)*", re.MULTILINE)
+# Runs of digits of face records, replaced to get the layout of their indices
+DIGIT_RUNS = re.compile(r"\d+")
+# Replace the characters around the indices of face records by spaces
+FACE_SEPARATORS = str.maketrans("f/\t\r\n", "     ")
+
+
+def read_offset(f):
+    """
+    Read the offset of a mesh from its first three lines, returns the
+    offset and whether the mesh has one.  The file is left after these
+    lines if the mesh has an offset, at its start otherwise.
+    """
+    lines = [f.readline() for _ in OFFSET_KEYWORDS]
+    offset = [0, 0, 0]
+    for i, keyword in enumerate(OFFSET_KEYWORDS):
+        if lines[i].find(keyword) == 0:
+            offset[i] = float(lines[i][10:])
+    with_offset = lines[0].find(OFFSET_KEYWORDS[0]) == 0
+    if not with_offset:
+        f.seek(0)
+    return offset, with_offset
+
+
+def layout(face_lines):
+    """Layout of the indices of face records, e.g. "f 0/0/0 0//0" for "f 1/2/3 4//5"
+    """
+    return DIGIT_RUNS.sub("0", face_lines)
+
+
+def write_faces(out, block, index_offset):
+    """
+    Write a block of face records, e.g. "f 1/2 3/4 5/6", with their
+    vertex, texture and normal indices increased by index_offset
+    """
+    first = block[:block.index("\n") + 1]
+    num_lines = block.count("\n")
+    # compare the layout of every line to the first one
+    if layout(block) != layout(first) * num_lines:
+        # faces with different layouts, write each run of the same layout
+        for _, lines in itertools.groupby(block.splitlines(True), layout):
+            write_faces(out, "".join(lines), index_offset)
+        return
+    if "-" in first:
+        # relative indices don't change
+        out.write(block)
+        return
+    column_offsets = [index_offset[k]
+                      for token in first.split()[1:]
+                      for k, index in enumerate(token.split("/")) if index]
+    values = numpy.fromstring(block.translate(FACE_SEPARATORS), dtype=numpy.int64, sep=" ")
+    if values.size != num_lines * len(column_offsets):
+        raise ValueError("Invalid face records: {}".format(first))
+    values = values.reshape(num_lines, len(column_offsets)) + column_offsets
+    row_format = re.sub(r"\d+", "%d", first.replace("%", "%%"))
+    mesh.write_rows(out, row_format, values)
+
+
+def copy_records(f, out, index_offset, chunk_bytes=MERGE_CHUNK_BYTES):
+    """
+    Copy the records of an OBJ stream by chunks of lines, offsetting the
+    indices of the faces.  Returns the number of vertices, texture
+    coordinates and normals copied.
+    """
+    counts = [0, 0, 0]
+    while True:
+        text = f.read(chunk_bytes)
+        if not text:
+            break
+        # complete the last line, and end the last line of the file before
+        # the next mesh
+        text += f.readline()
+        if not text.endswith("\n"):
+            text += "\n"
+        lines = "\n" + text
+        counts[0] += lines.count("\nv ") + lines.count("\nv\t")
+        counts[1] += lines.count("\nvt")
+        counts[2] += lines.count("\nvn")
+        # copy the other records and offset the blocks of faces
+        pos = 0
+        for match in FACE_BLOCK.finditer(text):
+            out.write(text[pos:match.start()])
+            write_faces(out, match.group(), index_offset)
+            pos = match.end()
+        out.write(text[pos:])
+    return counts
 
-def merge_files(mesh_files, output_file, check_offsets):
-    offset_x_keyword = "#x offset"
-    offset_y_keyword = "#y offset"
-    offset_z_keyword = "#z offset"
-
-    merged_lines = []
-    current_nb_vertices = 0
-
-    # reference offset (they are initialized with the first mesh)
-    ref_offset_x = 0
-    ref_offset_y = 0
-    ref_offset_z = 0
-    ref_use_offset = False
-    need_to_init_ref_offset = True
 
+def merge_files(mesh_files, output_file, check_offsets):
+    # Read the mesh offsets first, so that nothing is written if they are
+    # not consistent
+    offsets = []
     for filename in mesh_files:
         with open(filename) as f:
-            lines = f.readlines()
-
-        # Read mesh offset
-        with_offset = False
-        x_offset, y_offset, z_offset = 0, 0, 0
-        if lines[0].find(offset_x_keyword) == 0:
-            x_offset = float(lines[0][10:])
-            with_offset = True
-        if lines[1].find(offset_y_keyword) == 0:
-            y_offset = float(lines[1][10:])
-        if lines[2].find(offset_z_keyword) == 0:
-            z_offset = float(lines[2][10:])
-
-        if check_offsets:
-            # Initialize the reference offset if needed
-            if need_to_init_ref_offset:
-                ref_use_offset = with_offset
-                ref_offset_x = x_offset
-                ref_offset_y = y_offset
-                ref_offset_z = z_offset
-                need_to_init_ref_offset = False
-            else:
-                # Else check the mesh offset with the reference
-                if (ref_use_offset != with_offset or ref_offset_x != x_offset or
-                        ref_offset_y != y_offset or ref_offset_z != z_offset):
-                            logging.exception("Error: offsets are not consistent "
-                                              "over the meshes (" + filename + ")")
-                            sys.exit(1)
-
-        # Increment the vertices index by the number of current vertices when
-        # a new mesh is merged
-        nb_vertices = 0
-        for i in range(len(lines)):
-            if lines[i][0] == "v":
-                nb_vertices += 1
-            elif lines[i][0] == "f":
-                f = list(map(lambda x: str(int(x) + current_nb_vertices),
-                             lines[i].split(" ")[1:]))
-                lines[i] = " ".join(["f"] + f)+"\n"
-
-        # Update the nb of vertices with the count of the current mesh
-        current_nb_vertices += nb_vertices
-
-        # Append the lines to the gloabl list
+            offsets.append(read_offset(f))
+
+    # reference offset (they are initialized with the first mesh)
+    ref_offset, ref_use_offset = offsets[0] if check_offsets else ([0, 0, 0], False)
+    if check_offsets:
+        for filename, (offset, with_offset) in zip(mesh_files, offsets):
+            # check the mesh offset with the reference
+            if ref_use_offset != with_offset or ref_offset != offset:
+                logging.exception("Error: offsets are not consistent "
+                                  "over the meshes (" + filename + ")")
+                sys.exit(1)
+
+    with open(output_file, "w", buffering=MERGE_CHUNK_BYTES) as out:
+        # If there is an offset, it is added only once at the top of the output file
+        if ref_use_offset:
+            for keyword, value in zip(OFFSET_KEYWORDS, ref_offset):
+                out.write(keyword + ": " + str(value) + "\n")
+
+        # Increment the indices by the number of current vertices, texture
+        # coordinates and normals when a new mesh is merged.
         # If there is an offset, we do not repeat it each time
-        if with_offset:
-            merged_lines += lines[3:]
-        else:
-            merged_lines += lines
-
-    # If there is an offset, it is added only once at the top of the output file
-    offset_lines = []
-    if ref_use_offset:
-        offset_lines.append(offset_x_keyword + ": " + str(ref_offset_x) + "\n")
-        offset_lines.append(offset_y_keyword + ": " + str(ref_offset_y) + "\n")
-        offset_lines.append(offset_z_keyword + ": " + str(ref_offset_z) + "\n")
-
-    # Write the output file
-    with open(output_file, "w") as out:
-        out.writelines(offset_lines + merged_lines)
+        index_offset = [0, 0, 0]
+        for filename in mesh_files:
+            with open(filename) as f:
+                read_offset(f)
+                counts = copy_records(f, out, index_offset)
+            index_offset = [i + c for i, c in zip(index_offset, counts)]
 
 
 def main(args):
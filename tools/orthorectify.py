@@ -7,6 +7,7 @@
 ###############################################################################
 
 
+from danesfield import occlusion
 from danesfield import ortho
 
 import argparse
@@ -31,11 +32,23 @@ def main(args):
     parser.add_argument("--dtm", type=str,
                         help="Optional DTM parameter used to replace nodata areas in the "
                              "orthorectified image")
+    parser.add_argument("--tile-size", type=int,
+                        help="Process the DSM in square blocks of this many pixels "
+                             "to bound memory use. The result is unchanged.")
+    parser.add_argument("--max-memory-mb", type=float,
+                        help="Choose the block size so that the working memory is "
+                             "approximately bounded by this many megabytes")
+    parser.add_argument("--occlusion-engine", choices=sorted(occlusion.ENGINES),
+                        default="sort",
+                        help="Method used to detect occluded regions. 'zbuffer' "
+                             "avoids sorting the DSM by height.")
     args = parser.parse_args(args)
 
     ret = ortho.orthorectify(args.source_image, args.dsm, args.destination_image,
                              args.occlusion_thresh, args.denoise_radius,
-                             args.raytheon_rpc, args.dtm)
+                             args.raytheon_rpc, args.dtm,
+                             args.tile_size, args.max_memory_mb,
+                             args.occlusion_engine)
 
     if ret == ortho.ERROR:
         raise RuntimeError("Error: orthorectification failed")
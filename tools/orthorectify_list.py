@@ -9,8 +9,10 @@
 
 from danesfield import ortho
 from danesfield import gdal_utils
+from danesfield import image_index
 
 import argparse
+import concurrent.futures
 import gdal
 import glob
 import logging
@@ -34,14 +36,16 @@ def orthoParamsToString(args_source_image, args_dsm, args_destination_image,
     return ret
 
 
-def intersection(a, b):
-    x1 = max(a[0], b[0])
-    y1 = max(a[1], b[1])
-    x2 = min(a[2], b[2])
-    y2 = min(a[3], b[3])
-    if x1 < x2 and y1 < y2:
-        return [x1, y1, x2, y2]
-    # else return None
+def run_orthorectify(tasks, jobs=None):
+    """
+    Run ortho.orthorectify on lists of arguments in a pool of jobs
+    processes, or in this process with one job.  Returns the status codes.
+    """
+    if jobs == 1:
+        return [ortho.orthorectify(*task) for task in tasks]
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(ortho.orthorectify, *task) for task in tasks]
+        return [future.result() for future in futures]
 
 
 def main(args):
@@ -77,6 +81,14 @@ def main(args):
                         help="Prefixes for images excluded from the list of images that could "
                              "be used for orthorectification, because of snow for instance. "
                              "(14DEC, 01JAN)")
+    parser.add_argument("--metadata-index",
+                        help="JSON index of the image metadata read from the NITF "
+                             "headers, reused while the images are unchanged.  "
+                             "By default the headers are read every time.")
+    parser.add_argument('-j', "--jobs", type=int, default=1,
+                        help="Number of processes reading image metadata and "
+                             "orthorectifying DSM tiles.  Each process orthorectifies "
+                             "a full DSM tile in memory.")
     parser.add_argument("--debug", action="store_true",
                         help="Print additional information")
     args = parser.parse_args(args)
@@ -98,16 +110,8 @@ def main(args):
         print("Remove exclude_images: {} images".format(len(imagesList)))
 
     images = numpy.array(imagesList)
-    angles = numpy.zeros(len(images))
-    cloudCover = numpy.zeros(len(images))
-    bounds = numpy.zeros([len(images), 4])
-    for i, f in enumerate(images):
-        sourceImage = gdal.Open(f, gdal.GA_ReadOnly)
-        metaData = sourceImage.GetMetadata()
-        angles[i] = metaData['NITF_CSEXRA_OBLIQUITY_ANGLE']
-        cloudCover[i] = metaData['NITF_PIAIMC_CLOUDCVR']
-        outProj = pyproj.Proj('+proj=longlat +datum=WGS84')
-        bounds[i] = gdal_utils.gdal_bounding_box(sourceImage, outProj)
+    metadata = image_index.image_metadata(
+        imagesList, args.metadata_index, args.jobs)
 
     # list of dsms
     dsmList = glob.glob(args.dsm_folder + "/dsm_*.tif")
@@ -129,6 +133,7 @@ def main(args):
         ids = [os.path.basename(line) for line in dsms]
     ids = set(ids)
 
+    tasks = []
     for dsm in dsms:
         dsmBasename = os.path.basename(dsm)
         if dsmBasename not in ids:
@@ -140,19 +145,10 @@ def main(args):
         outProj = pyproj.Proj('+proj=longlat +datum=WGS84')
         dsmBounds = gdal_utils.gdal_bounding_box(dsmImage, outProj)
         dsmArea = (dsmBounds[2] - dsmBounds[0]) * (dsmBounds[3] - dsmBounds[1])
-        areas = numpy.zeros(len(images))
-        for i, source_image in enumerate(images):
-            imageIntersectDsm = intersection(dsmBounds, bounds[i])
-            areaImageIntersectDsm = (imageIntersectDsm[2] - imageIntersectDsm[0]) *\
-                (imageIntersectDsm[3] - imageIntersectDsm[1]) if imageIntersectDsm else 0
-            # area of DSM not covered
-            areas[i] = dsmArea - areaImageIntersectDsm
         # sort images by areas and angle
-        sortIndex = numpy.lexsort((angles, cloudCover, areas))
+        sortIndex, areas = image_index.rank_images(dsmBounds, metadata)
         images = images[sortIndex]
-        angles = angles[sortIndex]
-        cloudCover = cloudCover[sortIndex]
-        bounds = bounds[sortIndex]
+        metadata = [metadata[i] for i in sortIndex]
         areas = areas[sortIndex]
         if args.debug:
             print("========== Sorted list of images ==========")
@@ -160,13 +156,15 @@ def main(args):
                 print("{} {}: {} area not covered: {} (dsmBounds: {}, bounds: {}) "
                       "cloudCover: {} angle: {}".format(
                         index[0], index[1], os.path.basename(images[i]), areas[i] / dsmArea,
-                        dsmBounds, bounds[i], cloudCover[i], angles[i]))
+                        dsmBounds, metadata[i]['bounds'], metadata[i]['cloud_cover'],
+                        metadata[i]['angle']))
 
         source_image = images[0]
         print("Using {} percentage not covered: {} angle: {}".format(
-            source_image, areas[0] / dsmArea, angles[0]))
+            source_image, areas[0] / dsmArea, metadata[0]['angle']))
         destination_image = os.path.basename(source_image)
         destination_image = os.path.splitext(destination_image)[0]
+        oargs_raytheon_rpc = None
         if args.rpc_folder:
             oargs_raytheon_rpc = glob.glob(
                 args.rpc_folder + "/GRA_" + destination_image + '*.up.rpc')[0]
@@ -182,7 +180,12 @@ def main(args):
                                 "_" + index[1] + ".tif")
             ortho_params.append(dtmList[0])
         print(orthoParamsToString(*ortho_params))
-        ortho.orthorectify(*ortho_params)
+        tasks.append(ortho_params)
+
+    print("Orthorectifying {} DSM tiles".format(len(tasks)))
+    for ortho_params, status in zip(tasks, run_orthorectify(tasks, args.jobs)):
+        if status == ortho.ERROR:
+            print("Failed: {}".format(orthoParamsToString(*ortho_params)))
 
 
 if __name__ == '__main__':
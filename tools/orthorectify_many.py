@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+###############################################################################
+# Copyright Kitware Inc. and Contributors
+# Distributed under the Apache License, 2.0 (apache.org/licenses/LICENSE-2.0)
+# See accompanying Copyright.txt and LICENSE files for details
+###############################################################################
+
+
+from danesfield import occlusion
+from danesfield import ortho
+
+import argparse
+import logging
+import os
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Orthorectify several images given the same DSM. '
+        'The DSM is processed once and shared by all images. '
+        'Output images are named <source image name>_ortho.tif')
+    parser.add_argument("dsm", help="Digital surface model (DSM) image file name")
+    parser.add_argument("output_dir", help="Output directory for orthorectified images")
+    parser.add_argument("--image", action="append", nargs="+", required=True,
+                        help="Source image file name and optional Raytheon RPC "
+                        "file name for it. If no RPC file is given, the RPC is "
+                        "read from the source image. Repeat for each image.")
+    parser.add_argument('-t', "--occlusion-thresh", type=float, default=0.0,
+                        help="Threshold on height difference for detecting "
+                        "and masking occluded regions (in meters)")
+    parser.add_argument('-d', "--denoise-radius", type=float, default=2,
+                        help="Apply morphological operations with this radius "
+                        "to the DSM reduce speckled noise")
+    parser.add_argument("--dtm", type=str,
+                        help="Optional DTM parameter used to replace nodata areas in the "
+                             "orthorectified image")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of images to process in parallel. "
+                        "Defaults to the number of CPUs.")
+    parser.add_argument("--occlusion-engine", choices=sorted(occlusion.ENGINES),
+                        default="sort",
+                        help="Method used to detect occluded regions. 'zbuffer' "
+                             "avoids sorting the DSM by height.")
+    args = parser.parse_args(args)
+
+    if any(len(image) > 2 for image in args.image):
+        raise RuntimeError("Error: --image expects an image and an optional RPC file")
+    source_images = [image[0] for image in args.image]
+    raytheon_rpcs = [image[1] if len(image) > 1 else None for image in args.image]
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    destination_images = [
+        os.path.join(args.output_dir, '{}_ortho.tif'.format(
+            os.path.splitext(os.path.basename(source_image))[0]))
+        for source_image in source_images]
+
+    ret = ortho.orthorectify_many(source_images, args.dsm, destination_images,
+                                  args.occlusion_thresh, args.denoise_radius,
+                                  raytheon_rpcs, args.dtm, args.jobs,
+                                  args.occlusion_engine)
+
+    failed = [source_image for source_image, r in zip(source_images, ret)
+              if r == ortho.ERROR]
+    if failed:
+        raise RuntimeError("Error: orthorectification failed for {}".format(failed))
+
+
+if __name__ == '__main__':
+    import sys
+    try:
+        main(sys.argv[1:])
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(1)
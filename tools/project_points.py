@@ -7,14 +7,81 @@
 ###############################################################################
 
 
-from danesfield import rpc
+from danesfield import gridding
+from danesfield import pointcloud
 from danesfield import raytheon_rpc
+from danesfield import rpc_cache
 
 import argparse
 import gdal
 import logging
 import numpy
-import pdal
+
+# Number of rows of the destination image written at a time
+WRITE_BLOCK_ROWS = 1024
+
+
+def point_z_range(chunks):
+    """
+    Returns the min and max Z of chunks of (X, Y, Z) points
+    """
+    minZ, maxZ = numpy.inf, -numpy.inf
+    for arrayX, arrayY, arrayZ in chunks:
+        if len(arrayZ):
+            minZ = min(minZ, numpy.amin(arrayZ))
+            maxZ = max(maxZ, numpy.amax(arrayZ))
+    return minZ, maxZ
+
+
+def quantize_heights(arrayZ, minZ, maxZ, max_value):
+    """
+    Quantize heights to [0, max_value] over the range [minZ, maxZ]
+    """
+    return ((arrayZ.astype(numpy.float64) - minZ) * max_value /
+            (maxZ - minZ)).astype(numpy.int64)
+
+
+def project_point_chunks(model, chunks, shape, dtype=numpy.float32, z_range=None,
+                         max_value=None):
+    """
+    Project chunks of (X, Y, Z) points with an RPC model into a z-buffer
+    of the given image shape and dtype, keeping the highest point in each
+    pixel.  If max_value is given, the heights are quantized to [0,
+    max_value] over the (minZ, maxZ) z_range before the reduction, which
+    keeps the same points since the quantization is monotonic, and the
+    z-buffer is 0 where no point projects.  Otherwise it is -inf there.
+    Returns the z-buffer, the number of points and the number outside of
+    the image.
+    """
+    if max_value is None:
+        zbuffer = numpy.full(shape, -numpy.inf, dtype)
+    else:
+        zbuffer = numpy.zeros(shape, dtype)
+    numPoints = numOut = 0
+    for arrayX, arrayY, arrayZ in chunks:
+        if not len(arrayZ):
+            continue
+        imgPoints = model.project_batch(numpy.stack([arrayX, arrayY, arrayZ], axis=1))
+        # truncate to pixel indices
+        intImgPoints = imgPoints.astype(numpy.int64).transpose()
+        if max_value is not None:
+            arrayZ = quantize_heights(arrayZ, z_range[0], z_range[1], max_value)
+        inside = gridding.max_into(zbuffer, intImgPoints[1], intImgPoints[0], arrayZ)
+        numPoints += len(arrayZ)
+        numOut += len(arrayZ) - numpy.count_nonzero(inside)
+    return zbuffer, numPoints, numOut
+
+
+def write_zbuffer(band, zbuffer):
+    """
+    Write a z-buffer to a raster band in blocks of rows, with 0 where no
+    point projects
+    """
+    for row in range(0, zbuffer.shape[0], WRITE_BLOCK_ROWS):
+        block = zbuffer[row:row + WRITE_BLOCK_ROWS]
+        if numpy.issubdtype(block.dtype, numpy.floating):
+            block = numpy.where(numpy.isneginf(block), 0, block).astype(block.dtype)
+        band.WriteArray(block, 0, row)
 
 
 def main(args):
@@ -30,13 +97,17 @@ def main(args):
     parser.add_argument(
         "--type", choices=["uint8", "uint16", "float32"],
         help="Specify the type for the height band, default is float32.")
+    parser.add_argument("--chunk-size", type=int, default=1000000,
+                        help="Number of points read and projected at a time.  The "
+                             "points are reduced into a z-buffer of the size and type "
+                             "of the destination image, so memory use is bounded by "
+                             "that image plus a chunk of points.")
     args = parser.parse_args(args)
 
     # open the GDAL file
     sourceImage = gdal.Open(args.source_image, gdal.GA_ReadOnly)
     if not sourceImage:
         raise RuntimeError("Error: Failed to open source image {}".format(args.source_image))
-    model = None
     if (args.raytheon_rpc):
         # read the RPC from raytheon file
         print("Reading RPC from Raytheon file: {}".format(args.raytheon_rpc))
@@ -44,8 +115,9 @@ def main(args):
     else:
         # read the RPC from RPC Metadata in the image file
         print("Reading RPC Metadata from {}".format(args.source_image))
-        rpcMetaData = sourceImage.GetMetadata('RPC')
-        model = rpc.rpc_from_gdal_dict(rpcMetaData)
+        model = rpc_cache.load_rpc(args.source_image)
+    if model is None:
+        raise RuntimeError("Error: Failed to read the RPC")
 
     driver = sourceImage.GetDriver()
     driverMetadata = driver.GetMetadata()
@@ -76,6 +148,7 @@ def main(args):
         else:
             eType = gdal.GDT_Float32
             dtype = numpy.float32
+            MAX_VALUE = None
         destImage = driver.Create(
             args.destination_image, xsize=sourceImage.RasterXSize,
             ysize=sourceImage.RasterYSize, bands=1, eType=eType,
@@ -87,78 +160,33 @@ def main(args):
         else:
             # georeference through GCPs
             destImage.SetGCPs(gcps, gcpProjection)
-        raster = numpy.zeros(
-            (sourceImage.RasterYSize, sourceImage.RasterXSize),
-            dtype=dtype)
     else:
         raise RuntimeError("Error: driver {} does not supports Create().".format(driver))
 
-    # read the pdal file and project the points
-    json = u"""
-    {
-      "pipeline": [
-        "%s",
-        {
-            "type":"filters.reprojection",
-            "out_srs":"EPSG:4326"
-        }
-      ]
-    }"""
-    print("Loading Point Cloud")
-    json = json % args.source_points
-    pipeline = pdal.Pipeline(json)
-    pipeline.validate()  # check if our JSON and options were good
-    # this causes a segfault at the end of the program
-    # pipeline.loglevel = 8  # really noisy
-    pipeline.execute()
-    arrays = pipeline.arrays
-    arrayX = arrays[0]['X']
-    arrayY = arrays[0]['Y']
-    arrayZ = arrays[0]['Z']
-    pipeline = None
-
-    # Sort the points by height so that higher points project last
-    print("Sorting by Height")
-    heightIdx = numpy.argsort(arrayZ)
-    arrayX = arrayX[heightIdx]
-    arrayY = arrayY[heightIdx]
-    arrayZ = arrayZ[heightIdx]
-
-    minZ = numpy.amin(arrayZ)
-    maxZ = numpy.amax(arrayZ)
-    # project points to get image indexes and save their height into the image
-    print("Project {} points to destination image ...".format(len(arrayX)))
-    print("Points min/max Z: {}/{}  ...".format(minZ, maxZ))
-
-    print("Projecting Points")
-    imgPoints = model.project(numpy.array([arrayX, arrayY, arrayZ]).transpose())
-    intImgPoints = imgPoints.astype(numpy.int).transpose()
-
-    # find indicies of points that fall inside the image bounds
-    validIdx = numpy.logical_and.reduce((intImgPoints[1] < raster.shape[0],
-                                         intImgPoints[1] >= 0,
-                                         intImgPoints[0] < raster.shape[1],
-                                         intImgPoints[0] >= 0))
-
-    # keep only the points that are in the image
-    numOut = numpy.size(validIdx) - numpy.count_nonzero(validIdx)
+    # stream the points from the pdal file, in Long/Lat, and project them
+    # keeping the highest point in each pixel.  The z-buffer has the type
+    # of the destination image, so integer heights are quantized while
+    # projecting and the Z range is computed by a first pass over the points.
+    def read_chunks():
+        return pointcloud.read_point_chunks(
+            [args.source_points], chunk_size=args.chunk_size,
+            filters=[{"type": "filters.reprojection", "out_srs": "EPSG:4326"}])
+    z_range = None
+    if MAX_VALUE is not None:
+        z_range = point_z_range(read_chunks())
+        print("Points min/max Z: {}/{}  ...".format(*z_range))
+    print("Projecting Points by chunks of {}".format(args.chunk_size))
+    zbuffer, numPoints, numOut = project_point_chunks(
+        model, read_chunks(), (sourceImage.RasterYSize, sourceImage.RasterXSize),
+        dtype, z_range, MAX_VALUE)
+    print("Projected {} points to destination image".format(numPoints))
     if (numOut > 0):
         print("Skipped {} points outside of image".format(numOut))
-    intImgPoints = intImgPoints[:, validIdx]
-    if (args.type == "uint16" or args.type == "uint8"):
-        quantizedZ = ((arrayZ - minZ) * MAX_VALUE / (maxZ - minZ)).astype(
-            numpy.int)
-        quantizedZ = quantizedZ[validIdx]
-        print("Rendering Image")
-        raster[intImgPoints[1], intImgPoints[0]] = quantizedZ
-    else:
-        arrayZ = arrayZ[validIdx]
-        print("Rendering Image")
-        raster[intImgPoints[1], intImgPoints[0]] = arrayZ
 
     # Write the image
     print("Write destination image ...")
-    destImage.GetRasterBand(1).WriteArray(raster)
+    write_zbuffer(destImage.GetRasterBand(1), zbuffer)
+    del zbuffer
 
     # close files
     print("Close files ...")
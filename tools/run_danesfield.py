@@ -12,16 +12,23 @@ Run the Danesfield processing pipeline on an AOI from start to finish.
 """
 
 import argparse
+import concurrent.futures
 import configparser
 import datetime
 import glob
+import hashlib
+import json
 import logging
 import os
 import re
+import shutil
 import subprocess
 from pathlib import Path
 import sys
 import itertools
+import tempfile
+import threading
+import time
 
 
 def create_working_dir(working_dir, imagery_dir):
@@ -119,7 +126,315 @@ def py_cmd(tool_path):
     return ['python', '-u', tool_path]
 
 
-def run_step(working_dir, step_name, command, abort_on_error=True):
+# Serializes the output of steps that run concurrently
+_print_lock = threading.Lock()
+
+# Number of bytes read at the start, middle and end of a file to
+# fingerprint its content
+FINGERPRINT_SAMPLE_SIZE = 1 << 20
+
+
+def is_bookkeeping_file(fpath):
+    """
+    Whether a file is a log, exit status, manifest or profile file written
+    by `run_step` rather than an output of a step.
+    """
+    name = os.path.basename(fpath)
+    return name.endswith('.log') or name.endswith('.manifest.json') or \
+        name.endswith('.prof') or '.exitstatus.' in name
+
+
+def walk_files(dir_path):
+    """
+    Generate the paths of the files in a directory tree, skipping the
+    bookkeeping files of `run_step`.
+    """
+    for root, dirs, files in os.walk(dir_path):
+        dirs.sort()
+        for f in sorted(files):
+            fpath = os.path.join(root, f)
+            if not is_bookkeeping_file(fpath):
+                yield fpath
+
+
+def file_fingerprint(fpath):
+    """
+    Fingerprint a file from its size and a hash of samples of its content
+    at the start, middle and end of the file.
+    """
+    size = os.path.getsize(fpath)
+    h = hashlib.sha1(str(size).encode())
+    with open(fpath, 'rb') as f:
+        for offset in sorted({0,
+                              max(0, size // 2 - FINGERPRINT_SAMPLE_SIZE // 2),
+                              max(0, size - FINGERPRINT_SAMPLE_SIZE)}):
+            f.seek(offset)
+            h.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+    return h.hexdigest()
+
+
+def path_fingerprint(path):
+    """
+    Fingerprint a file, or all files of a directory.  Returns None if the
+    path does not exist.
+    """
+    if os.path.isdir(path):
+        return [[os.path.relpath(f, path), file_fingerprint(f)] for f in walk_files(path)]
+    if os.path.isfile(path):
+        return file_fingerprint(path)
+    return None
+
+
+# Options of the step commands setting a number of processes or threads,
+# left out of the step cache keys
+KEY_IGNORED_OPTIONS = ('-j', '--jobs')
+
+
+def key_command(command):
+    """
+    Remove the options in KEY_IGNORED_OPTIONS, and their values, from a
+    command line.
+    """
+    kept = []
+    skip = False
+    for arg in command:
+        if skip:
+            skip = False
+        elif str(arg) in KEY_IGNORED_OPTIONS:
+            skip = True
+        elif not str(arg).startswith(tuple(o + '=' for o in KEY_IGNORED_OPTIONS)):
+            kept.append(arg)
+    return kept
+
+
+def step_key(command, inputs=(), params=None, root=None):
+    """
+    Compute the cache key of a step from its command line, parameters
+    and the fingerprints of its input files.  Occurrences of the `root`
+    directory are left out so that the key doesn't depend on where the
+    pipeline is run, and so are the job counts, which don't change the
+    outputs.
+    """
+    def relative(s):
+        s = str(s)
+        return s.replace(root, '<root>') if root else s
+
+    if isinstance(command, str):
+        command = [command]
+    description = {'command': [relative(c) for c in key_command(command)],
+                   'params': params or {},
+                   'inputs': [[relative(path), path_fingerprint(path)]
+                              for path in sorted(inputs)]}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def read_manifest(manifest_fpath):
+    """
+    Read a step manifest, returns None if it doesn't exist or is invalid.
+    """
+    try:
+        with open(manifest_fpath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(manifest_fpath, key, files):
+    with open(manifest_fpath, 'w') as f:
+        json.dump({'key': key, 'files': files}, f, indent=2)
+
+
+def step_output_files(outputs, since):
+    """
+    List the files written by a step: output files, and the files in output
+    directories modified after the time `since`.
+    """
+    files = []
+    for path in outputs:
+        if os.path.isdir(path):
+            files.extend(f for f in walk_files(path) if os.path.getmtime(f) >= since)
+        elif os.path.isfile(path):
+            files.append(path)
+    return files
+
+
+def store_step_outputs(cache_dir, key, files, root=None):
+    """
+    Copy the output files of a step into the cache entry for `key`.
+    Paths are recorded relative to `root` when they are inside it.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.isdir(entry_dir):
+        return
+    # Write to a temporary directory first so that an entry is complete
+    # once it exists
+    tmp_dir = tempfile.mkdtemp(prefix=key + '.', dir=cache_dir)
+    index = []
+    for i, fpath in enumerate(files):
+        name = '{}_{}'.format(i, os.path.basename(fpath))
+        shutil.copy2(fpath, os.path.join(tmp_dir, name))
+        fpath = os.path.abspath(fpath)
+        if root and fpath.startswith(os.path.join(os.path.abspath(root), '')):
+            fpath = os.path.relpath(fpath, root)
+        index.append([name, fpath])
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # another run stored the same entry concurrently
+        shutil.rmtree(tmp_dir)
+
+
+def restore_step_outputs(cache_dir, key, root=None):
+    """
+    Copy the output files of the cache entry for `key` back to their
+    original locations, relative paths being relative to `root`.
+    Returns the restored files, or None if there is no entry for `key`
+    or the entry has no files.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry_dir, 'index.json')) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not index:
+        return None
+    files = []
+    for name, fpath in index:
+        fpath = os.path.join(root or '', fpath)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        shutil.copy2(os.path.join(entry_dir, name), fpath)
+        files.append(fpath)
+    return files
+
+
+# Interval in seconds between samples of the memory use of a running step
+RSS_SAMPLE_INTERVAL = 1.0
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def process_tree(pid):
+    """
+    List a process and its descendants, from the children lists of /proc.
+    """
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        for children_fpath in glob.glob('/proc/{}/task/*/children'.format(pids[i])):
+            try:
+                with open(children_fpath) as f:
+                    pids.extend(int(p) for p in f.read().split())
+            except (OSError, ValueError):
+                pass
+        i += 1
+    return pids
+
+
+def process_tree_rss(pid):
+    """
+    Resident set size in bytes of a process and its descendants.
+    """
+    rss = 0
+    for p in process_tree(pid):
+        try:
+            with open('/proc/{}/statm'.format(p)) as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            pass
+    return rss
+
+
+def read_proc_io(pid):
+    """
+    Read the I/O counters of a process, which include those of its
+    children that have exited.  Returns an empty dictionary if
+    /proc/<pid>/io is not available.
+    """
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            return {k.strip(): int(v) for k, v in
+                    (line.split(':') for line in f if ':' in line)}
+    except (OSError, ValueError):
+        return {}
+
+
+class ResourceMonitor(object):
+    """
+    Samples the memory use of a running process and its descendants in a
+    background thread, and collects its resource usage once it exits.
+    """
+
+    def __init__(self, proc, interval=RSS_SAMPLE_INTERVAL):
+        self.proc = proc
+        self.interval = interval
+        self.start_time = time.time()
+        self.rss_samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sample(self):
+        while True:
+            self.rss_samples.append([round(time.time() - self.start_time, 3),
+                                     process_tree_rss(self.proc.pid)])
+            if self._stop.wait(self.interval):
+                break
+
+    def wait(self):
+        """
+        Wait for the process to exit and reap it, setting its return code.
+        Returns a dictionary of the resource usage of the process and its
+        descendants.
+
+        The CPU times and peak RSS are the rusage of the process as
+        returned by wait4, i.e. its share of the RUSAGE_CHILDREN counters,
+        which stays accurate when several steps run at the same time.
+        """
+        # Wait without reaping, so that /proc/<pid>/io can still be read
+        os.waitid(os.P_PID, self.proc.pid, os.WEXITED | os.WNOWAIT)
+        wall_time = time.time() - self.start_time
+        self._stop.set()
+        self._thread.join()
+        io = read_proc_io(self.proc.pid)
+        _, status, usage = os.wait4(self.proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            self.proc.returncode = -os.WTERMSIG(status)
+        else:
+            self.proc.returncode = os.WEXITSTATUS(status)
+        return {'wall_time': wall_time,
+                'user_time': usage.ru_utime,
+                'system_time': usage.ru_stime,
+                # ru_maxrss is in kilobytes on Linux
+                'max_rss': usage.ru_maxrss * 1024,
+                'peak_sampled_rss': max(rss for t, rss in self.rss_samples),
+                'rss_samples': self.rss_samples,
+                'io': io}
+
+
+def profile_command(command, prof_fpath):
+    """
+    Run a python tool command under cProfile, writing the profile to
+    `prof_fpath`.  Commands that don't run a python script are returned
+    unchanged.
+    """
+    if isinstance(command, str) or not command or \
+       not os.path.basename(command[0]).startswith('python'):
+        return command
+    i = 1
+    while i < len(command) and command[i].startswith('-'):
+        if command[i] == '-m':
+            return command
+        i += 1
+    return command[:i] + ['-m', 'cProfile', '-o', prof_fpath] + command[i:]
+
+
+def run_step(working_dir, step_name, command, abort_on_error=True, output_prefix='',
+             inputs=None, outputs=(), params=None, cache_dir=None, root=None,
+             metrics=None, profile=False):
     """
     Runs a command if it has not already been run succcessfully.  Log
     and exit status files are written to `working_dir`.  This script
@@ -129,6 +444,15 @@ def run_step(working_dir, step_name, command, abort_on_error=True):
     The stdout and stderr of the command are both printed to stdout
     and written to the log file.
 
+    If `inputs` is given, the step is identified by a key hashing its
+    command, `params` and the content of its inputs, which is recorded
+    in a manifest file in `working_dir`.  A successfully completed step
+    is rerun if its key changes.  If `cache_dir` is given, the outputs of
+    successful steps are stored there under their key and restored
+    instead of rerunning a step with a known key.  Steps without outputs
+    are never stored or restored, so `outputs` must list every file or
+    directory the step writes.
+
     :param working_dir: Directory to create for log and exit status
     output files.
     :type working_dir: str
@@ -142,7 +466,42 @@ def run_step(working_dir, step_name, command, abort_on_error=True):
     :param abort_on_error: If True, the program will exit if the step
     fails.  Default is True.
     :type abort_on_error: bool
+
+    :param output_prefix: Prefix for each line of the command output
+    printed to stdout, used to tell apart steps running concurrently.
+    The log file is not prefixed.
+    :type output_prefix: str
+
+    :param inputs: Files and directories read by the step.
+    :type inputs: list of str
+
+    :param outputs: Files and directories written by the step.
+    :type outputs: list of str
+
+    :param params: Configuration parameters relevant to the step.
+    :type params: dict
+
+    :param cache_dir: Directory of cached step outputs.
+    :type cache_dir: str
+
+    :param root: Directory of the pipeline outputs, which may be moved
+    without invalidating the cache.
+    :type root: str
+
+    :param metrics: Dictionary filled with the status of the step and,
+    if it runs, its wall time, CPU time, memory use, I/O and output
+    sizes.
+    :type metrics: dict
+
+    :param profile: If True, a python step is run under cProfile and
+    its profile written to `<step_name>.prof` in `working_dir`.  The
+    step is run even if it already completed.
+    :type profile: bool
     """
+    if metrics is None:
+        metrics = {}
+    metrics.update(step=step_name, status='skipped', returncode=0)
+
     # Path to the log file, which will include both the stdout and
     # stderr from the step command
     step_log_fpath = os.path.join(working_dir, '{}.log'.format(step_name))
@@ -151,48 +510,292 @@ def run_step(working_dir, step_name, command, abort_on_error=True):
     # creation
     step_returncode_fpath_prefix = os.path.join(working_dir,
                                                 '{}.exitstatus'.format(step_name))
+    # Manifest recording the key of the last successful run
+    step_manifest_fpath = os.path.join(working_dir, '{}.manifest.json'.format(step_name))
+
+    key = None
+    if inputs is not None:
+        key = step_key(command, inputs, params, root)
 
     # Check that we haven't already succcessfully completed this step
-    # (as indicated by an exit status of 0)
-    if os.path.isfile('{}.0'.format(step_returncode_fpath_prefix)):
-        return 0
-    else:
-        # If we haven't run the step, or a previous run failed, remove
-        # previous log and returncode files
-        if os.path.isfile(step_log_fpath):
-            os.remove(step_log_fpath)
-        for f in glob.glob('{}.*'.format(step_returncode_fpath_prefix)):
-            os.remove(f)
-
-        # Create step working directory if it didn't already exist
-        if not os.path.isdir(working_dir):
-            os.mkdir(working_dir)
-
-        logging.info("---- Running step: {} ----".format(step_name))
-        logging.debug(command)
-        # Run the step; newline buffered text
-        proc = subprocess.Popen(command,
-                                stderr=subprocess.STDOUT,
-                                stdout=subprocess.PIPE,
-                                universal_newlines=True,
-                                bufsize=1)
-
-        # Write the output/err both to stdout and the log file
-        with open(step_log_fpath, 'w') as out_f:
-            for line in proc.stdout:
-                print(line, end='')
-                print(line, end='', file=out_f)
-
-        # Wait for the process to terminate and set the return code
-        # (max of 5 seconds)
-        proc.wait(timeout=5)
-        Path('{}.{}'.format(step_returncode_fpath_prefix, proc.returncode)).touch()
-
-        if abort_on_error and proc.returncode != 0:
-            logging.error('---- Error on step: {}.  Aborting! ----'.format(step_name))
-            exit(1)
-
-        return proc.returncode
+    # (as indicated by an exit status of 0) with the same key
+    if os.path.isfile('{}.0'.format(step_returncode_fpath_prefix)) and not profile:
+        if key is None:
+            return 0
+        manifest = read_manifest(step_manifest_fpath)
+        if manifest is None:
+            # Completed before manifests were recorded; trust it
+            write_manifest(step_manifest_fpath, key,
+                           step_output_files(outputs, 0))
+            return 0
+        if manifest['key'] == key:
+            return 0
+        logging.info("---- Command or inputs changed for step: {} ----".format(step_name))
+
+    # If we haven't run the step, or a previous run failed or is out
+    # of date, remove previous log, returncode and manifest files
+    if os.path.isfile(step_log_fpath):
+        os.remove(step_log_fpath)
+    for f in glob.glob('{}.*'.format(step_returncode_fpath_prefix)):
+        os.remove(f)
+    if os.path.isfile(step_manifest_fpath):
+        os.remove(step_manifest_fpath)
+
+    # Create step working directory if it didn't already exist.
+    # Concurrent steps may share a working directory.
+    os.makedirs(working_dir, exist_ok=True)
+
+    # Restore the outputs of a previous run with the same key
+    if key is not None and cache_dir and outputs and not profile:
+        restored = restore_step_outputs(cache_dir, key, root)
+        if restored is not None:
+            logging.info("---- Restored step from cache: {} ----".format(step_name))
+            write_manifest(step_manifest_fpath, key, restored)
+            metrics.update(status='restored', output_files=len(restored),
+                           output_bytes=sum(os.path.getsize(f) for f in restored))
+            Path('{}.0'.format(step_returncode_fpath_prefix)).touch()
+            return 0
+
+    logging.info("---- Running step: {} ----".format(step_name))
+    if profile:
+        prof_fpath = os.path.join(working_dir, '{}.prof'.format(step_name))
+        command = profile_command(command, prof_fpath)
+        metrics['profile'] = prof_fpath
+    logging.debug(command)
+    start_time = time.time()
+    # Run the step; newline buffered text
+    proc = subprocess.Popen(command,
+                            stderr=subprocess.STDOUT,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True,
+                            bufsize=1)
+    monitor = ResourceMonitor(proc)
+
+    # Write the output/err both to stdout and the log file
+    with open(step_log_fpath, 'w') as out_f:
+        for line in proc.stdout:
+            with _print_lock:
+                print(output_prefix + line, end='')
+            print(line, end='', file=out_f)
+
+    # Wait for the process to terminate and set the return code
+    metrics.update(monitor.wait())
+    metrics.update(status='ran' if proc.returncode == 0 else 'failed',
+                   returncode=proc.returncode, start_time=start_time)
+
+    # Allow for file systems with coarse modification times
+    output_files = step_output_files(outputs, start_time - 2)
+    metrics.update(output_files=len(output_files),
+                   output_bytes=sum(os.path.getsize(f) for f in output_files))
+
+    if key is not None and proc.returncode == 0:
+        if cache_dir and output_files:
+            os.makedirs(cache_dir, exist_ok=True)
+            store_step_outputs(cache_dir, key, output_files, root)
+        write_manifest(step_manifest_fpath, key, output_files)
+    Path('{}.{}'.format(step_returncode_fpath_prefix, proc.returncode)).touch()
+
+    if abort_on_error and proc.returncode != 0:
+        logging.error('---- Error on step: {}.  Aborting! ----'.format(step_name))
+        exit(1)
+
+    return proc.returncode
+
+
+class Step(object):
+    """
+    A step of the pipeline and the files it reads and writes.
+
+    The inputs and outputs are paths to files or directories.  A step
+    depends on every step that lists one of its inputs as an output.
+    The command may be a callable returning the command, in which case it
+    is only built once the step is ready to run, e.g. to glob the outputs
+    of the steps it depends on.
+    """
+
+    def __init__(self, working_dir, name, command, inputs=(), outputs=(),
+                 resources=(), params=None, abort_on_error=True):
+        """
+        :param working_dir: Directory for the log and exit status files.
+        :param name: Nominal identifier for the step.
+        :param command: Command passed to `run_step`, or a callable
+        returning it.
+        :param inputs: Paths read by the step.
+        :param outputs: Paths written by the step.  Only these are
+        stored in the step cache, and steps without outputs are not cached.
+        :param resources: Names of resources, such as 'gpu', that the
+        step uses exclusively.  Steps sharing a resource never run
+        concurrently.
+        :param params: Configuration parameters that affect the step
+        beyond its command line, part of the step cache key.
+        :param abort_on_error: If True, the pipeline stops if the step fails.
+        """
+        self.working_dir = working_dir
+        self.name = name
+        self.command = command
+        self.inputs = [os.path.normpath(p) for p in inputs]
+        self.outputs = [os.path.normpath(p) for p in outputs]
+        self.resources = set(resources)
+        self.params = dict(params or {})
+        self.abort_on_error = abort_on_error
+
+    def get_command(self):
+        if callable(self.command):
+            return self.command()
+        return self.command
+
+
+def step_dependencies(steps):
+    """
+    Compute the names of the steps that each step depends on.
+
+    :param steps: Steps of the pipeline.
+    :type steps: list of Step
+
+    :returns: Dictionary mapping each step name to a set of step names.
+    """
+    producers = {}
+    for step in steps:
+        for path in step.outputs:
+            producers.setdefault(path, []).append(step.name)
+    return {step.name: {name
+                        for path in step.inputs
+                        for name in producers.get(path, [])
+                        if name != step.name}
+            for step in steps}
+
+
+def format_metrics_table(metrics):
+    """
+    Format the metrics of the steps of a pipeline run as a table, one
+    row per step.
+    """
+    mb = 1024 * 1024
+    header = ['step', 'status', 'wall s', 'cpu s', 'max rss MB', 'read MB', 'write MB',
+              'output MB']
+    rows = []
+    for m in metrics:
+        io = m.get('io', {})
+        row = [m['step'], m['status']]
+        if 'wall_time' in m:
+            row += ['{:.1f}'.format(m['wall_time']),
+                    '{:.1f}'.format(m['user_time'] + m['system_time']),
+                    '{:.0f}'.format(max(m['max_rss'], m['peak_sampled_rss']) / mb),
+                    '{:.0f}'.format(io.get('rchar', 0) / mb),
+                    '{:.0f}'.format(io.get('wchar', 0) / mb)]
+        else:
+            row += ['-'] * 5
+        row.append('{:.0f}'.format(m['output_bytes'] / mb) if 'output_bytes' in m else '-')
+        rows.append(row)
+    total_wall = sum(m.get('wall_time', 0) for m in metrics)
+    total_cpu = sum(m.get('user_time', 0) + m.get('system_time', 0) for m in metrics)
+    rows.append(['total', '', '{:.1f}'.format(total_wall), '{:.1f}'.format(total_cpu),
+                 '', '', '', ''])
+    widths = [max(len(r[i]) for r in [header] + rows) for i in range(len(header))]
+    lines = []
+    for r in [header] + rows:
+        lines.append('  '.join(c.ljust(w) if i < 2 else c.rjust(w)
+                               for i, (c, w) in enumerate(zip(r, widths))).rstrip())
+    lines.insert(1, '-' * len(lines[0]))
+    return '\n'.join(lines)
+
+
+def write_pipeline_metrics(metrics_fpath, metrics, wall_time, jobs):
+    """
+    Write the metrics of the steps of a pipeline run to a JSON file.
+    """
+    with open(metrics_fpath, 'w') as f:
+        json.dump({'wall_time': wall_time, 'jobs': jobs, 'steps': metrics}, f, indent=2)
+
+
+def run_steps(steps, jobs=1, cache_dir=None, root=None, profile=False, metrics_fpath=None):
+    """
+    Run the steps of the pipeline, running up to `jobs` steps whose
+    dependencies are satisfied at the same time.  Steps that are ready are
+    started in the order they are listed, so with one job the steps run in
+    that order.  Each step goes through `run_step`, so completed steps are
+    skipped, out of date steps are rerun, and logs and exit status files
+    are written as usual.
+
+    This script will exit(1) once the running steps finish if a step that
+    has `abort_on_error` set fails.
+
+    :param steps: Steps of the pipeline, in a valid serial order.
+    :type steps: list of Step
+
+    :param jobs: Maximum number of steps to run concurrently.
+    :type jobs: int
+
+    :param cache_dir: Directory of cached step outputs, or None to
+    disable the cache.
+    :type cache_dir: str
+
+    :param root: Working directory of the pipeline, see `run_step`.
+    :type root: str
+
+    :param profile: Run python steps under cProfile, see `run_step`.
+    :type profile: bool
+
+    :param metrics_fpath: File to which the timing and resource usage
+    of each step are written as JSON.  A summary table is also logged
+    once the steps finish.
+    :type metrics_fpath: str
+    """
+    dependencies = step_dependencies(steps)
+    pending = list(steps)
+    done = set()
+    running = {}
+    busy_resources = set()
+    failed = []
+    metrics = {}
+    start_time = time.time()
+    output_prefix = '{}: ' if jobs > 1 else ''
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            if not failed:
+                for step in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    if dependencies[step.name] <= done and \
+                       not step.resources & busy_resources:
+                        pending.remove(step)
+                        busy_resources |= step.resources
+                        metrics[step.name] = {}
+                        future = executor.submit(run_step, step.working_dir, step.name,
+                                                 step.get_command(), abort_on_error=False,
+                                                 output_prefix=output_prefix.format(step.name),
+                                                 inputs=step.inputs, outputs=step.outputs,
+                                                 params=step.params, cache_dir=cache_dir,
+                                                 root=root, metrics=metrics[step.name],
+                                                 profile=profile)
+                        running[future] = step
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                busy_resources -= step.resources
+                if future.result() == 0 or not step.abort_on_error:
+                    done.add(step.name)
+                else:
+                    logging.error('---- Error on step: {}. ----'.format(step.name))
+                    failed.append(step.name)
+
+    # Report the steps in pipeline order
+    metrics = [metrics[step.name] for step in steps if step.name in metrics]
+    if metrics_fpath:
+        write_pipeline_metrics(metrics_fpath, metrics, time.time() - start_time, jobs)
+    if metrics:
+        logging.info('---- Pipeline metrics ----\n' + format_metrics_table(metrics))
+
+    if failed:
+        logging.error('---- Error on steps: {}.  Aborting! ----'.format(', '.join(failed)))
+        exit(1)
+    if pending:
+        raise RuntimeError('Steps with unsatisfied dependencies: {}'.format(
+            ', '.join(step.name for step in pending)))
 
 
 def main(args):
@@ -200,6 +803,13 @@ def main(args):
         description="Run the Danesfield processing pipeline on an AOI from start to finish.")
     parser.add_argument("ini_file",
                         help="ini file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Maximum number of independent steps to run concurrently")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't store or restore step outputs in the step cache")
+    parser.add_argument("--profile", action="store_true",
+                        help="Rerun every step, profiling python steps with cProfile.  "
+                             "Profiles are written to <step>.prof next to the step logs")
     args = parser.parse_args(args)
 
     # Read configuration file
@@ -212,6 +822,12 @@ def main(args):
     working_dir = create_working_dir(config['paths'].get('work_dir'),
                                      config['paths']['imagery_dir'])
 
+    # Outputs of successful steps are cached by a hash of their command
+    # and inputs, so that they can be restored rather than recomputed
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = config['paths'].get('cache_dir', os.path.join(working_dir, 'step-cache'))
+
     aoi_name = config['aoi']['name']
 
     gsd = float(config['params'].get('gsd', 0.25))
@@ -250,6 +866,9 @@ def main(args):
     for idx in incomplete_ids:
         del collection_id_to_files[idx]
 
+    # Steps of the pipeline, listed in a valid serial order
+    steps = []
+
     #############################################
     # Render DSM from P3D point cloud
     #############################################
@@ -261,14 +880,21 @@ def main(args):
     cmd_args += [dsm_file, '-s', p3d_file]
     cmd_args += ['--gsd', str(gsd)]
 
+    generate_dsm_outputs = [dsm_file]
     bounds = config['aoi'].get('bounds')
     if bounds:
         cmd_args += ['--bounds']
         cmd_args += bounds.split(' ')
+    else:
+        # The bounds of the point cloud are cached next to the DSM
+        generate_dsm_outputs.append(os.path.join(generate_dsm_outdir,
+                                                 'point_cloud_bounds.json'))
 
-    run_step(generate_dsm_outdir,
-             'generate-dsm',
-             cmd_args)
+    steps.append(Step(generate_dsm_outdir,
+                      'generate-dsm',
+                      cmd_args,
+                      inputs=[p3d_file],
+                      outputs=generate_dsm_outputs))
 
     # #############################################
     # # Fit Dtm to the DSM
@@ -279,36 +905,51 @@ def main(args):
 
     cmd_args = py_cmd(relative_tool_path('fit_dtm.py'))
     cmd_args += [dsm_file, dtm_file]
+    if config.has_option('params', 'dtm_jobs'):
+        cmd_args.extend(['--jobs', config.get('params', 'dtm_jobs')])
 
-    run_step(fit_dtm_outdir,
-             'fit-dtm',
-             cmd_args)
+    steps.append(Step(fit_dtm_outdir,
+                      'fit-dtm',
+                      cmd_args,
+                      inputs=[dsm_file],
+                      outputs=[dtm_file]))
 
     #############################################
     # Orthorectify images
     #############################################
-    # For each MSI source image call orthorectify.py
-    # needs to use the DSM, DTM from above and Raytheon RPC file,
-    # which is a by-product of P3D.
+    # Call orthorectify_many.py for all MSI source images at once so
+    # that the DSM processing is shared between images.  It needs to
+    # use the DSM, DTM from above and Raytheon RPC file, which is a
+    # by-product of P3D.
 
     orthorectify_outdir = os.path.join(working_dir, 'orthorectify')
+    cmd_args = py_cmd(relative_tool_path('orthorectify_many.py'))
+    cmd_args += [dsm_file, orthorectify_outdir, '--dtm', dtm_file]
+    orthorectify_inputs = [dsm_file, dtm_file]
     for collection_id, files in collection_id_to_files.items():
         # Orthorectify the msi images
         msi_ntf_fpath = files['msi']['image']
         msi_fname = os.path.splitext(os.path.split(msi_ntf_fpath)[1])[0]
         msi_ortho_img_fpath = os.path.join(orthorectify_outdir, '{}_ortho.tif'.format(msi_fname))
-        cmd_args = py_cmd(relative_tool_path('orthorectify.py'))
-        cmd_args += [msi_ntf_fpath, dsm_file, msi_ortho_img_fpath, '--dtm', dtm_file]
+        cmd_args += ['--image', msi_ntf_fpath]
+        orthorectify_inputs.append(msi_ntf_fpath)
 
         msi_rpc_fpath = files['msi'].get('rpc', None)
         if msi_rpc_fpath:
-            cmd_args.extend(['--raytheon-rpc', msi_rpc_fpath])
-
-        run_step(orthorectify_outdir,
-                 'orthorectify-{}'.format(msi_fname),
-                 cmd_args)
+            cmd_args.append(msi_rpc_fpath)
+            orthorectify_inputs.append(msi_rpc_fpath)
 
         files['msi']['ortho_img_fpath'] = msi_ortho_img_fpath
+
+    if config.has_option('params', 'ortho_jobs'):
+        cmd_args.extend(['--jobs', config.get('params', 'ortho_jobs')])
+
+    steps.append(Step(orthorectify_outdir,
+                      'orthorectify',
+                      cmd_args,
+                      inputs=orthorectify_inputs,
+                      outputs=[files['msi']['ortho_img_fpath']
+                               for files in collection_id_to_files.values()]))
     #
     # Note: we may eventually select a subset of input images
     # on which to run this and the following steps
@@ -322,15 +963,18 @@ def main(args):
     ndvi_outdir = os.path.join(working_dir, 'compute-ndvi')
     ndvi_output_fpath = os.path.join(ndvi_outdir, 'ndvi.tif')
     cmd_args = py_cmd(relative_tool_path('compute_ndvi.py'))
-    cmd_args += [files['msi']['ortho_img_fpath'] for
-                 files in
-                 collection_id_to_files.values() if
-                 'msi' in files and 'ortho_img_fpath' in files['msi']]
+    ortho_img_fpaths = [files['msi']['ortho_img_fpath'] for
+                        files in
+                        collection_id_to_files.values() if
+                        'msi' in files and 'ortho_img_fpath' in files['msi']]
+    cmd_args += ortho_img_fpaths
     cmd_args.append(ndvi_output_fpath)
 
-    run_step(ndvi_outdir,
-             'compute-ndvi',
-             cmd_args)
+    steps.append(Step(ndvi_outdir,
+                      'compute-ndvi',
+                      cmd_args,
+                      inputs=ortho_img_fpaths,
+                      outputs=[ndvi_output_fpath]))
 
     #############################################
     # Get OSM road vector data
@@ -339,13 +983,18 @@ def main(args):
 
     get_road_vector_outdir = os.path.join(working_dir, 'get-road-vector')
     road_vector_output_fpath = os.path.join(get_road_vector_outdir, 'road_vector.geojson')
+    # Intermediate files written next to the road vector
+    road_vector_osm_fpaths = [os.path.join(get_road_vector_outdir, 'road_vector' + suffix)
+                              for suffix in ('.osm', '.preformat.geojson')]
     cmd_args = py_cmd(relative_tool_path('get_road_vector.py'))
     cmd_args += ['--bounding-img', dsm_file,
                  '--output-dir', get_road_vector_outdir]
 
-    run_step(get_road_vector_outdir,
-             'get-road-vector',
-             cmd_args)
+    steps.append(Step(get_road_vector_outdir,
+                      'get-road-vector',
+                      cmd_args,
+                      inputs=[dsm_file],
+                      outputs=[road_vector_output_fpath] + road_vector_osm_fpaths))
 
     #############################################
     # Segment by Height and Vegetation
@@ -355,20 +1004,24 @@ def main(args):
 
     seg_by_height_outdir = os.path.join(working_dir, 'segment-by-height')
     threshold_output_mask_fpath = os.path.join(seg_by_height_outdir, 'threshold_CLS.tif')
+    road_rasterized_fpath = os.path.join(seg_by_height_outdir, 'road_rasterized.tif')
+    road_rasterized_bridge_fpath = os.path.join(seg_by_height_outdir,
+                                                'road_rasterized_bridge.tif')
     cmd_args = py_cmd(relative_tool_path('segment_by_height.py'))
     cmd_args += [dsm_file,
                  dtm_file,
                  threshold_output_mask_fpath,
                  '--input-ndvi', ndvi_output_fpath,
                  '--road-vector', road_vector_output_fpath,
-                 '--road-rasterized',
-                 os.path.join(seg_by_height_outdir, 'road_rasterized.tif'),
-                 '--road-rasterized-bridge',
-                 os.path.join(seg_by_height_outdir, 'road_rasterized_bridge.tif')]
+                 '--road-rasterized', road_rasterized_fpath,
+                 '--road-rasterized-bridge', road_rasterized_bridge_fpath]
 
-    run_step(seg_by_height_outdir,
-             'segment-by-height',
-             cmd_args)
+    steps.append(Step(seg_by_height_outdir,
+                      'segment-by-height',
+                      cmd_args,
+                      inputs=[dsm_file, dtm_file, ndvi_output_fpath, road_vector_output_fpath],
+                      outputs=[threshold_output_mask_fpath, road_rasterized_fpath,
+                               road_rasterized_bridge_fpath]))
 
     #############################################
     # Material Segmentation
@@ -395,9 +1048,15 @@ def main(args):
     if config['material'].getboolean('cuda'):
             cmd_args.append('--cuda')
 
-    run_step(material_classifier_outdir,
-             'material-classification',
-             cmd_args)
+    # Expected file path for material classification output MTL file
+    output_mtl = os.path.join(material_classifier_outdir, '{}_MTL.tif'.format(aoi_name))
+
+    steps.append(Step(material_classifier_outdir,
+                      'material-classification',
+                      cmd_args,
+                      inputs=img_paths + info_paths + [config['material']['model_fpath']],
+                      outputs=[output_mtl],
+                      resources=['gpu']))
 
     #############################################
     # Roof Geon Extraction & PointNet Geon Extraction
@@ -420,80 +1079,102 @@ def main(args):
         '--output_dir', roof_geon_extraction_outdir
     ]
 
-    run_step(roof_geon_extraction_outdir,
-             'roof-geon-extraction',
-             cmd_args)
+    steps.append(Step(roof_geon_extraction_outdir,
+                      'roof-geon-extraction',
+                      cmd_args,
+                      inputs=[p3d_file, threshold_output_mask_fpath, dtm_file,
+                              config['roof']['model_dir']],
+                      outputs=[roof_geon_extraction_outdir],
+                      resources=['gpu']))
 
     #############################################
     # Texture Mapping
     #############################################
 
     crop_and_pansharpen_outdir = os.path.join(working_dir, 'crop-and-pansharpen')
+    crop_pansharpened_fpaths = []
     for collection_id, files in collection_id_to_files.items():
         cmd_args = py_cmd(relative_tool_path('crop_and_pansharpen.py'))
-        cmd_args += [dsm_file, crop_and_pansharpen_outdir, "--pan", files['pan']['image']]
-        rpc_fpath = files['pan'].get('rpc', None)
-        if (rpc_fpath):
-            cmd_args.append(rpc_fpath)
-        cmd_args.extend(["--msi", files['msi']['image']])
-        rpc_fpath = files['msi'].get('rpc', None)
-        if (rpc_fpath):
-            cmd_args.append(rpc_fpath)
-
-        run_step(crop_and_pansharpen_outdir,
-                 'crop-and-pansharpen-{}'.format(collection_id),
-                 cmd_args)
+        cmd_args += [dsm_file, crop_and_pansharpen_outdir]
+        inputs = [dsm_file]
+        outputs = []
+        for modality in ('pan', 'msi'):
+            cmd_args.extend(['--' + modality, files[modality]['image']])
+            inputs.append(files[modality]['image'])
+            rpc_fpath = files[modality].get('rpc', None)
+            if (rpc_fpath):
+                cmd_args.append(rpc_fpath)
+                inputs.append(rpc_fpath)
+            fname = os.path.splitext(os.path.split(files[modality]['image'])[1])[0]
+            outputs.append(os.path.join(crop_and_pansharpen_outdir,
+                                        '{}_crop.tif'.format(fname)))
+        # Steps for different collections share the output directory, so
+        # list their output files explicitly
+        pan_fname = os.path.splitext(os.path.split(files['pan']['image'])[1])[0]
+        outputs += [os.path.join(crop_and_pansharpen_outdir, pan_fname + suffix)
+                    for suffix in ('_crop_pansharpened.tif',
+                                   '_crop_pansharpened_processed.tif')]
+        crop_pansharpened_fpaths.append(outputs[-1])
+
+        steps.append(Step(crop_and_pansharpen_outdir,
+                          'crop-and-pansharpen-{}'.format(collection_id),
+                          cmd_args,
+                          inputs=inputs,
+                          outputs=outputs))
 
     texture_mapping_outdir = os.path.join(working_dir, 'texture-mapping')
     occlusion_mesh = "xxxx.obj"
-    images_to_use = glob.glob(os.path.join(crop_and_pansharpen_outdir,
-                                           "*_crop_pansharpened_processed.tif"))
-    orig_meshes = glob.glob(os.path.join(roof_geon_extraction_outdir, "*.obj"))
-    orig_meshes = [e for e in orig_meshes
-                   if e.find(occlusion_mesh) < 0 and e.find("building_") < 0]
-    cmd_args = py_cmd(relative_tool_path('texture_mapping.py'))
-    cmd_args += [dsm_file, dtm_file, texture_mapping_outdir, occlusion_mesh, "--crops"]
-    cmd_args.extend(images_to_use)
-    cmd_args.append("--buildings")
-    cmd_args.extend(orig_meshes)
-
-    run_step(texture_mapping_outdir,
-             'texture-mapping',
-             cmd_args)
+
+    # The crops and meshes are only known once the previous steps have run
+    def texture_mapping_cmd():
+        images_to_use = glob.glob(os.path.join(crop_and_pansharpen_outdir,
+                                               "*_crop_pansharpened_processed.tif"))
+        orig_meshes = glob.glob(os.path.join(roof_geon_extraction_outdir, "*.obj"))
+        orig_meshes = [e for e in orig_meshes
+                       if e.find(occlusion_mesh) < 0 and e.find("building_") < 0]
+        cmd_args = py_cmd(relative_tool_path('texture_mapping.py'))
+        cmd_args += [dsm_file, dtm_file, texture_mapping_outdir, occlusion_mesh, "--crops"]
+        cmd_args.extend(images_to_use)
+        cmd_args.append("--buildings")
+        cmd_args.extend(orig_meshes)
+        return cmd_args
+
+    steps.append(Step(texture_mapping_outdir,
+                      'texture-mapping',
+                      texture_mapping_cmd,
+                      inputs=[dsm_file, dtm_file, roof_geon_extraction_outdir] +
+                      crop_pansharpened_fpaths,
+                      outputs=[texture_mapping_outdir]))
 
     #############################################
     # Buildings to DSM
     #############################################
 
     buildings_to_dsm_outdir = os.path.join(working_dir, 'buildings-to-dsm')
-    # Generate the output DSM
+    # Generate the output DSM and CLS from the same rendering of the buildings
     output_dsm = os.path.join(buildings_to_dsm_outdir, "buildings_to_dsm_DSM.tif")
-    cmd_args = py_cmd(relative_tool_path('buildings_to_dsm.py'))
-    cmd_args += [dtm_file,
-                 output_dsm]
-    cmd_args.append('--input_obj_paths')
-    obj_list = glob.glob("{}/*.obj".format(roof_geon_extraction_outdir))
-    # remove occlusion_mesh and results (building_<i>.obj)
-    obj_list = [e for e in obj_list
-                if e.find(occlusion_mesh) < 0 and e.find("building_") < 0]
-    cmd_args.extend(obj_list)
-
-    run_step(buildings_to_dsm_outdir,
-             'buildings-to-dsm_DSM',
-             cmd_args)
-
-    # Generate the output CLS
     output_cls = os.path.join(buildings_to_dsm_outdir, "buildings_to_dsm_CLS.tif")
-    cmd_args = py_cmd(relative_tool_path('buildings_to_dsm.py'))
-    cmd_args += [dtm_file,
-                 output_cls,
-                 '--render_cls']
-    cmd_args.append('--input_obj_paths')
-    cmd_args.extend(obj_list)
 
-    run_step(buildings_to_dsm_outdir,
-             'buildings-to-dsm_CLS',
-             cmd_args)
+    def building_obj_list():
+        obj_list = glob.glob("{}/*.obj".format(roof_geon_extraction_outdir))
+        # remove occlusion_mesh and results (building_<i>.obj)
+        return [e for e in obj_list
+                if e.find(occlusion_mesh) < 0 and e.find("building_") < 0]
+
+    def buildings_to_dsm_cmd():
+        cmd_args = py_cmd(relative_tool_path('buildings_to_dsm.py'))
+        cmd_args += [dtm_file,
+                     output_dsm,
+                     '--output_cls', output_cls]
+        cmd_args.append('--input_obj_paths')
+        cmd_args.extend(building_obj_list())
+        return cmd_args
+
+    steps.append(Step(buildings_to_dsm_outdir,
+                      'buildings-to-dsm',
+                      buildings_to_dsm_cmd,
+                      inputs=[dtm_file, roof_geon_extraction_outdir],
+                      outputs=[output_dsm, output_cls]))
 
     #############################################
     # Run metrics
@@ -501,9 +1182,6 @@ def main(args):
 
     run_metrics_outdir = os.path.join(working_dir, 'run_metrics')
 
-    # Expected file path for material classification output MTL file
-    output_mtl = os.path.join(material_classifier_outdir, '{}_MTL.tif'.format(aoi_name))
-
     cmd_args = py_cmd(relative_tool_path('run_metrics.py'))
     cmd_args += [
         '--output-dir', run_metrics_outdir,
@@ -514,9 +1192,15 @@ def main(args):
         '--mtl', output_mtl,
         '--dtm', dtm_file]
 
-    run_step(run_metrics_outdir,
-             'run-metrics',
-             cmd_args)
+    steps.append(Step(run_metrics_outdir,
+                      'run-metrics',
+                      cmd_args,
+                      inputs=[output_dsm, output_cls, output_mtl, dtm_file,
+                              config['metrics']['ref_data_dir']],
+                      outputs=[run_metrics_outdir]))
+
+    run_steps(steps, args.jobs, cache_dir, working_dir, profile=args.profile,
+              metrics_fpath=os.path.join(working_dir, 'pipeline_metrics.json'))
 
 
 if __name__ == '__main__':
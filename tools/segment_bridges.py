@@ -14,27 +14,12 @@ import os
 import cv2
 import gdal
 import numpy
-import numpy.linalg
 import scipy.ndimage.measurements as ndm
 import scipy.ndimage.morphology as morphology
 
+from danesfield import regions
 from danesfield.gdal_utils import gdal_open, gdal_save
-from danesfield.rasterize import ELEVATED_ROADS_QUERY, rasterize_file_dilated_line
-
-
-def estimate_object_scale(img):
-    """
-    Given a binary (boolean) image, return a pair estimating the large
-    and small dimension of the object in img.  We currently use PCA
-    for this purpose.
-    """
-    points = numpy.transpose(img.nonzero())
-    points = points - points.mean(0)
-    s = numpy.linalg.svd(points, compute_uv=False) / len(points) ** 0.5
-    # If the object was a perfect rectangle, this would calculate the
-    # lengths of its axes.  (For an ellipse the value is 1/16)
-    VARIANCE_RATIO = 1 / 12
-    return s / VARIANCE_RATIO ** 0.5
+from danesfield.rasterize import rasterize_file_buffered_roads
 
 
 def main(args):
@@ -94,15 +79,10 @@ both --road-vector-shapefile-dir AND --road-vector-shapefile-prefix")
         else:
             input_road_vector = args.road_vector
 
-        # The dilation is intended to create semi-realistic widths
-        roads = rasterize_file_dilated_line(
-            input_road_vector, cls_file, args.road_rasterized,
-            numpy.ones((3, 3)), dilation_iterations=20,
-        )
-        road_bridges = rasterize_file_dilated_line(
-            input_road_vector, cls_file, args.road_rasterized_bridge,
-            numpy.ones((3, 3)), dilation_iterations=20,
-            query=ELEVATED_ROADS_QUERY,
+        # The buffering is intended to create semi-realistic widths
+        roads, road_bridges = rasterize_file_buffered_roads(
+            input_road_vector, cls_file, 20,
+            args.road_rasterized, args.road_rasterized_bridge,
         )
 
         # Remove building candidates that overlap with a road
@@ -111,17 +91,9 @@ both --road-vector-shapefile-dir AND --road-vector-shapefile-prefix")
 
     # label the larger mask image
     label_img = ndm.label(mask)[0]
-    # extract the unique labels that match the seeds
-    selected, counts = numpy.unique(label_img, return_counts=True)
-    # filter out very oblong objects
-    subselected = []
-    for i, n in zip(selected, counts):
-        # skip the background and small components
-        if i == 0 or n < 64:
-            continue
-        dim_large, dim_small = estimate_object_scale(label_img == i)
-        if dim_small > 0 and dim_large / dim_small < 6:
-            subselected.append(i)
+    # filter out small and very oblong objects
+    stats = regions.component_stats(label_img)
+    subselected = regions.select_components(stats, min_count=64, max_elongation=6)
 
     logging.info("Keeping {} connected components".format(len(subselected)))
 
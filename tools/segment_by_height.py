@@ -14,12 +14,12 @@ import os
 import cv2
 import gdal
 import numpy
-import numpy.linalg
 import scipy.ndimage.measurements as ndm
 import scipy.ndimage.morphology as morphology
 
 from danesfield.gdal_utils import gdal_open, gdal_save
-from danesfield.rasterize import ELEVATED_ROADS_QUERY, rasterize_file_dilated_line
+from danesfield import regions
+from danesfield.rasterize import rasterize_file_buffered_roads
 
 
 def save_ndsm(ndsm, dsm_file, filename):
@@ -31,19 +31,16 @@ def save_ndsm(ndsm, dsm_file, filename):
     ndsm_file.GetRasterBand(1).SetNoDataValue(no_data_val)
 
 
-def estimate_object_scale(img):
+def select_compact_components(label_img, selected, max_elongation=6):
     """
-    Given a binary (boolean) image, return a pair estimating the large
-    and small dimension of the object in img.  We currently use PCA
-    for this purpose.
+    Return the labels in selected whose components are not too oblong,
+    i.e. whose ratio of large to small dimension, estimated by PCA, is
+    less than max_elongation.
     """
-    points = numpy.transpose(img.nonzero())
-    points = points - points.mean(0)
-    s = numpy.linalg.svd(points, compute_uv=False) / len(points) ** 0.5
-    # If the object was a perfect rectangle, this would calculate the
-    # lengths of its axes.  (For an ellipse the value is 1/16)
-    VARIANCE_RATIO = 1 / 12
-    return s / VARIANCE_RATIO ** 0.5
+    selected = numpy.asarray(selected)
+    selected = selected[selected > 0]
+    stats = regions.region_stats(label_img)
+    return selected[regions.elongation(stats[selected - 1]) < max_elongation]
 
 
 def main(args):
@@ -139,15 +136,10 @@ both --road-vector-shapefile-dir AND --road-vector-shapefile-prefix")
         else:
             input_road_vector = args.road_vector
 
-        # The dilation is intended to create semi-realistic widths
-        roads = rasterize_file_dilated_line(
-            input_road_vector, dsm_file, args.road_rasterized,
-            numpy.ones((3, 3)), dilation_iterations=20,
-        )
-        road_bridges = rasterize_file_dilated_line(
-            input_road_vector, dsm_file, args.road_rasterized_bridge,
-            numpy.ones((3, 3)), dilation_iterations=20,
-            query=ELEVATED_ROADS_QUERY,
+        # The buffering is intended to create semi-realistic widths
+        roads, road_bridges = rasterize_file_buffered_roads(
+            input_road_vector, dsm_file, 20,
+            args.road_rasterized, args.road_rasterized_bridge,
         )
 
         # Remove building candidates that overlap with a road
@@ -181,11 +173,7 @@ both --road-vector-shapefile-dir AND --road-vector-shapefile-prefix")
     # extract the unique labels that match the seeds
     selected = numpy.unique(numpy.extract(seeds, label_img))
     # filter out very oblong objects
-    subselected = []
-    for i in selected:
-        dim_large, dim_small = estimate_object_scale(label_img == i)
-        if dim_large / dim_small < 6:
-            subselected.append(i)
+    subselected = select_compact_components(label_img, selected)
 
     print("Keeping {} connected components".format(len(subselected)))
 
@@ -18,7 +18,7 @@ import gdal
 import pyproj
 
 from danesfield import gdal_utils
-from orthorectify_list import intersection
+from danesfield import image_index
 
 
 def main(args):
@@ -32,37 +32,27 @@ def main(args):
         '--output-filepath',
         type=str,
         help='Results will be written to the provided filepath')
+    parser.add_argument(
+        '--metadata-index',
+        help='JSON index of the image metadata read from the NITF headers, reused '
+             'while the images are unchanged')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of processes reading the metadata of images missing from the '
+             'index')
     parser.add_argument(
         'image_files', nargs='+')
 
     args = parser.parse_args(args)
 
     # Method taken from the 'orthorectify_list.py' script
-    angles = numpy.zeros(len(args.image_files))
-    cloudCover = numpy.zeros(len(args.image_files))
-    bounds = numpy.zeros([len(args.image_files), 4])
-
     outProj = pyproj.Proj('+proj=longlat +datum=WGS84')
     dsmImage = gdal.Open(args.dsm, gdal.GA_ReadOnly)
     dsmBounds = gdal_utils.gdal_bounding_box(dsmImage, outProj)
-    dsmArea = (dsmBounds[2] - dsmBounds[0]) * (dsmBounds[3] - dsmBounds[1])
-
-    areas = numpy.zeros(len(args.image_files))
-
-    for i, image_file in enumerate(args.image_files):
-        sourceImage = gdal.Open(image_file, gdal.GA_ReadOnly)
-        metaData = sourceImage.GetMetadata()
-        angles[i] = metaData['NITF_CSEXRA_OBLIQUITY_ANGLE']
-        cloudCover[i] = metaData['NITF_PIAIMC_CLOUDCVR']
-        bounds = gdal_utils.gdal_bounding_box(sourceImage, outProj)
-
-        imageIntersectDsm = intersection(dsmBounds, bounds)
-        areaImageIntersectDsm = (imageIntersectDsm[2] - imageIntersectDsm[0]) *\
-            (imageIntersectDsm[3] - imageIntersectDsm[1]) if imageIntersectDsm else 0
-        # area of DSM not covered
-        areas[i] = dsmArea - areaImageIntersectDsm
 
-    sortIndex = numpy.lexsort((angles, cloudCover, areas))
+    metadata = image_index.image_metadata(
+        args.image_files, args.metadata_index, args.jobs)
+    sortIndex, areas = image_index.rank_images(dsmBounds, metadata)
 
     bestList = numpy.asarray(args.image_files)[sortIndex]
 
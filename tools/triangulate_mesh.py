@@ -15,6 +15,8 @@ import sys
 import vtk
 from vtk.util.numpy_support import vtk_to_numpy
 
+from danesfield import mesh as mesh_io
+
 """ This script triangulate a mesh using the VTK Triangle filter """
 
 
@@ -22,12 +24,17 @@ def main(args):
     parser = argparse.ArgumentParser(description="Transform a mesh into a pure triangular mesh")
     parser.add_argument('input_mesh', type=str, help='Input mesh')
     parser.add_argument('output_dir', type=str, help='Output directory')
+    parser.add_argument('--ply', action='store_true',
+                        help='Write a binary PLY mesh instead of an OBJ mesh, the OBJ header '
+                             'is written as comments')
     # Parse arguments
     args = parser.parse_args(args)
 
     if not os.path.isdir(args.output_dir):
         os.mkdir(args.output_dir)
     output_mesh = os.path.join(args.output_dir, os.path.basename(args.input_mesh))
+    if args.ply:
+        output_mesh = os.path.splitext(output_mesh)[0] + ".ply"
 
     # Read OBJ
     reader = vtk.vtkOBJReader()
@@ -51,17 +58,12 @@ def main(args):
     tri_filter.Update()
     mesh = tri_filter.GetOutput()
 
-    # Write OBJ (header + data)
+    # Write OBJ (header + data), the triangles are stored as (3, id0, id1, id2)
     faces = mesh.GetPolys().GetData()
     faces = vtk_to_numpy(faces).reshape((-1, 4))
     vertices = mesh.GetPoints().GetData()
     vertices = vtk_to_numpy(vertices)
-    with open(output_mesh, "w") as out_f:
-        out_f.writelines(header)
-        for v in vertices:
-            out_f.write("v " + " ".join(map(str, v)) + "\n")
-        for f in faces[:, 1:]:
-            out_f.write("f " + " ".join(map(lambda x: str(x+1), f)) + "\n")
+    mesh_io.write_mesh(output_mesh, vertices, faces[:, 1:], header)
 
 
 if __name__ == "__main__":